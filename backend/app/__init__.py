@@ -1,42 +1,151 @@
-from flask import Flask
+from flask import Flask, Response, request
 from flask_cors import CORS
-from app.config import initialize_config, get_database
-from app.models import (
-    User,
-    UserGenre,
-    Group,
-    GroupUser,
+from app.config import (
+    initialize_config,
+    initialize_recommender_config,
+    get_database,
 )
-from app.routes import user
+from app.routes import user, group, campaign
+from app.cache import initialize_cache
+from app.jobs import DEFAULT_WORKERS as DEFAULT_JOB_WORKERS, initialize_jobs
+from app.migrations import apply_migrations
+from app.auth import initialize_auth
+from app.ratings import initialize_ratings
+from app.recommender.catalog import initialize_catalog
+from app.recommender.factorization import model_version
+from app.recommender.online import initialize_online
+from app.passwords import initialize_passwords
+from app.admission import Overloaded, initialize_admission
+from app.conditional import initialize_conditional
+from app.utils import api_error
+from app.metrics import finish_request, initialize_metrics, render, start_request
 import os
 from dotenv import load_dotenv
 
 
-def create_tables():
-    with get_database() as DB:
-        DB.create_tables(
-            [
-                User,
-                UserGenre,
-                Group,
-                GroupUser,
-            ]
-        )
-
-
 def initialize_settings():
     load_dotenv("settings.env")
 
     host = os.getenv("HOST")
     port = os.getenv("PORT")
     db_path = os.getenv("DB_PATH")
+    model_dir = os.getenv("MODEL_DIR")
+
+    # Waitress threads plus job workers can each hold one connection.
+    threads = int(os.getenv("THREADS", 4))
+    job_workers = os.getenv("JOB_WORKERS")
+    job_workers = int(job_workers) if job_workers else DEFAULT_JOB_WORKERS
+    pool_size = os.getenv("DB_POOL_SIZE")
+    pool_timeout = os.getenv("DB_POOL_TIMEOUT")
+
+    initialize_config(
+        host,
+        port,
+        db_path,
+        model_dir,
+        threads=threads,
+        pool_size=int(pool_size) if pool_size else threads + job_workers,
+        pool_timeout=int(pool_timeout) if pool_timeout else None,
+    )
+
+    deadline_ms = os.getenv("RECOMMENDER_DEADLINE_MS")
+    workers = os.getenv("RECOMMENDER_WORKERS")
+    weights = os.getenv("RECOMMENDER_WEIGHTS")
+
+    initialize_recommender_config(
+        deadline_ms=int(deadline_ms) if deadline_ms else None,
+        workers=int(workers) if workers else None,
+        normalization=os.getenv("RECOMMENDER_NORMALIZATION"),
+        weights=parse_weights(weights) if weights else None,
+        group_strategy=os.getenv("RECOMMENDER_GROUP_STRATEGY"),
+    )
+
+    cache_size = os.getenv("RECOMMENDATION_CACHE_SIZE")
+    cache_ttl = os.getenv("RECOMMENDATION_CACHE_TTL")
 
-    initialize_config(host, port, db_path)
+    initialize_cache(
+        max_entries=int(cache_size) if cache_size else None,
+        ttl=int(cache_ttl) if cache_ttl else None,
+        path=os.getenv("RECOMMENDATION_CACHE_PATH"),
+        # Pre-fork worker processes share their invalidations.
+        shared=os.getenv("WEB_WORKER") is not None,
+    )
+
+    initialize_jobs(job_workers)
+
+    auth_cache_size = os.getenv("AUTH_CACHE_SIZE")
+    auth_cache_ttl = os.getenv("AUTH_CACHE_TTL")
+    initialize_auth(
+        secret_key=os.getenv("SECRET_KEY"),
+        cache_size=int(auth_cache_size) if auth_cache_size else None,
+        cache_ttl=int(auth_cache_ttl) if auth_cache_ttl else None,
+    )
+
+    hash_workers = os.getenv("PASSWORD_HASH_WORKERS")
+    hash_queue = os.getenv("PASSWORD_HASH_QUEUE")
+    initialize_passwords(
+        workers=int(hash_workers) if hash_workers else None,
+        queue_limit=int(hash_queue) if hash_queue else None,
+        method=os.getenv("PASSWORD_HASH_METHOD"),
+    )
+
+    rating_flush_ms = os.getenv("RATING_FLUSH_MS")
+    rating_flush_rows = os.getenv("RATING_FLUSH_ROWS")
+    initialize_ratings(
+        flush_ms=int(rating_flush_ms) if rating_flush_ms else None,
+        flush_rows=int(rating_flush_rows) if rating_flush_rows else None,
+    )
+
+    learning_rate = os.getenv("ONLINE_LEARNING_RATE")
+    compact_interval = os.getenv("ONLINE_COMPACT_INTERVAL")
+    initialize_online(
+        learning_rate=float(learning_rate) if learning_rate else None,
+        compact_interval=int(compact_interval) if compact_interval else None,
+        compaction=os.getenv("ONLINE_COMPACTION", "1") == "1",
+    )
+
+    initialize_catalog(os.getenv("CATALOG_SNAPSHOTS"))
+
+    # By default half the server threads may be computing recommendations;
+    # the rest stay free for cheap requests.
+    concurrency = os.getenv("RECOMMENDATION_CONCURRENCY")
+    admission_wait_ms = os.getenv("ADMISSION_WAIT_MS")
+    retry_after = os.getenv("ADMISSION_RETRY_AFTER")
+    group_weight = os.getenv("ADMISSION_GROUP_WEIGHT")
+    initialize_admission(
+        int(concurrency) if concurrency else max(1, threads // 2),
+        wait_ms=int(admission_wait_ms) if admission_wait_ms else None,
+        retry_after=int(retry_after) if retry_after else None,
+        group_weight=int(group_weight) if group_weight else None,
+    )
+
+    compress_min_bytes = os.getenv("RESPONSE_COMPRESS_MIN_BYTES")
+    encoded_cache_bytes = os.getenv("RESPONSE_CACHE_BYTES")
+    initialize_conditional(
+        min_compress_bytes=int(compress_min_bytes) if compress_min_bytes else None,
+        cache_bytes=int(encoded_cache_bytes) if encoded_cache_bytes else None,
+    )
+
+    slow_request_ms = os.getenv("SLOW_REQUEST_MS")
+    initialize_metrics(
+        int(slow_request_ms) if slow_request_ms else None,
+        worker=os.getenv("WEB_WORKER"),
+    )
+
+
+def parse_weights(value):
+    # "content:1.0,collaborative:0.5" -> {"content": 1.0, "collaborative": 0.5}
+    weights = {}
+    for item in value.split(","):
+        name, weight = item.split(":")
+        weights[name.strip()] = float(weight)
+    return weights
 
 
 def initialize():
     initialize_settings()
-    create_tables()
+    with get_database().connection_context():
+        apply_migrations()
 
 
 def create_app():
@@ -50,23 +159,52 @@ def create_app():
                 "origins": "*",
                 "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
                 "allow_headers": ["Content-Type", "Authorization"],
+                "expose_headers": ["X-Model-Version"],
             }
         },
     )
 
     app.register_blueprint(user.bp)
+    app.register_blueprint(group.bp)
+    app.register_blueprint(campaign.bp)
 
     @app.get("/")
     def get_index():
         return {"message": "This is an API"}
 
+    @app.errorhandler(Overloaded)
+    def overloaded(e):
+        response, status_code = api_error(
+            "Server busy, try again shortly", status_code=503
+        )
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, status_code
+
+    @app.get("/health")
+    def get_health():
+        # Probed by the pre-fork master (app/prefork.py) on each worker's
+        # private port; answering at all means a server thread is free.
+        return {"status": "ok", "pid": os.getpid()}
+
+    @app.get("/metrics")
+    def get_metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
     @app.before_request
     def before_request():
+        start_request()
         get_database().connect(reuse_if_open=True)
 
     @app.after_request
     def after_request(response):
         get_database().close()
+        response.headers["X-Model-Version"] = model_version()
+        # Label by URL rule, not path, so /api/user/1 and /api/user/2 share
+        # a series.
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        finish_request(
+            route, request.method, response.status_code, response.content_length
+        )
         return response
 
     return app
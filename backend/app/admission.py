@@ -0,0 +1,170 @@
+import threading
+import time
+from .metrics import register_gauges
+
+# Seconds clients are told to wait before retrying a shed request.
+DEFAULT_RETRY_AFTER = 1
+# Slots a group or campaign computation takes, against 1 for one user.
+DEFAULT_GROUP_WEIGHT = 2
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__("Server busy")
+        self.retry_after = retry_after or DEFAULT_RETRY_AFTER
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution: the first
+    # caller runs fn, the rest wait for its result (or its exception).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.counters = {"executions": 0, "coalesced": 0}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                self.counters["executions"] += 1
+                leader = True
+            else:
+                self.counters["coalesced"] += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.calls))
+
+
+class Admission:
+    # Holds `weight` slots from the moment it is granted until it is
+    # released, so it can be taken in a request and handed to a job.
+    def __init__(self, controller, weight):
+        self.controller = controller
+        self.weight = weight
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.weight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    # Caps how many expensive computations run at once so they cannot
+    # occupy every server thread; beyond the cap requests are shed
+    # immediately (or after `wait` seconds) rather than queued. Each
+    # computation takes as many slots as its weight.
+    def __init__(self, limit, wait=0, retry_after=None):
+        self.limit = limit
+        self.wait = wait
+        self.retry_after = retry_after
+        self.used = 0
+        self.available = threading.Condition()
+        self.lock = threading.Lock()
+        self.counters = {"admitted": 0, "rejected": 0, "in_flight": 0}
+
+    def count(self, name, delta=1):
+        with self.lock:
+            self.counters[name] += delta
+
+    def acquire(self, weight):
+        deadline = time.monotonic() + self.wait
+        with self.available:
+            while self.used + weight > self.limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.available.wait(remaining)
+            self.used += weight
+            return True
+
+    def release(self, weight):
+        with self.available:
+            self.used -= weight
+            self.available.notify_all()
+        self.count("in_flight", -1)
+
+    def admit(self, weight=1):
+        # A computation heavier than the whole limit still runs, alone.
+        weight = min(weight, self.limit)
+        if not self.acquire(weight):
+            self.count("rejected")
+            raise Overloaded(self.retry_after)
+
+        self.count("admitted")
+        self.count("in_flight")
+        return Admission(self, weight)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        with self.available:
+            return dict(counters, used=self.used, limit=self.limit)
+
+
+_flights = SingleFlight()
+_controller = AdmissionController(limit=2)
+_group_weight = DEFAULT_GROUP_WEIGHT
+
+
+def initialize_admission(limit, wait_ms=None, retry_after=None, group_weight=None):
+    global _controller, _group_weight
+    _controller = AdmissionController(
+        limit, (wait_ms or 0) / 1000, retry_after or DEFAULT_RETRY_AFTER
+    )
+    _group_weight = group_weight or DEFAULT_GROUP_WEIGHT
+
+
+def coalesce(key, fn):
+    return _flights.do(key, fn)
+
+
+def admit(weight=1):
+    return _controller.admit(weight)
+
+
+def admit_group():
+    # Ranking for a group scores every member, so it costs more slots than
+    # one user's recommendations.
+    return _controller.admit(_group_weight)
+
+
+register_gauges("request_coalescing", "Coalesced identical requests", _flights.stats)
+register_gauges(
+    "recommendation_admission",
+    "Concurrent recommendation computations",
+    lambda: _controller.stats(),
+)
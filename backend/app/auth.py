@@ -0,0 +1,207 @@
+import datetime
+import hashlib
+import logging
+import math
+import secrets
+import threading
+import time
+import uuid
+import jwt
+from playhouse.signals import post_delete, post_save
+from .cache import MISSING, TTLCache
+from .metrics import register_gauges
+from .models import RevokedToken, User
+
+TOKEN_LIFETIME = datetime.timedelta(days=7)
+# Decoded tokens and user rows are trusted this long before being
+# re-checked; revocation is still checked on every request.
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 10000
+# The revocation filter pulls rows written by other processes this often.
+REVOCATION_SYNC_INTERVAL = 5
+# ...and is rebuilt without expired tokens this often.
+REVOCATION_REBUILD_INTERVAL = 60 * 60
+BLOOM_CAPACITY = 100000
+BLOOM_ERROR_RATE = 0.01
+
+logger = logging.getLogger(__name__)
+
+_secret_key = None
+_token_cache = TTLCache(DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL)
+_user_cache = TTLCache(DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, name="users")
+_revocations = None
+_revocations_lock = threading.Lock()
+
+
+class BloomFilter:
+    # k bit positions per key from one blake2b digest (double hashing).
+    # No false negatives; false positives at about `error_rate` once
+    # `capacity` keys have been added.
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        bits_per_key = -1.44 * math.log2(error_rate)
+        self.size = max(64, int(capacity * bits_per_key))
+        self.hashes = max(1, round(bits_per_key * 0.693))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+
+class RevocationSet:
+    # The Bloom filter answers "definitely not revoked" for almost every
+    # request without touching the database; a positive is confirmed
+    # against the revokedtoken table.
+    def __init__(self):
+        self.filter = BloomFilter()
+        self.last_id = 0
+        self.synced = 0
+        self.rebuilt = time.time()
+        self.lock = threading.Lock()
+
+    def load(self, bloom, after):
+        # Adds the jtis revoked after row `after`; returns the last row id.
+        for row_id, jti in (
+            RevokedToken.select(RevokedToken.id, RevokedToken.jti)
+            .where(RevokedToken.id > after)
+            .tuples()
+        ):
+            bloom.add(jti)
+            after = max(after, row_id)
+        return after
+
+    def sync(self):
+        now = time.time()
+        if now - self.synced < REVOCATION_SYNC_INTERVAL:
+            return
+        with self.lock:
+            if now - self.synced < REVOCATION_SYNC_INTERVAL:
+                return
+            if now - self.rebuilt >= REVOCATION_REBUILD_INTERVAL:
+                self.rebuild()
+            else:
+                self.last_id = self.load(self.filter, self.last_id)
+            self.synced = now
+
+    def rebuild(self):
+        # Filled completely before it replaces the current filter, which
+        # readers keep using meanwhile without the lock.
+        RevokedToken.delete().where(
+            RevokedToken.expires < datetime.datetime.now()
+        ).execute()
+        bloom = BloomFilter()
+        self.last_id = self.load(bloom, 0)
+        self.filter = bloom
+        self.rebuilt = time.time()
+
+    def add(self, jti, expires):
+        RevokedToken.insert(jti=jti, expires=expires).on_conflict_ignore().execute()
+        with self.lock:
+            self.filter.add(jti)
+
+    def __contains__(self, jti):
+        self.sync()
+        if jti not in self.filter:
+            return False
+        return RevokedToken.select().where(RevokedToken.jti == jti).exists()
+
+
+def initialize_auth(secret_key=None, cache_size=None, cache_ttl=None):
+    global _secret_key, _token_cache, _user_cache
+    if not secret_key:
+        logger.warning("SECRET_KEY is not set; tokens will not survive a restart")
+        secret_key = secrets.token_hex(32)
+    _secret_key = secret_key
+    _token_cache = TTLCache(
+        cache_size or DEFAULT_CACHE_SIZE, cache_ttl or DEFAULT_CACHE_TTL
+    )
+    _user_cache = TTLCache(
+        cache_size or DEFAULT_CACHE_SIZE, cache_ttl or DEFAULT_CACHE_TTL, name="users"
+    )
+    return _secret_key
+
+
+def get_revocations():
+    global _revocations
+    if _revocations is None:
+        with _revocations_lock:
+            if _revocations is None:
+                _revocations = RevocationSet()
+    return _revocations
+
+
+def auth_stats():
+    stats = {f"token_{k}": v for k, v in _token_cache.stats().items()}
+    stats.update({f"user_{k}": v for k, v in _user_cache.stats().items()})
+    return stats
+
+
+register_gauges("auth_cache", "Authentication cache statistics", auth_stats)
+
+
+def issue_token(user_id):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    payload = {
+        "sub": str(user_id),
+        "iat": now,
+        "exp": now + TOKEN_LIFETIME,
+        "jti": uuid.uuid4().hex,
+    }
+    return jwt.encode(payload, _secret_key, algorithm="HS256")
+
+
+def decode_token(token):
+    payload = _token_cache.get(token)
+    if payload is MISSING:
+        try:
+            payload = jwt.decode(token, _secret_key, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            return None
+        _token_cache.set(token, payload)
+    elif payload["exp"] <= time.time():
+        return None
+    return payload
+
+
+def authenticate(token):
+    # Returns (user, payload) or (None, None). In the common case this is
+    # two cache hits and a Bloom filter probe, with no database work.
+    payload = decode_token(token)
+    if payload is None or payload["jti"] in get_revocations():
+        return None, None
+
+    user_id = int(payload["sub"])
+    user = _user_cache.get_or_compute(
+        user_id, lambda: User.get_or_none(User.id == user_id)
+    )
+    if user is None:
+        _user_cache.delete(user_id)
+        return None, None
+    return user, payload
+
+
+def revoke_token(payload):
+    expires = datetime.datetime.fromtimestamp(payload["exp"])
+    get_revocations().add(payload["jti"], expires)
+
+
+@post_save(sender=User)
+def on_user_changed(model_class, instance, created):
+    _user_cache.delete(instance.id)
+
+
+@post_delete(sender=User)
+def on_user_removed(model_class, instance):
+    _user_cache.delete(instance.id)
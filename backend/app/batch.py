@@ -0,0 +1,214 @@
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from peewee import chunked
+from .config import (
+    get_database,
+    get_read_database,
+    initialize_recommender_config,
+)
+from .models import BatchRecommendation, BatchRun, Group, User
+from .recommender.content_filtering import DEFAULT_LIMIT
+from .recommender.factorization import model_version
+from .recommender.hybrid import rank_group, rank_user
+
+CHUNK_SIZE = 500
+INSERT_BATCH_SIZE = 100
+
+# Batch workers have no client waiting on them, so engines are never cut
+# off by the online deadline.
+BATCH_DEADLINE_MS = 10 * 60 * 1000
+
+
+class Precomputed:
+    # One user's or group's rows from the last batch run, best first.
+    def __init__(self, ranked, model_version, generated, stale):
+        self.ranked = ranked
+        self.model_version = model_version
+        self.generated = generated
+        self.stale = stale
+
+
+def load(field, owner_id):
+    rows = list(
+        BatchRecommendation.select(
+            BatchRecommendation.song,
+            BatchRecommendation.score,
+            BatchRecommendation.model_version,
+            BatchRecommendation.generated,
+            BatchRecommendation.stale,
+        )
+        .where(field == owner_id)
+        .order_by(BatchRecommendation.rank)
+        .bind(get_read_database())
+        .tuples()
+    )
+    if not rows:
+        return None
+    _, _, version, generated, _ = rows[0]
+    return Precomputed(
+        [(song_id, score) for song_id, score, _, _, _ in rows],
+        version,
+        generated,
+        any(stale for _, _, _, _, stale in rows),
+    )
+
+
+def load_user(user_id):
+    return load(BatchRecommendation.user, user_id)
+
+
+def load_group(group_id):
+    return load(BatchRecommendation.group, group_id)
+
+
+# Changed inputs only mark the rows stale: they are still served when
+# there is no capacity to compute fresh results, and the next run
+# (refresh_recommendations.py --stale) rebuilds them.
+
+
+def mark_user_stale(user_id):
+    BatchRecommendation.update(stale=True).where(
+        (BatchRecommendation.user == user_id) & ~BatchRecommendation.stale
+    ).execute()
+
+
+def mark_group_stale(group_id):
+    BatchRecommendation.update(stale=True).where(
+        (BatchRecommendation.group == group_id) & ~BatchRecommendation.stale
+    ).execute()
+
+
+def initialize_worker():
+    # Runs once in every pool process: the worker reads settings.env and
+    # builds its own models on first use.
+    from . import initialize_settings
+
+    initialize_settings()
+    initialize_recommender_config(deadline_ms=BATCH_DEADLINE_MS)
+
+
+def compute_users(user_ids, limit):
+    rows = []
+    with get_database().connection_context():
+        for user in User.select().where(User.id.in_(user_ids)):
+            for position, (song_id, score) in enumerate(rank_user(user, limit)):
+                rows.append((user.id, None, song_id, score, position + 1))
+    return rows
+
+
+def compute_groups(group_ids, limit):
+    rows = []
+    with get_database().connection_context():
+        for group in Group.select().where(Group.id.in_(group_ids)):
+            for position, (song_id, score) in enumerate(rank_group(group, limit)):
+                rows.append((None, group.id, song_id, score, position + 1))
+    return rows
+
+
+def write_chunk(run, field, ids, rows):
+    generated = datetime.datetime.now()
+    with get_database().atomic():
+        BatchRecommendation.delete().where(field.in_(ids)).execute()
+        for batch in chunked(rows, INSERT_BATCH_SIZE):
+            BatchRecommendation.insert_many(
+                [
+                    {
+                        "user": user_id,
+                        "group": group_id,
+                        "song": song_id,
+                        "score": score,
+                        "rank": position,
+                        "model_version": run.model_version,
+                        "generated": generated,
+                    }
+                    for user_id, group_id, song_id, score, position in batch
+                ]
+            ).execute()
+
+        if field is BatchRecommendation.user:
+            run.last_user_id = max(ids)
+        else:
+            run.last_group_id = max(ids)
+        run.save()
+
+
+def pending_ids(model, after):
+    query = model.select(model.id).where(model.id > after).order_by(model.id).tuples()
+    return [row_id for (row_id,) in query]
+
+
+def stale_ids(field, after):
+    query = (
+        BatchRecommendation.select(field)
+        .distinct()
+        .where(BatchRecommendation.stale & (field > after))
+        .order_by(field)
+        .tuples()
+    )
+    return [row_id for (row_id,) in query]
+
+
+def refresh(executor, run, model, field, compute, after, stale=False):
+    ids = stale_ids(field, after) if stale else pending_ids(model, after)
+    chunks = list(chunked(ids, CHUNK_SIZE))
+    futures = [executor.submit(compute, chunk, run.limit) for chunk in chunks]
+
+    # Chunks are written strictly in id order so the checkpoint always
+    # marks a prefix of completed work.
+    for done, (chunk, future) in enumerate(zip(chunks, futures), start=1):
+        write_chunk(run, field, chunk, future.result())
+        print(f"{model.__name__}: {done}/{len(chunks)} chunks written")
+
+
+def start_run(limit=DEFAULT_LIMIT, resume=False):
+    if resume:
+        run = (
+            BatchRun.select()
+            .where(BatchRun.finished.is_null())
+            .order_by(BatchRun.id.desc())
+            .first()
+        )
+        if run is not None:
+            print(
+                f"Resuming run {run.id} after user {run.last_user_id}, "
+                f"group {run.last_group_id}"
+            )
+            return run
+
+    return BatchRun.create(
+        model_version=model_version(),
+        limit=limit,
+        started=datetime.datetime.now(),
+    )
+
+
+def run_batch(limit=DEFAULT_LIMIT, workers=None, resume=False, stale=False):
+    # stale=True rebuilds only the users and groups whose rows were marked
+    # stale since they were generated.
+    run = start_run(limit, resume)
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initialize_worker
+    ) as executor:
+        refresh(
+            executor,
+            run,
+            User,
+            BatchRecommendation.user,
+            compute_users,
+            run.last_user_id,
+            stale,
+        )
+        refresh(
+            executor,
+            run,
+            Group,
+            BatchRecommendation.group,
+            compute_groups,
+            run.last_group_id,
+            stale,
+        )
+
+    run.finished = datetime.datetime.now()
+    run.save()
+    return run
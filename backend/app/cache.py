@@ -0,0 +1,361 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from peewee import fn
+from playhouse.signals import post_delete, post_save, pre_save
+from .admission import SingleFlight
+from .batch import mark_group_stale, mark_user_stale
+from .config import get_read_database
+from .metrics import register_gauges
+from .models import (
+    CacheInvalidation,
+    CampaignRecommendationRating,
+    GroupUser,
+    User,
+    UserGenre,
+)
+from .recommender.aggregation import STRATEGIES
+from .recommender.factorization import model_version
+
+MISSING = object()
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 15 * 60
+# Seconds between checks for invalidations made by other worker processes.
+INVALIDATION_POLL_INTERVAL = 1
+
+_recommendation_cache = None
+# Set in worker processes of a pre-fork server, see InvalidationLog.
+_shared = False
+
+
+class SqliteStore:
+    # Optional second tier so a restarted process does not start cold.
+    # Values are stored as JSON with their absolute expiry time.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=wal")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "DELETE FROM cache WHERE expires < ?", (time.time(),)
+            )
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expires FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return MISSING, None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expires):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires),
+            )
+
+    def delete(self, key):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM cache")
+
+
+class InvalidationLog:
+    # Each worker process caches on its own, so deletions are also written
+    # to the database and replayed, within INVALIDATION_POLL_INTERVAL, by
+    # the same cache in the other workers.
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self.last_id = None
+        self.checked = 0.0
+        self.pruned = 0.0
+        self.lock = threading.Lock()
+
+    def publish(self, key):
+        if not _shared:
+            return
+        now = datetime.datetime.now()
+        CacheInvalidation.insert(
+            cache=self.name, key=json.dumps(key), origin=os.getpid(), created=now
+        ).execute()
+        if time.monotonic() - self.pruned >= self.ttl:
+            # Entries cached before these rows have expired by now.
+            self.pruned = time.monotonic()
+            CacheInvalidation.delete().where(
+                (CacheInvalidation.created < now - datetime.timedelta(seconds=self.ttl))
+                & (CacheInvalidation.cache == self.name)
+            ).execute()
+
+    def poll(self, cache):
+        if not _shared or time.monotonic() - self.checked < INVALIDATION_POLL_INTERVAL:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.checked = time.monotonic()
+            if self.last_id is None:
+                self.last_id = (
+                    CacheInvalidation.select(fn.MAX(CacheInvalidation.id))
+                    .bind(get_read_database())
+                    .scalar()
+                    or 0
+                )
+                return
+            rows = list(
+                CacheInvalidation.select(CacheInvalidation.id, CacheInvalidation.key)
+                .where(
+                    (CacheInvalidation.id > self.last_id)
+                    & (CacheInvalidation.cache == self.name)
+                    & (CacheInvalidation.origin != os.getpid())
+                )
+                .order_by(CacheInvalidation.id)
+                .bind(get_read_database())
+                .tuples()
+            )
+            for row_id, key in rows:
+                cache.forget(json.loads(key))
+                self.last_id = row_id
+        finally:
+            self.lock.release()
+
+
+class TTLCache:
+    def __init__(
+        self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, store=None, name=None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        # Named caches share their invalidations between worker processes.
+        self.log = InvalidationLog(name, ttl) if name else None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Misses on the same key wait for one computation instead of each
+        # running their own.
+        self.flights = SingleFlight()
+        # Bumped on every invalidation so a computation that started before
+        # the invalidation cannot store its stale result afterwards.
+        self.generations = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "disk_hits": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def generation(self, key):
+        with self.lock:
+            return self.generations.get(key, 0)
+
+    def get(self, key):
+        if self.log is not None:
+            self.log.poll(self)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > now:
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return value
+
+                del self.entries[key]
+                self.counters["expirations"] += 1
+
+        if self.store is not None:
+            value, expires = self.store.get(key)
+            if value is not MISSING:
+                with self.lock:
+                    self.counters["disk_hits"] += 1
+                    self._insert(key, value, expires)
+                return value
+
+        with self.lock:
+            self.counters["misses"] += 1
+        return MISSING
+
+    def set(self, key, value, generation=None):
+        expires = time.time() + self.ttl
+        with self.lock:
+            if generation is not None and generation != self.generations.get(key, 0):
+                return False
+            self._insert(key, value, expires)
+
+        if self.store is not None:
+            self.store.set(key, value, expires)
+        return True
+
+    def _insert(self, key, value, expires):
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        def load():
+            generation = self.generation(key)
+            value = compute()
+            self.set(key, value, generation)
+            return value
+
+        return self.flights.do(key, load)
+
+    def delete(self, key, publish=True):
+        self.forget(key)
+        if self.store is not None:
+            self.store.delete(key)
+        if publish and self.log is not None:
+            self.log.publish(key)
+
+    def forget(self, key):
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+            self.entries.pop(key, None)
+            self.counters["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            for key in self.entries:
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.entries.clear()
+
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self):
+        flights = self.flights.stats()
+        with self.lock:
+            return dict(
+                self.counters,
+                entries=len(self.entries),
+                coalesced=flights["coalesced"],
+            )
+
+
+def initialize_cache(max_entries=None, ttl=None, path=None, shared=False):
+    global _recommendation_cache, _shared
+    _shared = shared
+    _recommendation_cache = TTLCache(
+        max_entries=max_entries or DEFAULT_MAX_ENTRIES,
+        ttl=ttl or DEFAULT_TTL,
+        store=SqliteStore(path) if path else None,
+        name="recommendations",
+    )
+    return _recommendation_cache
+
+
+def get_recommendation_cache():
+    if _recommendation_cache is None:
+        initialize_cache()
+    return _recommendation_cache
+
+
+register_gauges(
+    "recommendation_cache",
+    "Recommendation cache statistics",
+    lambda: get_recommendation_cache().stats(),
+)
+
+
+# Keys include the served model version: after a swap or rollback the
+# entries computed by the previous model are no longer found and expire.
+def user_key(user_id):
+    return f"user:{model_version()}:{user_id}"
+
+
+def group_key(group_id, strategy=None):
+    return f"group:{model_version()}:{group_id}:{strategy or 'default'}"
+
+
+def invalidate_group(group_id, publish=True):
+    cache = get_recommendation_cache()
+    for strategy in (None,) + STRATEGIES:
+        cache.delete(group_key(group_id, strategy), publish)
+
+    # Precomputed batch rows were built from the same, now stale, inputs.
+    if publish:
+        mark_group_stale(group_id)
+
+
+def invalidate_user(user_id, publish=True):
+    # publish=False drops this process's entries only, for changes every
+    # worker process sees and invalidates for itself; the batch rows were
+    # marked stale when the change was written.
+    cache = get_recommendation_cache()
+    cache.delete(user_key(user_id), publish)
+    if publish:
+        mark_user_stale(user_id)
+
+    # Group recommendations are built from every member's profile.
+    for (group_id,) in (
+        GroupUser.select(GroupUser.group).where(GroupUser.user == user_id).tuples()
+    ):
+        invalidate_group(group_id, publish)
+
+
+# Model signals only fire for save()/delete_instance(); bulk queries that
+# touch these tables must invalidate explicitly.
+
+
+@pre_save(sender=User)
+def on_user_pre_save(model_class, instance, created):
+    dirty = {field.name for field in instance.dirty_fields}
+    instance._profile_changed = not created and bool(
+        dirty & {"instrument", "proficiency"}
+    )
+
+
+@post_save(sender=User)
+def on_user_saved(model_class, instance, created):
+    if getattr(instance, "_profile_changed", False):
+        invalidate_user(instance.id)
+
+
+@post_delete(sender=User)
+def on_user_deleted(model_class, instance):
+    invalidate_user(instance.id)
+
+
+@post_save(sender=UserGenre)
+@post_delete(sender=UserGenre)
+def on_user_genre_changed(model_class, instance, created=False):
+    invalidate_user(instance.user_id)
+
+
+@post_save(sender=GroupUser)
+@post_delete(sender=GroupUser)
+def on_group_user_changed(model_class, instance, created=False):
+    invalidate_group(instance.group_id)
+    get_recommendation_cache().delete(user_key(instance.user_id))
+
+
+@post_save(sender=CampaignRecommendationRating)
+def on_rating_saved(model_class, instance, created):
+    invalidate_user(instance.user_id)
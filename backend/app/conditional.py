@@ -0,0 +1,111 @@
+import gzip
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from functools import wraps
+from flask import make_response, request
+from .metrics import register_gauges
+
+# Smaller bodies are sent as is; compressing them saves less than the
+# Content-Encoding header costs.
+DEFAULT_MIN_COMPRESS_BYTES = 1024
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+ENCODINGS = {
+    "gzip": lambda body: gzip.compress(body, compresslevel=6, mtime=0),
+    "deflate": lambda body: zlib.compress(body, 6),
+}
+
+
+class EncodedCache:
+    # Compressed bodies keyed by (etag, encoding), evicted least recently
+    # used once they add up to max_bytes. An unchanged payload is
+    # compressed once, however often it is refetched.
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "not_modified": 0,
+            "compressed": 0,
+        }
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_or_encode(self, etag, encoding, body):
+        key = (etag, encoding)
+        with self.lock:
+            encoded = self.entries.get(key)
+            if encoded is not None:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return encoded
+            self.counters["misses"] += 1
+
+        encoded = ENCODINGS[encoding](body)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = encoded
+                self.size += len(encoded)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.counters["evictions"] += 1
+        return encoded
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.size)
+
+
+_min_compress_bytes = DEFAULT_MIN_COMPRESS_BYTES
+_cache = EncodedCache()
+
+
+def initialize_conditional(min_compress_bytes=None, cache_bytes=None):
+    global _min_compress_bytes, _cache
+    _min_compress_bytes = min_compress_bytes or DEFAULT_MIN_COMPRESS_BYTES
+    _cache = EncodedCache(cache_bytes or DEFAULT_CACHE_BYTES)
+
+
+register_gauges(
+    "response_encoding", "Conditional and compressed responses", lambda: _cache.stats()
+)
+
+
+def conditional(f):
+    # For JSON GETs: tags the body with a content-derived ETag, answers a
+    # matching If-None-Match with 304 and compresses larger bodies. The
+    # browser's HTTP cache revalidates with If-None-Match on its own, so
+    # clients need no changes to benefit.
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        response = make_response(f(*args, **kwargs))
+        if response.status_code != 200 or response.is_streamed:
+            return response
+
+        body = response.get_data()
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        # Weak: the tag names the JSON, whichever encoding carries it.
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Accept-Encoding")
+
+        if request.if_none_match.contains_weak(etag):
+            _cache.count("not_modified")
+            return response.make_conditional(request)
+
+        encoding = request.accept_encodings.best_match(list(ENCODINGS))
+        if encoding and len(body) >= _min_compress_bytes:
+            response.set_data(_cache.get_or_encode(etag, encoding, body))
+            response.headers["Content-Encoding"] = encoding
+            _cache.count("compressed")
+        return response
+
+    return decorated
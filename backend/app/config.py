@@ -1,27 +1,79 @@
-from peewee import SqliteDatabase
 from peewee import DatabaseProxy
+from .metrics import (
+    InstrumentedPooledSqliteDatabase,
+    InstrumentedSqliteDatabase,
+    register_gauges,
+)
 
 HOST = None
 PORT = None
+MODEL_DIR = None
+THREADS = 4
+# Seconds a request waits for a pooled connection before failing.
+DEFAULT_POOL_TIMEOUT = 10
 DB = DatabaseProxy()
+# Query-only connections for the recommender's bulk reads.
+READ_DB = DatabaseProxy()
 
+PRAGMAS = {
+    "journal_mode": "wal",
+    "cache_size": -1 * 64000,
+    "foreign_keys": 1,
+    "ignore_check_constraints": 0,
+    "synchronous": 0,
+}
+# journal_mode is persistent in the file, so read connections leave it
+# alone; query_only makes any accidental write fail loudly.
+READ_PRAGMAS = {
+    "query_only": 1,
+    "cache_size": -1 * 64000,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+}
 
-def initialize_config(host, port, db_path):
-    global HOST, PORT, DB
+RECOMMENDER = {
+    "deadline_ms": 300,
+    "workers": 8,
+    "normalization": "minmax",
+    "group_strategy": "average",
+    "weights": {"content": 1.0, "collaborative": 1.0, "factorization": 1.0},
+}
+
+
+def initialize_config(
+    host,
+    port,
+    db_path,
+    model_dir=None,
+    threads=None,
+    pool_size=None,
+    pool_timeout=None,
+):
+    global HOST, PORT, MODEL_DIR, THREADS, DB
     HOST = host
     PORT = port
-    DB.initialize(
-        SqliteDatabase(
+    MODEL_DIR = model_dir or "models"
+    THREADS = threads or THREADS
+
+    if pool_size:
+        # Pragmas run once per pooled connection instead of once per request.
+        database = InstrumentedPooledSqliteDatabase(
             db_path,
-            pragmas={
-                "journal_mode": "wal",
-                "cache_size": -1 * 64000,
-                "foreign_keys": 1,
-                "ignore_check_constraints": 0,
-                "synchronous": 0,
-            },
+            max_connections=pool_size,
+            timeout=pool_timeout or DEFAULT_POOL_TIMEOUT,
+            pragmas=PRAGMAS,
+            # A connection is used by one thread at a time, but not always
+            # the thread that opened it.
+            check_same_thread=False,
         )
-    )
+        register_gauges("db_pool", "Database connection pool", database.pool_stats)
+    else:
+        database = InstrumentedSqliteDatabase(db_path, pragmas=PRAGMAS)
+    DB.initialize(database)
+
+    # Thread-affine: each engine/request thread keeps its own read
+    # connection open, so it is set up once per thread.
+    READ_DB.initialize(InstrumentedSqliteDatabase(db_path, pragmas=READ_PRAGMAS))
 
 
 def get_host():
@@ -32,5 +84,51 @@ def get_port():
     return PORT
 
 
+def get_threads():
+    return THREADS
+
+
+def get_model_dir():
+    return MODEL_DIR
+
+
+def initialize_recommender_config(
+    deadline_ms=None,
+    workers=None,
+    normalization=None,
+    weights=None,
+    group_strategy=None,
+):
+    settings = {
+        "deadline_ms": deadline_ms,
+        "workers": workers,
+        "normalization": normalization,
+        "weights": weights,
+        "group_strategy": group_strategy,
+    }
+    RECOMMENDER.update({k: v for k, v in settings.items() if v is not None})
+
+
+def get_recommender_config():
+    return RECOMMENDER
+
+
 def get_database():
     return DB
+
+
+def get_read_database():
+    return READ_DB
+
+
+def close_connections():
+    # Called before forking worker processes: an SQLite connection must
+    # not be carried across fork(), so none may be left open, pooled or
+    # idle.
+    database = DB.obj
+    if hasattr(database, "close_all"):
+        database.close_all()
+    elif not database.is_closed():
+        database.close()
+    if not READ_DB.obj.is_closed():
+        READ_DB.obj.close()
@@ -0,0 +1,104 @@
+import atexit
+import datetime
+import json
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .config import get_database
+from .models import Job
+
+DEFAULT_WORKERS = 2
+# Finished jobs are kept this long so clients can still poll their status.
+JOB_RETENTION = datetime.timedelta(hours=1)
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_workers = DEFAULT_WORKERS
+
+
+def to_dict(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "created": job.created.isoformat(),
+        "started": job.started.isoformat() if job.started else None,
+        "finished": job.finished.isoformat() if job.finished else None,
+        "result": json.loads(job.result) if job.result is not None else None,
+        "error": job.error,
+    }
+
+
+def initialize_jobs(workers=None):
+    global _workers
+    _workers = workers or DEFAULT_WORKERS
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=_workers, thread_name_prefix="jobs"
+                )
+    return _executor
+
+
+def shutdown_jobs():
+    # Lets queued and running jobs finish, so none is left "running" in
+    # the table by a process that exits.
+    with _executor_lock:
+        executor = _executor
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _prune(now):
+    Job.delete().where(Job.finished < now - JOB_RETENTION).execute()
+
+
+def _update(job_id, **fields):
+    Job.update(**fields).where(Job.id == job_id).execute()
+
+
+def _run(job_id, kind, fn, args):
+    # Worker threads get their own connection, released when done.
+    with get_database().connection_context():
+        _update(job_id, status="running", started=datetime.datetime.now())
+        try:
+            result = fn(*args)
+        except Exception as e:
+            logger.exception("Job %s (%s) failed", job_id, kind)
+            _update(
+                job_id,
+                status="failed",
+                error=str(e),
+                finished=datetime.datetime.now(),
+            )
+        else:
+            _update(
+                job_id,
+                status="succeeded",
+                result=json.dumps(result),
+                finished=datetime.datetime.now(),
+            )
+
+
+def submit(kind, fn, *args):
+    now = datetime.datetime.now()
+    _prune(now)
+    job = Job.create(id=uuid.uuid4().hex, kind=kind, status="queued", created=now)
+    get_executor().submit(_run, job.id, kind, fn, args)
+    return job
+
+
+def get_job(job_id):
+    # Any worker process can answer for a job another one runs.
+    return Job.get_or_none(Job.id == job_id)
+
+
+atexit.register(shutdown_jobs)
@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from peewee import SqliteDatabase
+from playhouse.pool import PooledSqliteDatabase
+
+# Upper bounds of the histogram buckets; +Inf is implied.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+DEFAULT_SLOW_REQUEST_MS = 500
+# Queries kept per request for the slow-request log.
+MAX_LOGGED_QUERIES = 50
+
+logger = logging.getLogger(__name__)
+
+_slow_request_ms = DEFAULT_SLOW_REQUEST_MS
+# Added to every series; names the pre-fork worker process reporting.
+_labels = ()
+_metrics = {}
+_gauges = {}
+_metrics_lock = threading.Lock()
+_request = threading.local()
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels tuple -> [bucket counts..., sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                labels = format_labels(_labels + key + (("le", str(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(_labels + key)
+            lines.append(f"{self.name}_sum{labels} {values[-2]}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+def format_labels(items):
+    if not items:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in items
+    )
+    return "{" + pairs + "}"
+
+
+def histogram(name, help, buckets=DURATION_BUCKETS):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = Histogram(name, help, buckets)
+        return metric
+
+
+def register_gauges(prefix, help, collect):
+    # collect() returns {name: value}; each becomes a <prefix>_<name> gauge
+    # read at scrape time.
+    with _metrics_lock:
+        _gauges[prefix] = (help, collect)
+
+
+request_duration = histogram(
+    "http_request_duration_seconds", "Wall time spent handling a request"
+)
+request_queries = histogram(
+    "http_request_sql_queries", "SQL statements executed per request", COUNT_BUCKETS
+)
+request_sql_duration = histogram(
+    "http_request_sql_duration_seconds", "Time spent in SQL per request"
+)
+response_size = histogram(
+    "http_response_size_bytes", "Size of response bodies", SIZE_BUCKETS
+)
+query_duration = histogram("sql_query_duration_seconds", "Duration of SQL statements")
+pool_wait = histogram(
+    "db_pool_wait_seconds", "Time spent waiting to check out a pooled connection"
+)
+pool_checkout = histogram(
+    "db_pool_checkout_seconds", "Time a pooled connection stayed checked out"
+)
+
+
+def initialize_metrics(slow_request_ms=None, worker=None):
+    global _slow_request_ms, _labels
+    _slow_request_ms = slow_request_ms or DEFAULT_SLOW_REQUEST_MS
+    # Each worker process keeps and reports its own metrics only.
+    _labels = (("worker", worker),) if worker is not None else ()
+
+
+class QueryTimingMixin:
+    # Times every statement and, inside a request, adds it to that
+    # request's query list. Queries run on engine or job threads are only
+    # counted in sql_query_duration_seconds.
+    def execute_sql(self, sql, params=None, commit=None):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params)
+        finally:
+            elapsed = time.perf_counter() - started
+            query_duration.observe(elapsed)
+
+            queries = getattr(_request, "queries", None)
+            if queries is not None:
+                queries.append((sql, elapsed))
+
+
+class InstrumentedSqliteDatabase(QueryTimingMixin, SqliteDatabase):
+    pass
+
+
+class InstrumentedPooledSqliteDatabase(QueryTimingMixin, PooledSqliteDatabase):
+    def connect(self, reuse_if_open=False):
+        if not self.is_closed():
+            return super().connect(reuse_if_open)
+
+        # Includes the pool's sleep-and-retry loop while it is exhausted.
+        started = time.perf_counter()
+        try:
+            return super().connect(reuse_if_open)
+        finally:
+            pool_wait.observe(time.perf_counter() - started)
+
+    def _close(self, conn, close_conn=False):
+        pooled = self._in_use.get(self.conn_key(conn))
+        if pooled is not None and not close_conn:
+            pool_checkout.observe(time.time() - pooled.checked_out)
+        super()._close(conn, close_conn)
+
+    def pool_stats(self):
+        return {
+            "in_use": len(self._in_use),
+            "idle": len(self._connections),
+            "max": self._max_connections,
+        }
+
+
+def start_request():
+    _request.started = time.perf_counter()
+    _request.queries = []
+
+
+def finish_request(route, method, status, size):
+    started = getattr(_request, "started", None)
+    queries = getattr(_request, "queries", None)
+    _request.started = _request.queries = None
+    if started is None:
+        return
+
+    elapsed = time.perf_counter() - started
+    sql_time = sum(duration for _, duration in queries)
+
+    request_duration.observe(elapsed, route=route, method=method, status=status)
+    request_queries.observe(len(queries), route=route, method=method)
+    request_sql_duration.observe(sql_time, route=route, method=method)
+    if size is not None:
+        response_size.observe(size, route=route, method=method)
+
+    if elapsed * 1000 >= _slow_request_ms:
+        logger.warning(
+            "Slow request %s %s: %.0fms, %d queries in %.0fms\n%s",
+            method,
+            route,
+            elapsed * 1000,
+            len(queries),
+            sql_time * 1000,
+            "\n".join(
+                f"  {duration * 1000:8.2f}ms  {sql}"
+                for sql, duration in queries[:MAX_LOGGED_QUERIES]
+            ),
+        )
+
+
+def render():
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+        gauges = dict(_gauges)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for prefix, (help, collect) in sorted(gauges.items()):
+        for name, value in sorted(collect().items()):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name}{format_labels(_labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,30 +1,22 @@
 from functools import wraps
-from flask import request, jsonify, g
-from .utils import validate_jwt_token
-from .models import User
+from flask import request, g
+from .auth import authenticate
+from .utils import api_error
 
 
 def auth_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        header = request.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return api_error("Missing or invalid authentication token", status_code=401)
 
-        # token = request.headers.get("Authorization")
-
-        # if not token or not token.startswith("Bearer "):
-        #     return jsonify({"error": "Missing or invalid authentication token"}), 401
-
-        # token = token.split("Bearer ")[1]
-        # user_id = validate_jwt_token(token)
-
-        # if not user_id:
-        #     return jsonify({"error": "Invalid or expired token"}), 401
-
-        # try:
-        #     user = User.get(User.id == user_id)
-        #     g.user = user
-        # except:
-        #     return jsonify({"error": "User not found"}), 401
+        user, payload = authenticate(header[len("Bearer ") :])
+        if user is None:
+            return api_error("Invalid or expired token", status_code=401)
 
+        g.user = user
+        g.token = payload
         return f(*args, **kwargs)
 
     return decorated
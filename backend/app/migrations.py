@@ -0,0 +1,471 @@
+import datetime
+from peewee import IntegerField
+from playhouse.migrate import SqliteMigrator, migrate
+from .config import get_database
+from .models import SchemaVersion
+
+# The DDL of released migrations is written out rather than derived from
+# the models, so later model changes cannot alter what an old version
+# creates; they need a migration of their own.
+INITIAL_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS "user" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "email" VARCHAR(255) NOT NULL,
+        "password" VARCHAR(255) NOT NULL,
+        "created" DATETIME NOT NULL,
+        "instrument" INTEGER NOT NULL,
+        "proficiency" INTEGER NOT NULL
+    )
+    """,
+    'CREATE UNIQUE INDEX IF NOT EXISTS "user_email" ON "user" ("email")',
+    """
+    CREATE TABLE IF NOT EXISTS "usergenre" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "user_id" INTEGER NOT NULL,
+        "genre" INTEGER NOT NULL,
+        FOREIGN KEY ("user_id") REFERENCES "user" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "usergenre_user_id" ON "usergenre" ("user_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "usergenre_user_id_genre" ON "usergenre" ("user_id", "genre")',
+    """
+    CREATE TABLE IF NOT EXISTS "group" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "name" VARCHAR(255) NOT NULL,
+        "created" DATETIME NOT NULL,
+        "admin_user_id" INTEGER NOT NULL,
+        "description" TEXT NOT NULL,
+        "invite_code" VARCHAR(255) NOT NULL,
+        FOREIGN KEY ("admin_user_id") REFERENCES "user" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "group_admin_user_id" ON "group" ("admin_user_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "group_invite_code" ON "group" ("invite_code")',
+    """
+    CREATE TABLE IF NOT EXISTS "groupuser" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "group_id" INTEGER NOT NULL,
+        "user_id" INTEGER NOT NULL,
+        "joined" DATETIME NOT NULL,
+        FOREIGN KEY ("group_id") REFERENCES "group" ("id"),
+        FOREIGN KEY ("user_id") REFERENCES "user" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "groupuser_group_id" ON "groupuser" ("group_id")',
+    'CREATE INDEX IF NOT EXISTS "groupuser_user_id" ON "groupuser" ("user_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "artist" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "name" VARCHAR(255) NOT NULL,
+        "genre" INTEGER NOT NULL
+    )
+    """,
+    'CREATE UNIQUE INDEX IF NOT EXISTS "artist_name" ON "artist" ("name")',
+    """
+    CREATE TABLE IF NOT EXISTS "album" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "name" VARCHAR(255) NOT NULL,
+        "artist_id" INTEGER NOT NULL,
+        FOREIGN KEY ("artist_id") REFERENCES "artist" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "album_artist_id" ON "album" ("artist_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "song" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "name" VARCHAR(255) NOT NULL,
+        "album_id" INTEGER NOT NULL,
+        FOREIGN KEY ("album_id") REFERENCES "album" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "song_album_id" ON "song" ("album_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "songinstrumentproficiency" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "song_id" INTEGER NOT NULL,
+        "instrument" INTEGER NOT NULL,
+        "proficiency" INTEGER NOT NULL,
+        FOREIGN KEY ("song_id") REFERENCES "song" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "songinstrumentproficiency_song_id" ON "songinstrumentproficiency" ("song_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "campaign" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "name" VARCHAR(255) NOT NULL,
+        "created_date" DATETIME NOT NULL,
+        "due_date" DATETIME NOT NULL,
+        "group_id" INTEGER NOT NULL,
+        FOREIGN KEY ("group_id") REFERENCES "group" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "campaign_group_id" ON "campaign" ("group_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "campaignrecommendation" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "campaign_id" INTEGER NOT NULL,
+        "song_id" INTEGER NOT NULL,
+        FOREIGN KEY ("campaign_id") REFERENCES "campaign" ("id"),
+        FOREIGN KEY ("song_id") REFERENCES "song" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "campaignrecommendation_campaign_id" ON "campaignrecommendation" ("campaign_id")',
+    'CREATE INDEX IF NOT EXISTS "campaignrecommendation_song_id" ON "campaignrecommendation" ("song_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "campaignrecommendation_campaign_id_song_id" ON "campaignrecommendation" ("campaign_id", "song_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "campaignrecommendationrating" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "campaign_recommendation_id" INTEGER NOT NULL,
+        "user_id" INTEGER NOT NULL,
+        "rating" INTEGER NOT NULL,
+        FOREIGN KEY ("campaign_recommendation_id") REFERENCES "campaignrecommendation" ("id"),
+        FOREIGN KEY ("user_id") REFERENCES "user" ("id")
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "campaignrecommendationrating_campaign_recommendation_id" ON "campaignrecommendationrating" ("campaign_recommendation_id")',
+    'CREATE INDEX IF NOT EXISTS "campaignrecommendationrating_user_id" ON "campaignrecommendationrating" ("user_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "campaignrecommendationrating_campaign_recommendation_id_user_id" ON "campaignrecommendationrating" ("campaign_recommendation_id", "user_id")',
+    """
+    CREATE TABLE IF NOT EXISTS "batchrecommendation" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "user_id" INTEGER,
+        "group_id" INTEGER,
+        "song_id" INTEGER NOT NULL,
+        "score" REAL NOT NULL,
+        "rank" INTEGER NOT NULL,
+        "model_version" VARCHAR(255) NOT NULL,
+        "generated" DATETIME NOT NULL,
+        FOREIGN KEY ("user_id") REFERENCES "user" ("id") ON DELETE CASCADE,
+        FOREIGN KEY ("group_id") REFERENCES "group" ("id") ON DELETE CASCADE,
+        FOREIGN KEY ("song_id") REFERENCES "song" ("id") ON DELETE CASCADE
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "batchrecommendation_user_id" ON "batchrecommendation" ("user_id")',
+    'CREATE INDEX IF NOT EXISTS "batchrecommendation_group_id" ON "batchrecommendation" ("group_id")',
+    'CREATE INDEX IF NOT EXISTS "batchrecommendation_song_id" ON "batchrecommendation" ("song_id")',
+    'CREATE INDEX IF NOT EXISTS "batchrecommendation_user_id_rank" ON "batchrecommendation" ("user_id", "rank")',
+    'CREATE INDEX IF NOT EXISTS "batchrecommendation_group_id_rank" ON "batchrecommendation" ("group_id", "rank")',
+    """
+    CREATE TABLE IF NOT EXISTS "batchrun" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "model_version" VARCHAR(255) NOT NULL,
+        "limit" INTEGER NOT NULL,
+        "started" DATETIME NOT NULL,
+        "finished" DATETIME,
+        "last_user_id" INTEGER NOT NULL,
+        "last_group_id" INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS "schemaversion" (
+        "version" INTEGER NOT NULL PRIMARY KEY,
+        "name" VARCHAR(255) NOT NULL,
+        "applied" DATETIME NOT NULL
+    )
+    """,
+]
+REVOKED_TOKENS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS "revokedtoken" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "jti" VARCHAR(255) NOT NULL,
+        "expires" DATETIME NOT NULL
+    )
+    """,
+    'CREATE UNIQUE INDEX IF NOT EXISTS "revokedtoken_jti" ON "revokedtoken" ("jti")',
+    'CREATE INDEX IF NOT EXISTS "revokedtoken_expires" ON "revokedtoken" ("expires")',
+]
+
+JOBS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS "job" (
+        "id" VARCHAR(255) NOT NULL PRIMARY KEY,
+        "kind" VARCHAR(255) NOT NULL,
+        "status" VARCHAR(255) NOT NULL,
+        "created" DATETIME NOT NULL,
+        "started" DATETIME,
+        "finished" DATETIME,
+        "result" TEXT,
+        "error" TEXT
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "job_finished" ON "job" ("finished")',
+]
+
+CACHE_INVALIDATIONS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS "cacheinvalidation" (
+        "id" INTEGER NOT NULL PRIMARY KEY,
+        "cache" VARCHAR(255) NOT NULL,
+        "key" TEXT NOT NULL,
+        "origin" INTEGER NOT NULL,
+        "created" DATETIME NOT NULL
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS "cacheinvalidation_created" ON "cacheinvalidation" ("created")',
+]
+BATCH_STALENESS_SCHEMA = [
+    'ALTER TABLE "batchrecommendation" ADD COLUMN "stale" INTEGER NOT NULL DEFAULT 0',
+]
+
+
+# Hot queries each migration is responsible for, written out like the
+# DDL above: a released migration checks the queries as they were when
+# it shipped, whatever the models look like later.
+HOT_PATH_CHECKS = [
+    (
+        "songs by instrument level",
+        'SELECT "song_id" FROM "songinstrumentproficiency" '
+        'WHERE "instrument" = 0 AND "proficiency" = 0',
+    ),
+    (
+        "group membership",
+        'SELECT "id" FROM "groupuser" WHERE "group_id" = 1 AND "user_id" = 1',
+    ),
+    (
+        "group members",
+        'SELECT "t1"."id", "t1"."instrument", "t1"."proficiency" FROM "user" AS "t1" '
+        'INNER JOIN "groupuser" AS "t2" ON "t2"."user_id" = "t1"."id" '
+        'WHERE "t2"."group_id" = 1',
+    ),
+    (
+        "groups of a user",
+        'SELECT "group_id" FROM "groupuser" WHERE "user_id" = 1',
+    ),
+    (
+        "campaigns by group",
+        'SELECT "id", "name", "due_date" FROM "campaign" '
+        'WHERE "group_id" = 1 ORDER BY "due_date"',
+    ),
+    (
+        "ratings by user",
+        'SELECT "campaign_recommendation_id", "rating" '
+        'FROM "campaignrecommendationrating" WHERE "user_id" = 1',
+    ),
+    (
+        "campaign ratings",
+        'SELECT "t1"."id" FROM "campaignrecommendationrating" AS "t1" '
+        'INNER JOIN "campaignrecommendation" AS "t2" '
+        'ON "t1"."campaign_recommendation_id" = "t2"."id" '
+        'WHERE "t2"."campaign_id" = 1',
+    ),
+    (
+        "user genres",
+        'SELECT "genre" FROM "usergenre" WHERE "user_id" = 1',
+    ),
+    (
+        "batch rows by user",
+        'SELECT "song_id", "rank" FROM "batchrecommendation" '
+        'WHERE "user_id" = 1 ORDER BY "rank"',
+    ),
+]
+REVOCATION_CHECKS = [
+    (
+        "revoked token lookup",
+        'SELECT "id" FROM "revokedtoken" WHERE "jti" = \'jti\'',
+    ),
+    (
+        "revocations since",
+        'SELECT "id", "jti" FROM "revokedtoken" WHERE "id" > 0',
+    ),
+]
+RATING_SEQUENCE_CHECKS = [
+    (
+        "ratings changed since",
+        'SELECT "id" FROM "campaignrecommendationrating" '
+        'WHERE "updated_seq" > 0 ORDER BY "updated_seq"',
+    ),
+]
+JOB_CHECKS = [
+    (
+        "job lookup",
+        'SELECT "status", "result" FROM "job" WHERE "id" = \'id\'',
+    ),
+    (
+        "finished jobs",
+        'DELETE FROM "job" WHERE "finished" < \'2000-01-01\'',
+    ),
+]
+CACHE_INVALIDATION_CHECKS = [
+    (
+        "invalidations since",
+        'SELECT "id", "key" FROM "cacheinvalidation" '
+        'WHERE "id" > 0 AND "cache" = \'cache\' AND "origin" != 0',
+    ),
+    (
+        "expired invalidations",
+        'DELETE FROM "cacheinvalidation" '
+        "WHERE \"created\" < '2000-01-01' AND \"cache\" = 'cache'",
+    ),
+]
+
+BATCH_STALENESS_CHECKS = [
+    (
+        "stale batch users",
+        'SELECT DISTINCT "user_id" FROM "batchrecommendation" '
+        'WHERE "stale" = 1 AND "user_id" > 0 ORDER BY "user_id"',
+    ),
+    (
+        "stale batch groups",
+        'SELECT DISTINCT "group_id" FROM "batchrecommendation" '
+        'WHERE "stale" = 1 AND "group_id" > 0 ORDER BY "group_id"',
+    ),
+]
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+class Migration:
+    # apply(db) changes the schema; checks are (name, sql) pairs
+    # for the hot queries this migration is responsible for. After it is
+    # applied, none of them may fall back to a full table scan.
+    def __init__(self, version, name, apply, checks=None):
+        self.version = version
+        self.name = name
+        self.apply = apply
+        self.checks = checks or []
+
+
+def execute_all(db, statements):
+    for sql in statements:
+        db.execute_sql(sql)
+
+
+def add_indexes(db, indexes):
+    # Databases created before migrations existed may already have some of
+    # these from the models' Meta.indexes, so only missing ones are created.
+    migrator = SqliteMigrator(db)
+    operations = []
+    for table, columns, unique in indexes:
+        existing = {tuple(index.columns) for index in db.get_indexes(table)}
+        if tuple(columns) not in existing:
+            operations.append(migrator.add_index(table, columns, unique))
+    migrate(*operations)
+
+
+def create_tables(db):
+    execute_all(db, INITIAL_SCHEMA)
+
+
+def add_hot_path_indexes(db):
+    add_indexes(
+        db,
+        [
+            (
+                "songinstrumentproficiency",
+                ("instrument", "proficiency", "song_id"),
+                False,
+            ),
+            ("groupuser", ("group_id", "user_id"), False),
+            ("campaign", ("group_id", "due_date"), False),
+            (
+                "campaignrecommendationrating",
+                ("user_id", "campaign_recommendation_id", "rating"),
+                False,
+            ),
+        ],
+    )
+
+
+def create_revoked_tokens(db):
+    execute_all(db, REVOKED_TOKENS_SCHEMA)
+
+
+def add_rating_sequence(db):
+    migrator = SqliteMigrator(db)
+    migrate(
+        migrator.add_column(
+            "campaignrecommendationrating",
+            "updated_seq",
+            IntegerField(default=0),
+        )
+    )
+    # Existing rows keep their order; the online updates' watermarks,
+    # recorded as row ids until now, stay valid as sequence numbers.
+    db.execute_sql('UPDATE "campaignrecommendationrating" SET "updated_seq" = "id"')
+    add_indexes(db, [("campaignrecommendationrating", ("updated_seq",), False)])
+
+
+def create_jobs(db):
+    execute_all(db, JOBS_SCHEMA)
+
+
+def create_cache_invalidations(db):
+    execute_all(db, CACHE_INVALIDATIONS_SCHEMA)
+
+
+def add_batch_staleness(db):
+    execute_all(db, BATCH_STALENESS_SCHEMA)
+
+
+MIGRATIONS = [
+    Migration(1, "create tables", create_tables),
+    Migration(2, "hot path indexes", add_hot_path_indexes, HOT_PATH_CHECKS),
+    Migration(3, "revoked tokens", create_revoked_tokens, REVOCATION_CHECKS),
+    Migration(4, "rating sequence", add_rating_sequence, RATING_SEQUENCE_CHECKS),
+    Migration(5, "jobs", create_jobs, JOB_CHECKS),
+    Migration(
+        6,
+        "cache invalidations",
+        create_cache_invalidations,
+        CACHE_INVALIDATION_CHECKS,
+    ),
+    Migration(7, "batch staleness", add_batch_staleness, BATCH_STALENESS_CHECKS),
+]
+
+
+def query_plan(db, sql):
+    return [row[-1] for row in db.execute_sql("EXPLAIN QUERY PLAN " + sql)]
+
+
+def check_query_plans(db, migrations=None):
+    # SQLite reports a full table scan as "SCAN <table>"; index lookups are
+    # "SEARCH ..." and covering-index scans name the index they use.
+    failures = []
+    for migration in migrations or MIGRATIONS:
+        for name, sql in migration.checks:
+            for detail in query_plan(db, sql):
+                if detail.startswith("SCAN ") and " USING " not in detail:
+                    failures.append(f"{name}: {detail}")
+    if failures:
+        raise QueryPlanError("Full table scans:\n" + "\n".join(failures))
+
+
+def applied_versions(db):
+    if not db.table_exists(SchemaVersion._meta.table_name):
+        return set()
+    return {
+        version for (version,) in SchemaVersion.select(SchemaVersion.version).tuples()
+    }
+
+
+def pending_migrations(db=None):
+    db = db or get_database()
+    applied = applied_versions(db)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def apply_migrations(target=None):
+    db = get_database()
+    applied = []
+    for migration in pending_migrations(db):
+        if target is not None and migration.version > target:
+            break
+
+        # IMMEDIATE takes the write lock up front, so concurrent starters
+        # queue here and then see the version already recorded.
+        with db.atomic("IMMEDIATE"):
+            if migration.version in applied_versions(db):
+                continue
+            migration.apply(db)
+            check_query_plans(db, [migration])
+            SchemaVersion.create(
+                version=migration.version,
+                name=migration.name,
+                applied=datetime.datetime.now(),
+            )
+        applied.append(migration)
+    return applied
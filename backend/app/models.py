@@ -1,4 +1,5 @@
 from peewee import *
+from playhouse import signals
 from .config import get_database
 
 
@@ -18,7 +19,7 @@ def genre_choices():
     return [(0, "Rock"), (1, "Jazz"), (2, "Blues"), (3, "Country"), (4, "Funk")]
 
 
-class BaseModel(Model):
+class BaseModel(signals.Model):
     class Meta:
         database = get_database()
 
@@ -52,6 +53,9 @@ class GroupUser(BaseModel):
     user = ForeignKeyField(User, backref="groups")
     joined = DateTimeField()
 
+    class Meta:
+        indexes = ((("group", "user"), False),)
+
 
 class Artist(BaseModel):
     name = CharField(unique=True)
@@ -73,6 +77,10 @@ class SongInstrumentProficiency(BaseModel):
     instrument = IntegerField(choices=instrument_choices())
     proficiency = IntegerField(choices=instrument_proficiency_levels())
 
+    class Meta:
+        # Covers "songs playable at this level" without touching the table.
+        indexes = ((("instrument", "proficiency", "song"), False),)
+
 
 class Campaign(BaseModel):
     name = CharField()
@@ -80,6 +88,9 @@ class Campaign(BaseModel):
     due_date = DateTimeField()
     group = ForeignKeyField(Group, backref="campaigns")
 
+    class Meta:
+        indexes = ((("group", "due_date"), False),)
+
 
 class CampaignRecommendation(BaseModel):
     campaign = ForeignKeyField(Campaign, backref="recommendations")
@@ -93,6 +104,82 @@ class CampaignRecommendationRating(BaseModel):
     campaign_recommendation = ForeignKeyField(CampaignRecommendation, backref="ratings")
     user = ForeignKeyField(User, backref="campaign_recommendation_ratings")
     rating = IntegerField()
+    # Taken from a table-wide counter on every insert or update (see
+    # app/ratings.py), so readers can follow changes in commit order.
+    updated_seq = IntegerField(default=0, index=True)
+
+    class Meta:
+        indexes = (
+            (("campaign_recommendation", "user"), True),
+            (("user", "campaign_recommendation", "rating"), False),
+        )
+
+
+class BatchRecommendation(BaseModel):
+    # Exactly one of user/group is set.
+    user = ForeignKeyField(
+        User, null=True, backref="batch_recommendations", on_delete="CASCADE"
+    )
+    group = ForeignKeyField(
+        Group, null=True, backref="batch_recommendations", on_delete="CASCADE"
+    )
+    song = ForeignKeyField(Song, backref="batch_recommendations", on_delete="CASCADE")
+    score = FloatField()
+    rank = IntegerField()
+    model_version = CharField()
+    generated = DateTimeField()
+    # Set when the user's or group's inputs changed after `generated`; the
+    # rows are kept and served until the next run rebuilds them.
+    stale = BooleanField(default=False)
 
     class Meta:
-        indexes = ((("campaign_recommendation", "user"), True),)
+        indexes = (
+            (("user", "rank"), False),
+            (("group", "rank"), False),
+        )
+
+
+class BatchRun(BaseModel):
+    model_version = CharField()
+    limit = IntegerField()
+    started = DateTimeField()
+    finished = DateTimeField(null=True)
+    # Checkpoints: every user/group with an id up to these has been written.
+    last_user_id = IntegerField(default=0)
+    last_group_id = IntegerField(default=0)
+
+
+class RevokedToken(BaseModel):
+    jti = CharField(unique=True)
+    # Rows can be dropped once the token would have expired anyway.
+    expires = DateTimeField(index=True)
+
+
+class Job(BaseModel):
+    # Background jobs (app/jobs.py); kept in the database so any worker
+    # process can answer a status poll.
+    id = CharField(primary_key=True)
+    kind = CharField()
+    status = CharField()
+    created = DateTimeField()
+    started = DateTimeField(null=True)
+    # Finished jobs are pruned by this.
+    finished = DateTimeField(null=True, index=True)
+    # JSON encoded.
+    result = TextField(null=True)
+    error = TextField(null=True)
+
+
+class CacheInvalidation(BaseModel):
+    # Cache deletions made by one worker process, replayed by the others
+    # (app/cache.py); rows older than the cache's TTL are pruned.
+    cache = CharField()
+    key = TextField()
+    origin = IntegerField()
+    created = DateTimeField(index=True)
+
+
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied = DateTimeField()
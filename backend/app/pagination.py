@@ -0,0 +1,64 @@
+import json
+from flask import Response, request, stream_with_context
+from .config import get_database
+from .utils import api_response, api_error
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Rows fetched per query while streaming NDJSON.
+STREAM_BATCH_SIZE = 500
+
+
+def parse_page_args(args):
+    after = int(args.get("after", 0))
+    limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    if after < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(args)
+    return after, limit
+
+
+def keyset_page(query, key, after, limit):
+    # Seeks past the last seen id instead of using OFFSET, so every page
+    # costs the same index range scan however deep the client has paged.
+    rows = list(query.where(key > after).order_by(key).limit(limit + 1))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, getattr(rows[-1], key.name)
+
+
+def iter_keyset(query, key, after=0, batch_size=STREAM_BATCH_SIZE):
+    while after is not None:
+        rows, after = keyset_page(query, key, after, batch_size)
+        yield rows
+
+
+def ndjson_response(query, key, serialize, after=0):
+    def generate():
+        # after_request has already released the request's connection by
+        # the time the body is iterated, so the stream holds its own.
+        with get_database().connection_context():
+            for rows in iter_keyset(query, key, after):
+                for item in serialize(rows):
+                    yield json.dumps(item) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def list_response(query, key, serialize, message):
+    # ?after=<id>&limit=<n> returns one page and the cursor for the next;
+    # ?format=ndjson streams everything after the cursor, one row per line.
+    try:
+        after, limit = parse_page_args(request.args)
+    except ValueError:
+        return api_error("Invalid cursor or limit", status_code=400)
+
+    if request.args.get("format") == "ndjson":
+        return ndjson_response(query, key, serialize, after)
+
+    rows, cursor = keyset_page(query, key, after, limit)
+    return api_response(
+        data={"items": serialize(rows), "nextCursor": cursor},
+        message=message,
+        status_code=200,
+    )
@@ -0,0 +1,139 @@
+import functools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.security import check_password_hash, generate_password_hash
+from .admission import Overloaded
+from .metrics import histogram, register_gauges
+
+DEFAULT_WORKERS = 2
+# Hashes queued or running at once; beyond this callers are turned away.
+DEFAULT_QUEUE_LIMIT = 32
+# Stored hashes with a different method prefix are upgraded on login.
+DEFAULT_METHOD = "pbkdf2:sha256:600000"
+# Seconds a caller waits for a queued hash before giving up.
+HASH_TIMEOUT = 10
+
+hash_duration = histogram(
+    "password_hash_duration_seconds",
+    "Time to hash or check a password, including queueing",
+)
+
+_workers = DEFAULT_WORKERS
+_method = DEFAULT_METHOD
+_slots = threading.BoundedSemaphore(DEFAULT_QUEUE_LIMIT)
+_counters = {"in_flight": 0, "rejected": 0}
+_counters_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class HashingOverloaded(Overloaded):
+    pass
+
+
+def initialize_passwords(workers=None, queue_limit=None, method=None):
+    global _workers, _method, _slots
+    _workers = workers or DEFAULT_WORKERS
+    _method = method or DEFAULT_METHOD
+    _slots = threading.BoundedSemaphore(queue_limit or DEFAULT_QUEUE_LIMIT)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                # spawn, not fork: the server is multi-threaded by the time
+                # the first hash is requested.
+                _executor = ProcessPoolExecutor(
+                    max_workers=_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _executor
+
+
+def stats():
+    with _counters_lock:
+        return dict(_counters)
+
+
+register_gauges("password_hashing", "Password hashing pool", stats)
+
+
+@functools.lru_cache(maxsize=None)
+def method_prefix(method):
+    # werkzeug stores the parameters it filled in, e.g. "scrypt:32768:8:1"
+    # for "scrypt", so compare against a real hash's prefix instead of the
+    # configured string.
+    return generate_password_hash("", method=method).split("$", 1)[0]
+
+
+def needs_rehash(hashed_password, method):
+    return hashed_password.split("$", 1)[0] != method_prefix(method)
+
+
+# The two functions below run in the worker processes.
+
+
+def _hash(raw_password, method):
+    return generate_password_hash(raw_password, method=method)
+
+
+def _verify(raw_password, hashed_password, method):
+    if not check_password_hash(hashed_password, raw_password):
+        return False, None
+    if needs_rehash(hashed_password, method):
+        return True, generate_password_hash(raw_password, method=method)
+    return True, None
+
+
+def count(name, delta=1):
+    with _counters_lock:
+        _counters[name] += delta
+
+
+def run(operation, fn, *args):
+    # Fails fast instead of queueing without bound: a login burst must not
+    # tie up every server thread waiting on the pool.
+    if not _slots.acquire(blocking=False):
+        count("rejected")
+        raise HashingOverloaded()
+
+    started = time.perf_counter()
+    count("in_flight")
+    slots = _slots
+
+    def release(future):
+        # The slot is held until the pool is done with the task, not just
+        # until the caller stops waiting, so the backlog stays bounded.
+        count("in_flight", -1)
+        slots.release()
+
+    try:
+        future = get_executor().submit(fn, *args)
+    except BaseException:
+        release(None)
+        raise
+    future.add_done_callback(release)
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except TimeoutError:
+        # Drops the task if it has not started; a running one keeps its
+        # slot until it finishes.
+        future.cancel()
+        count("rejected")
+        raise HashingOverloaded()
+    finally:
+        hash_duration.observe(time.perf_counter() - started, operation=operation)
+
+
+def hash_password(raw_password):
+    return run("hash", _hash, raw_password, _method)
+
+
+def verify_password(raw_password, hashed_password):
+    # Returns (matches, new_hash); new_hash is set when the stored hash
+    # used older parameters and should replace it.
+    return run("verify", _verify, raw_password, hashed_password, _method)
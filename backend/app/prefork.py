@@ -0,0 +1,294 @@
+import http.client
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from waitress import create_server
+from waitress.channel import HTTPChannel
+from waitress.server import BaseWSGIServer
+
+# Seconds between health probes, and failed probes in a row before a
+# worker is replaced.
+HEALTH_INTERVAL = 5
+HEALTH_TIMEOUT = 2
+HEALTH_FAILURES = 3
+# A new worker has this long to answer its first probe.
+STARTUP_TIMEOUT = 60
+# Seconds a stopping worker gets to finish its requests before SIGKILL;
+# it stops waiting for them a little earlier, to exit cleanly.
+STOP_TIMEOUT = 30
+DRAIN_TIMEOUT = STOP_TIMEOUT - 10
+DRAIN_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    def __init__(self, index, pid, health_port):
+        self.index = index
+        self.pid = pid
+        self.health_port = health_port
+        self.started = time.monotonic()
+        self.ready = False
+        self.failures = 0
+        self.checked = 0
+
+    def probe(self):
+        connection = http.client.HTTPConnection(
+            "127.0.0.1", self.health_port, timeout=HEALTH_TIMEOUT
+        )
+        try:
+            connection.request("GET", "/health")
+            return connection.getresponse().status == 200
+        except OSError:
+            return False
+        finally:
+            connection.close()
+
+
+def listen(host, port, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def busy(server):
+    dispatcher = server.task_dispatcher
+    if dispatcher.queue or dispatcher.active_count:
+        return True
+    # Requests still being read count too, and responses are written
+    # out by the server loop after their task ends.
+    return any(
+        channel.request is not None or channel.requests or channel.total_outbufs_len
+        for channel in list(server.map.values())
+        if isinstance(channel, HTTPChannel)
+    )
+
+
+def drain(server, listener, stopping):
+    # On SIGTERM: stop accepting on the shared listener (the other
+    # workers keep taking its queued connections), let the requests
+    # already accepted finish, then stop the server loop from its own
+    # thread. The listener stays open: its trigger serves the channels.
+    stopping.wait()
+    listening = next(
+        dispatcher
+        for dispatcher in list(server.map.values())
+        if isinstance(dispatcher, BaseWSGIServer) and dispatcher.socket is listener
+    )
+    listening.accepting = False
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while busy(server) and time.monotonic() < deadline:
+        time.sleep(DRAIN_INTERVAL)
+    listening.trigger.pull_trigger(server.close)
+
+
+def run_worker(index, listener, health, create_app, threads):
+    # Runs in the child after fork() and never returns into the master's
+    # code.
+    status = 0
+    try:
+        stopping = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        os.environ["WEB_WORKER"] = str(index)
+        if index:
+            # Only the first worker writes compacted model artifacts.
+            os.environ["ONLINE_COMPACTION"] = "0"
+        # Workers map the shared catalog snapshot, which the first one
+        # republishes as songs are added, instead of each copying it.
+        os.environ["CATALOG_SNAPSHOTS"] = "publish" if index == 0 else "follow"
+
+        app = create_app()
+        # The shared listener takes traffic; the private health socket
+        # lets the master probe this worker specifically.
+        server = create_server(app, sockets=[listener, health], threads=threads)
+        threading.Thread(
+            target=drain,
+            args=(server, listener, stopping),
+            name="worker-drain",
+            daemon=True,
+        ).start()
+        server.run()
+    except Exception:
+        logger.exception("Worker %d crashed", index)
+        status = 1
+    finally:
+        try:
+            from .jobs import shutdown_jobs
+
+            shutdown_jobs()
+        except Exception:
+            logger.exception("Worker %d could not finish its jobs", index)
+        try:
+            from .ratings import flush_ratings
+
+            flush_ratings()
+        except Exception:
+            logger.exception("Worker %d could not flush ratings", index)
+        os._exit(status)
+
+
+class Master:
+    # Pre-fork supervisor: one listening socket shared by `workers`
+    # waitress processes. Each worker maps the same read-only model and
+    # catalog files, so scoring uses every core without a copy of the
+    # matrices per process.
+    def __init__(self, host, port, workers, threads, create_app, prepare):
+        self.workers_count = workers
+        self.threads = threads
+        self.create_app = create_app
+        # prepare() runs in the master before every (re)fork: it publishes
+        # the shared artifacts and must leave no database connection open.
+        self.prepare = prepare
+        self.listener = listen(host, int(port))
+        self.workers = {}
+        self.running = True
+        self.reload_requested = False
+
+    def spawn(self, index):
+        health = listen("127.0.0.1", 0)
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index, self.listener, health, self.create_app, self.threads)
+        health_port = health.getsockname()[1]
+        health.close()
+        worker = Worker(index, pid, health_port)
+        self.workers[pid] = worker
+        logger.info("Started worker %d (pid %d)", index, pid)
+        return worker
+
+    def stop(self, worker, timeout=STOP_TIMEOUT):
+        # SIGTERM makes the worker stop accepting, finish the requests it
+        # has (see drain()) and flush buffered ratings; SIGKILL if it does
+        # not exit in time.
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                pid, _ = os.waitpid(worker.pid, os.WNOHANG)
+                if pid:
+                    break
+                time.sleep(0.1)
+            else:
+                os.kill(worker.pid, signal.SIGKILL)
+                os.waitpid(worker.pid, 0)
+        except (ChildProcessError, ProcessLookupError):
+            pass
+        self.workers.pop(worker.pid, None)
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is not None and self.running:
+                logger.warning(
+                    "Worker %d (pid %d) exited with status %d; restarting",
+                    worker.index,
+                    pid,
+                    status,
+                )
+                self.spawn(worker.index)
+
+    def check_health(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if now - worker.checked < HEALTH_INTERVAL:
+                continue
+            worker.checked = now
+            if worker.probe():
+                worker.ready = True
+                worker.failures = 0
+                continue
+
+            if not worker.ready:
+                if now - worker.started < STARTUP_TIMEOUT:
+                    continue
+            else:
+                worker.failures += 1
+                if worker.failures < HEALTH_FAILURES:
+                    continue
+
+            logger.warning(
+                "Worker %d (pid %d) failed health checks; restarting",
+                worker.index,
+                worker.pid,
+            )
+            self.stop(worker, timeout=HEALTH_TIMEOUT)
+            self.spawn(worker.index)
+
+    def wait_ready(self, worker):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if worker.probe():
+                worker.ready = True
+                return True
+            time.sleep(0.5)
+        return False
+
+    def reload(self):
+        # Rolling: each worker is replaced only once its successor
+        # answers health checks, so capacity never drops to zero.
+        logger.info("Reloading workers")
+        self.prepare()
+        for old in sorted(self.workers.values(), key=lambda worker: worker.index):
+            new = self.spawn(old.index)
+            if not self.wait_ready(new):
+                logger.error(
+                    "Worker %d did not become healthy; keeping pid %d",
+                    new.index,
+                    old.pid,
+                )
+                self.stop(new, timeout=HEALTH_TIMEOUT)
+                continue
+            self.stop(old)
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        self.prepare()
+        for index in range(self.workers_count):
+            self.spawn(index)
+
+        while self.running:
+            self.reap()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.check_health()
+            time.sleep(0.5)
+
+        logger.info("Stopping %d workers", len(self.workers))
+        for worker in list(self.workers.values()):
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for worker in list(self.workers.values()):
+            self.stop(worker)
+        self.listener.close()
+
+
+def serve_prefork(host, port, workers, threads, create_app, prepare):
+    Master(host, port, workers, threads, create_app, prepare).run()
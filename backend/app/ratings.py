@@ -0,0 +1,197 @@
+import atexit
+import logging
+import threading
+import time
+from peewee import IntegrityError, fn
+from .cache import invalidate_user
+from .config import get_database
+from .metrics import COUNT_BUCKETS, histogram, register_gauges
+from .models import CampaignRecommendationRating
+
+# A rating is written at most this long after it was accepted...
+DEFAULT_FLUSH_MS = 200
+# ...or as soon as this many distinct ratings are waiting.
+DEFAULT_FLUSH_ROWS = 500
+
+logger = logging.getLogger(__name__)
+
+flush_duration = histogram(
+    "rating_flush_duration_seconds", "Time to write a batch of buffered ratings"
+)
+flush_rows = histogram(
+    "rating_flush_rows", "Ratings written per flush", COUNT_BUCKETS + (1000,)
+)
+
+
+class RatingBuffer:
+    # Ratings are keyed by (campaign_recommendation, user), the table's
+    # unique index, so a re-rate before the next flush replaces the
+    # pending value and the whole batch is one upsert.
+    def __init__(self, flush_ms=DEFAULT_FLUSH_MS, flush_rows=DEFAULT_FLUSH_ROWS):
+        self.flush_ms = flush_ms
+        self.flush_rows = flush_rows
+        self.pending = {}
+        self.oldest = None
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        self.counters = {"accepted": 0, "flushed": 0, "flushes": 0, "dropped": 0}
+
+    def add(self, campaign_recommendation_id, user_id, rating):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="rating-flusher", daemon=True
+                )
+                self.thread.start()
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending[(campaign_recommendation_id, user_id)] = rating
+            self.counters["accepted"] += 1
+            if len(self.pending) >= self.flush_rows:
+                self.condition.notify()
+
+    def take(self):
+        with self.condition:
+            batch, self.pending, self.oldest = self.pending, {}, None
+            return batch
+
+    def restore(self, batch):
+        # Newer ratings accepted while the batch was being written win.
+        with self.condition:
+            if not self.pending:
+                self.oldest = time.monotonic()
+            for key, rating in batch.items():
+                self.pending.setdefault(key, rating)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = self.oldest + self.flush_ms / 1000
+                while (
+                    len(self.pending) < self.flush_rows and time.monotonic() < deadline
+                ):
+                    self.condition.wait(deadline - time.monotonic())
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing buffered ratings failed")
+                time.sleep(self.flush_ms / 1000)
+
+    def flush(self):
+        with self.flush_lock:
+            batch = self.take()
+            if not batch:
+                return 0
+
+            started = time.perf_counter()
+            try:
+                with get_database().connection_context():
+                    written = self.write(batch)
+                    # insert_many bypasses the model signals that normally
+                    # invalidate cached recommendations.
+                    for user_id in {user_id for _, user_id in batch}:
+                        invalidate_user(user_id)
+            except Exception:
+                self.restore(batch)
+                raise
+            finally:
+                flush_duration.observe(time.perf_counter() - started)
+
+            for callback in _listeners:
+                callback(batch)
+
+            flush_rows.observe(written)
+            with self.condition:
+                self.counters["flushed"] += written
+                self.counters["flushes"] += 1
+                self.counters["dropped"] += len(batch) - written
+            return written
+
+    def write(self, batch):
+        rows = [
+            {
+                "campaign_recommendation": campaign_recommendation_id,
+                "user": user_id,
+                "rating": rating,
+            }
+            for (campaign_recommendation_id, user_id), rating in batch.items()
+        ]
+        try:
+            upsert(rows)
+            return len(rows)
+        except IntegrityError:
+            pass
+
+        # A recommendation or user was deleted after its rating was
+        # accepted; write the rest one by one and drop the orphans.
+        written = 0
+        for row in rows:
+            try:
+                upsert([row])
+                written += 1
+            except IntegrityError:
+                logger.warning("Dropping rating for missing row: %s", row)
+        return written
+
+    def stats(self):
+        with self.condition:
+            return dict(self.counters, pending=len(self.pending))
+
+
+def upsert(rows):
+    # A re-rate updates the existing row in place, keeping its id. Every
+    # written row takes the next updated_seq; IMMEDIATE holds the write
+    # lock from the MAX() on, so sequence numbers are unique and commit in
+    # order across processes.
+    with get_database().atomic("IMMEDIATE"):
+        seq = (
+            CampaignRecommendationRating.select(
+                fn.MAX(CampaignRecommendationRating.updated_seq)
+            ).scalar()
+            or 0
+        )
+        CampaignRecommendationRating.insert_many(
+            [dict(row, updated_seq=seq + offset) for offset, row in enumerate(rows, 1)]
+        ).on_conflict(
+            conflict_target=[
+                CampaignRecommendationRating.campaign_recommendation,
+                CampaignRecommendationRating.user,
+            ],
+            preserve=[
+                CampaignRecommendationRating.rating,
+                CampaignRecommendationRating.updated_seq,
+            ],
+        ).execute()
+
+
+_buffer = RatingBuffer()
+_listeners = []
+
+
+def initialize_ratings(flush_ms=None, flush_rows=None):
+    _buffer.flush_ms = flush_ms or DEFAULT_FLUSH_MS
+    _buffer.flush_rows = flush_rows or DEFAULT_FLUSH_ROWS
+
+
+def add_rating(campaign_recommendation_id, user_id, rating):
+    _buffer.add(campaign_recommendation_id, user_id, rating)
+
+
+def subscribe(callback):
+    # callback(batch) runs on the flusher thread after every successful
+    # write, with {(campaign_recommendation_id, user_id): rating}; it must
+    # hand work off rather than do it inline.
+    _listeners.append(callback)
+
+
+def flush_ratings():
+    return _buffer.flush()
+
+
+register_gauges("rating_buffer", "Write-behind rating buffer", _buffer.stats)
+
+# Graceful shutdown (SIGINT/SIGTERM, see web.py) writes out what is left.
+atexit.register(flush_ratings)
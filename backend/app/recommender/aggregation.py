@@ -0,0 +1,93 @@
+import numpy as np
+from app.config import get_read_database
+from app.models import GroupUser, User, UserGenre, genre_choices
+
+DEFAULT_STRATEGY = "average"
+SCORE_BLOCK_SIZE = 65536
+
+REDUCTIONS = {
+    "average": lambda scores: scores.mean(axis=1),
+    "least_misery": lambda scores: scores.min(axis=1),
+    "most_pleasure": lambda scores: scores.max(axis=1),
+    # Average member score, scaled by how much of the song's line-up the
+    # group can actually cover.
+    "instrument_coverage": lambda scores: scores.mean(axis=1),
+}
+
+STRATEGIES = tuple(REDUCTIONS)
+
+
+class GroupMembers:
+    def __init__(self, user_ids, instruments, proficiencies, genres):
+        self.user_ids = user_ids
+        self.instruments = instruments
+        self.proficiencies = proficiencies
+        # (members x genres) boolean matrix of liked genres
+        self.genres = genres
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+def group_members(group):
+    members = np.array(
+        list(
+            User.select(User.id, User.instrument, User.proficiency)
+            .join(GroupUser, on=(GroupUser.user == User.id))
+            .where(GroupUser.group == group)
+            .order_by(User.id)
+            .bind(get_read_database())
+            .tuples()
+        ),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    user_ids = members[:, 0]
+
+    genres = np.zeros((len(user_ids), len(genre_choices())), dtype=bool)
+    liked = np.array(
+        list(
+            UserGenre.select(UserGenre.user, UserGenre.genre)
+            .where(UserGenre.user.in_(user_ids.tolist()))
+            .bind(get_read_database())
+            .tuples()
+        ),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    genres[np.searchsorted(user_ids, liked[:, 0]), liked[:, 1]] = True
+
+    return GroupMembers(user_ids, members[:, 1], members[:, 2], genres)
+
+
+def validate_strategy(strategy):
+    strategy = strategy or DEFAULT_STRATEGY
+    if strategy not in REDUCTIONS:
+        raise ValueError(f"Unknown group strategy: {strategy}")
+    return strategy
+
+
+def coverage(required_levels, members, instrument_count):
+    # required_levels is (songs x instruments) holding the hardest level
+    # each song asks of an instrument, or -1 when the part is absent. An
+    # instrument is covered when some member plays it at that level.
+    best = np.full(instrument_count, -1)
+    np.maximum.at(best, members.instruments, members.proficiencies)
+
+    required = required_levels >= 0
+    covered = required & (best[None, :] >= required_levels)
+    return (covered.sum(axis=1) + 1) / (required.sum(axis=1) + 1)
+
+
+def aggregate(song_vectors, member_vectors, strategy, weights=None):
+    # Scores the (songs x members) matrix one block of songs at a time and
+    # reduces each block across members, so memory stays bounded for
+    # large catalogs.
+    reduce = REDUCTIONS[strategy]
+    scores = np.empty(len(song_vectors), dtype=np.float32)
+    member_vectors = np.asarray(member_vectors, dtype=np.float32).T
+    for start in range(0, len(song_vectors), SCORE_BLOCK_SIZE):
+        block = np.asarray(song_vectors[start : start + SCORE_BLOCK_SIZE])
+        scores[start : start + len(block)] = reduce(block @ member_vectors)
+
+    if weights is not None:
+        scores *= weights
+    return scores
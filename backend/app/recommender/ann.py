@@ -0,0 +1,120 @@
+import json
+import os
+import numpy as np
+from app.recommender.content_filtering import top_k
+
+INDEX_FILE = "index.json"
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+ASSIGN_BLOCK_SIZE = 65536
+
+
+class IVFIndex:
+    # Inverted-file index: vectors are grouped by their nearest coarse
+    # centroid and stored contiguously, list i occupying
+    # vectors[offsets[i]:offsets[i + 1]]. A query only scans the nprobe
+    # lists whose centroids score highest, so nprobe trades recall for
+    # latency; nprobe == len(centroids) is an exact search.
+    def __init__(self, centroids, offsets, ids, vectors, nprobe=DEFAULT_NPROBE):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, limit, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probe = top_k(self.centroids @ query, nprobe)
+
+        positions = np.concatenate(
+            [np.arange(self.offsets[i], self.offsets[i + 1]) for i in probe]
+        )
+        if len(positions) == 0:
+            return np.empty(0, dtype=self.ids.dtype), np.empty(0, dtype=np.float32)
+
+        scores = self.vectors[positions] @ query
+        top = top_k(scores, limit)
+        return np.asarray(self.ids[positions[top]]), scores[top]
+
+
+def assign(vectors, centroids):
+    # argmin ||x - c||^2 == argmax (2 x.c - ||c||^2), in blocks so the
+    # (vectors x centroids) score matrix stays bounded.
+    bias = (centroids * centroids).sum(axis=1)
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_SIZE):
+        block = np.asarray(vectors[start : start + ASSIGN_BLOCK_SIZE])
+        labels[start : start + len(block)] = np.argmax(
+            2 * block @ centroids.T - bias, axis=1
+        )
+    return labels
+
+
+def kmeans(vectors, lists, iterations=KMEANS_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), lists * KMEANS_SAMPLES_PER_LIST)
+    sample = np.asarray(vectors[rng.choice(len(vectors), sample_size, replace=False)])
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=lists)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = sample[rng.choice(len(sample), empty.sum())]
+
+    return centroids
+
+
+def build_index(vectors, ids, lists=None, nprobe=DEFAULT_NPROBE, seed=0):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if lists is None:
+        lists = int(np.sqrt(len(vectors)))
+    lists = max(1, min(lists, len(vectors)))
+
+    centroids = kmeans(vectors, lists, seed=seed)
+    labels = assign(vectors, centroids)
+    order = np.argsort(labels, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=lists))))
+
+    return IVFIndex(
+        centroids,
+        offsets.astype(np.int64),
+        np.asarray(ids)[order],
+        vectors[order],
+        nprobe,
+    )
+
+
+def save_index(index, path):
+    os.makedirs(path, exist_ok=True)
+    for name in ("centroids", "offsets", "ids", "vectors"):
+        np.save(os.path.join(path, f"{name}.npy"), getattr(index, name))
+
+    with open(os.path.join(path, INDEX_FILE), "w") as f:
+        json.dump({"nprobe": index.nprobe, "lists": len(index.centroids)}, f)
+
+
+def load_index(path, nprobe=None):
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        meta = json.load(f)
+
+    arrays = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in ("ids", "vectors")
+    }
+    # Centroids and offsets are tiny and touched on every query.
+    return IVFIndex(
+        np.load(os.path.join(path, "centroids.npy")),
+        np.load(os.path.join(path, "offsets.npy")),
+        arrays["ids"],
+        arrays["vectors"],
+        nprobe or meta["nprobe"],
+    )
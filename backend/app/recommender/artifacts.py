@@ -0,0 +1,33 @@
+import json
+import os
+import numpy as np
+
+
+def save_array(directory, filename, array):
+    # A new file is swapped in under the name, never rewritten in place:
+    # processes that still map the old file keep reading the old inode.
+    path = os.path.join(directory, filename)
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(array))
+    os.replace(tmp_path, path)
+
+
+def save_json(directory, filename, data):
+    path = os.path.join(directory, filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def load_json(directory, filename):
+    with open(os.path.join(directory, filename)) as f:
+        return json.load(f)
+
+
+def load_arrays(directory, files):
+    # Memory-mapped read-only: loading is instant and every process
+    # mapping the same files shares them through the OS page cache.
+    return {
+        name: np.load(os.path.join(directory, filename), mmap_mode="r")
+        for name, filename in files.items()
+    }
@@ -0,0 +1,474 @@
+import os
+import sys
+import threading
+import time
+import numpy as np
+from peewee import fn
+from app.config import get_model_dir, get_read_database
+from app.recommender import registry
+from app.recommender.artifacts import load_arrays, load_json, save_array, save_json
+from app.models import (
+    Album,
+    Artist,
+    Song,
+    SongInstrumentProficiency,
+    instrument_proficiency_levels,
+)
+
+PROFICIENCY_COUNT = len(instrument_proficiency_levels())
+
+# Seconds between incremental refreshes triggered by get_catalog().
+REFRESH_INTERVAL = 60
+# Seconds between checks for a republished snapshot, when following one.
+SNAPSHOT_CHECK_INTERVAL = 5
+
+# Shared snapshot under MODEL_DIR, see save_snapshot().
+SNAPSHOT_DIR = "catalog"
+SNAPSHOT_MANIFEST = "manifest.json"
+
+COLUMNS = (
+    "song_ids",
+    "genres",
+    "requirements",
+    "song_names",
+    "album_names",
+    "artist_names",
+    "album_ids",
+    "artist_ids",
+)
+
+_catalog = None
+_catalog_lock = threading.Lock()
+# None: refresh from the database. "follow": map the shared snapshot
+# whenever it is republished. "publish": the same, and this process
+# republishes it (see content_filtering.SnapshotPublisher).
+_snapshots = None
+
+
+class StringTable:
+    # Append-only, shared between snapshots: a code handed out is never
+    # reused, so older snapshots stay valid while newer ones add names.
+    def __init__(self):
+        self.strings = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+    def intern(self, names):
+        codes = np.empty(len(names), dtype=np.int32)
+        for i, name in enumerate(names):
+            code = self.codes.get(name)
+            if code is None:
+                code = len(self.strings)
+                self.strings.append(sys.intern(name))
+                self.codes[name] = code
+            codes[i] = code
+        return codes
+
+    def nbytes(self):
+        return sys.getsizeof(self.strings) + sum(
+            sys.getsizeof(string) for string in self.strings
+        )
+
+
+class MappedStrings:
+    # A StringTable saved by save_snapshot(): UTF-8 bytes plus offsets,
+    # mapped read-only and shared by every process. Names interned by a
+    # later incremental refresh go to a private overflow list.
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+        self.base = len(offsets) - 1
+        self.strings = []
+        self.codes = None
+
+    def __len__(self):
+        return self.base + len(self.strings)
+
+    def __getitem__(self, code):
+        if code >= self.base:
+            return self.strings[code - self.base]
+        return bytes(self.blob[self.offsets[code] : self.offsets[code + 1]]).decode()
+
+    def intern(self, names):
+        if self.codes is None:
+            # Only needed once new songs arrive after the snapshot.
+            self.codes = {self[code]: code for code in range(self.base)}
+        codes = np.empty(len(names), dtype=np.int32)
+        for i, name in enumerate(names):
+            code = self.codes.get(name)
+            if code is None:
+                code = self.base + len(self.strings)
+                self.strings.append(sys.intern(name))
+                self.codes[name] = code
+            codes[i] = code
+        return codes
+
+    def nbytes(self):
+        # The mapped part is shared, so only the overflow is counted.
+        return sys.getsizeof(self.strings) + sum(
+            sys.getsizeof(string) for string in self.strings
+        )
+
+
+class Catalog:
+    # Immutable column-oriented snapshot of Song -> Album -> Artist plus
+    # SongInstrumentProficiency. Row i describes song_ids[i]; song_ids is
+    # sorted because song ids only grow. A refresh builds a new snapshot
+    # and swaps it in, so readers never see half-updated columns.
+    def __init__(
+        self,
+        song_ids,
+        genres,
+        requirements,
+        song_names,
+        album_names,
+        artist_names,
+        album_ids,
+        artist_ids,
+        strings,
+        last_song_id=0,
+        last_requirement_id=0,
+        version=0,
+        extras=None,
+    ):
+        self.song_ids = song_ids
+        self.genres = genres
+        # Bit (instrument * PROFICIENCY_COUNT + proficiency) is set when the
+        # song has a part for that instrument at that level.
+        self.requirements = requirements
+        self.song_names = song_names
+        self.album_names = album_names
+        self.artist_names = artist_names
+        self.album_ids = album_ids
+        self.artist_ids = artist_ids
+        self.strings = strings
+        self.last_song_id = last_song_id
+        self.last_requirement_id = last_requirement_id
+        self.version = version
+        # Arrays derived from exactly this snapshot and saved with it
+        # (e.g. the content feature matrix); dropped by any refresh.
+        self.extras = extras or {}
+        self.refreshed = time.time()
+        # Manifest mtime of the shared snapshot this was mapped from.
+        self.modified = None
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def rows(self, song_ids):
+        # Positions of song_ids in the snapshot and a mask of which exist.
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        if len(self.song_ids) == 0:
+            empty = np.zeros(len(song_ids), dtype=np.int64)
+            return empty, empty.astype(bool)
+
+        rows = np.searchsorted(self.song_ids, song_ids)
+        rows = np.minimum(rows, len(self.song_ids) - 1)
+        return rows, self.song_ids[rows] == song_ids
+
+    def requirement_pairs(self, row):
+        mask = int(self.requirements[row])
+        return [
+            divmod(bit, PROFICIENCY_COUNT)
+            for bit in range(mask.bit_length())
+            if mask >> bit & 1
+        ]
+
+    def memory_footprint(self):
+        footprint = {name: getattr(self, name).nbytes for name in COLUMNS}
+        footprint["strings"] = self.strings.nbytes()
+        footprint["total"] = sum(footprint.values())
+        return footprint
+
+
+def empty_catalog():
+    return Catalog(
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int8),
+        np.empty(0, dtype=np.uint16),
+        np.empty(0, dtype=np.int32),
+        np.empty(0, dtype=np.int32),
+        np.empty(0, dtype=np.int32),
+        np.empty(0, dtype=np.int64),
+        np.empty(0, dtype=np.int64),
+        StringTable(),
+    )
+
+
+def load_catalog(previous=None):
+    # Picks up only songs and requirement rows with ids above the ones
+    # already in `previous`; edits to existing rows need a full reload.
+    previous = previous or empty_catalog()
+
+    # One read transaction, so both selects see the same snapshot: a song
+    # and its requirements committed between them would otherwise leave
+    # requirements for a song this refresh does not have, and the
+    # watermark would move past them.
+    with get_read_database().atomic():
+        songs = list(
+            Song.select(
+                Song.id,
+                Song.name,
+                Album.name,
+                Artist.name,
+                Artist.genre,
+                Album.id,
+                Artist.id,
+            )
+            .join(Album)
+            .join(Artist)
+            .where(Song.id > previous.last_song_id)
+            .order_by(Song.id)
+            .bind(get_read_database())
+            .tuples()
+        )
+        requirements = np.array(
+            list(
+                SongInstrumentProficiency.select(
+                    SongInstrumentProficiency.id,
+                    SongInstrumentProficiency.song,
+                    SongInstrumentProficiency.instrument,
+                    SongInstrumentProficiency.proficiency,
+                )
+                .where(SongInstrumentProficiency.id > previous.last_requirement_id)
+                .bind(get_read_database())
+                .tuples()
+            ),
+            dtype=np.int64,
+        ).reshape(-1, 4)
+
+    if not songs and not len(requirements):
+        previous.refreshed = time.time()
+        return previous
+
+    columns = {name: getattr(previous, name) for name in COLUMNS}
+    last_song_id = previous.last_song_id
+    if songs:
+        (
+            song_ids,
+            song_names,
+            album_names,
+            artist_names,
+            genres,
+            album_ids,
+            artist_ids,
+        ) = zip(*songs)
+        strings = previous.strings
+        added = {
+            "song_ids": np.array(song_ids, dtype=np.int64),
+            "genres": np.array(genres, dtype=np.int8),
+            "requirements": np.zeros(len(songs), dtype=np.uint16),
+            "song_names": strings.intern(song_names),
+            "album_names": strings.intern(album_names),
+            "artist_names": strings.intern(artist_names),
+            "album_ids": np.array(album_ids, dtype=np.int64),
+            "artist_ids": np.array(artist_ids, dtype=np.int64),
+        }
+        columns = {
+            name: np.concatenate((columns[name], added[name])) for name in COLUMNS
+        }
+        last_song_id = int(song_ids[-1])
+    else:
+        columns["requirements"] = columns["requirements"].copy()
+
+    catalog = Catalog(
+        **columns,
+        strings=previous.strings,
+        last_song_id=last_song_id,
+        last_requirement_id=previous.last_requirement_id,
+        version=previous.version + 1,
+    )
+
+    if len(requirements):
+        rows, found = catalog.rows(requirements[:, 1])
+        bits = (requirements[:, 2] * PROFICIENCY_COUNT + requirements[:, 3]).astype(
+            np.uint16
+        )
+        np.bitwise_or.at(
+            catalog.requirements, rows[found], np.left_shift(np.uint16(1), bits[found])
+        )
+        catalog.last_requirement_id = int(requirements[:, 0].max())
+
+    return catalog
+
+
+def initialize_catalog(snapshots=None):
+    # Worker processes follow the shared snapshot rather than refreshing
+    # from the database: a refresh copies every column into private
+    # memory, once per process.
+    global _snapshots
+    _snapshots = snapshots
+
+
+def snapshot_mode():
+    return _snapshots
+
+
+def snapshot_dir():
+    return os.path.join(get_model_dir(), SNAPSHOT_DIR)
+
+
+def snapshot_modified(directory=None):
+    try:
+        return os.stat(
+            os.path.join(directory or snapshot_dir(), SNAPSHOT_MANIFEST)
+        ).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_stale(directory=None):
+    # True when songs or requirement rows were added after the shared
+    # snapshot was written.
+    directory = directory or snapshot_dir()
+    if snapshot_modified(directory) is None:
+        return True
+    manifest = load_json(directory, SNAPSHOT_MANIFEST)
+    last_song_id = Song.select(fn.MAX(Song.id)).bind(get_read_database()).scalar()
+    last_requirement_id = (
+        SongInstrumentProficiency.select(fn.MAX(SongInstrumentProficiency.id))
+        .bind(get_read_database())
+        .scalar()
+    )
+    return (last_song_id or 0) > manifest["last_song_id"] or (
+        last_requirement_id or 0
+    ) > manifest["last_requirement_id"]
+
+
+def save_snapshot(catalog, directory=None, extras=None):
+    # Writes the columns, strings and `extras` as .npy files under fresh
+    # names, then the manifest. Workers map the same files, so the
+    # catalog costs its size once per machine rather than once per
+    # process. Files older than the previous snapshot are removed:
+    # processes still mapping them keep their open inodes, and one that
+    # has just read the previous manifest can still open its files.
+    directory = directory or snapshot_dir()
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.time_ns()
+    previous = set()
+    if snapshot_modified(directory) is not None:
+        previous = set(load_json(directory, SNAPSHOT_MANIFEST)["files"].values())
+
+    encoded = [catalog.strings[code].encode() for code in range(len(catalog.strings))]
+    arrays = {name: getattr(catalog, name) for name in COLUMNS}
+    arrays["string_blob"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    arrays["string_offsets"] = np.concatenate(
+        ([0], np.cumsum([len(value) for value in encoded], dtype=np.int64))
+    )
+    arrays.update(extras or {})
+
+    files = {}
+    for name, array in arrays.items():
+        files[name] = f"{name}.{stamp}.npy"
+        save_array(directory, files[name], array)
+
+    save_json(
+        directory,
+        SNAPSHOT_MANIFEST,
+        {
+            "files": files,
+            "columns": list(COLUMNS),
+            "extras": list(extras or {}),
+            "last_song_id": catalog.last_song_id,
+            "last_requirement_id": catalog.last_requirement_id,
+            # Unique per snapshot, so features built from another one are
+            # never taken for this one's.
+            "version": stamp,
+        },
+    )
+
+    current = set(files.values()) | previous
+    for filename in os.listdir(directory):
+        if filename.endswith(".npy") and filename not in current:
+            os.remove(os.path.join(directory, filename))
+    return files
+
+
+def load_snapshot(directory=None):
+    if directory is None:
+        directory = snapshot_dir()
+        bundle = registry.active_dir()
+        if not os.path.exists(os.path.join(directory, SNAPSHOT_MANIFEST)) and bundle:
+            # No shared snapshot yet: the one saved with the served model is
+            # older, but still spares reading the whole catalog.
+            directory = os.path.join(bundle, registry.CATALOG_DIR)
+    if not os.path.exists(os.path.join(directory, SNAPSHOT_MANIFEST)):
+        return None
+
+    modified = snapshot_modified(directory)
+    manifest = load_json(directory, SNAPSHOT_MANIFEST)
+    if set(manifest["columns"]) != set(COLUMNS):
+        # Written before a column was added: read the catalog instead.
+        return None
+    arrays = load_arrays(directory, manifest["files"])
+    catalog = Catalog(
+        **{name: arrays[name] for name in manifest["columns"]},
+        strings=MappedStrings(arrays["string_blob"], arrays["string_offsets"]),
+        last_song_id=manifest["last_song_id"],
+        last_requirement_id=manifest["last_requirement_id"],
+        version=manifest["version"],
+        extras={name: arrays[name] for name in manifest["extras"]},
+    )
+    catalog.modified = modified
+    return catalog
+
+
+def remap_snapshot(catalog):
+    # Follows the shared snapshot: maps it again once it has been
+    # republished, and otherwise keeps `catalog` as is.
+    modified = snapshot_modified()
+    if modified is not None and modified != catalog.modified:
+        try:
+            snapshot = load_snapshot(snapshot_dir())
+            if snapshot is not None:
+                return snapshot
+        except FileNotFoundError:
+            # Replaced twice while being read; the next check maps it.
+            pass
+    catalog.refreshed = time.time()
+    return catalog
+
+
+def get_catalog():
+    global _catalog
+    catalog = _catalog
+    interval = SNAPSHOT_CHECK_INTERVAL if _snapshots else REFRESH_INTERVAL
+    if catalog is not None and time.time() - catalog.refreshed < interval:
+        return catalog
+
+    # One thread loads or refreshes; while a refresh runs, other callers
+    # keep reading the current snapshot instead of waiting.
+    if catalog is not None and not _catalog_lock.acquire(blocking=False):
+        return catalog
+    if catalog is None:
+        _catalog_lock.acquire()
+
+    try:
+        if _catalog is None:
+            snapshot = load_snapshot()
+            if _snapshots and snapshot is not None:
+                _catalog = snapshot
+            else:
+                # Start from the shared snapshot if there is one and read
+                # only the rows added since it was written.
+                _catalog = load_catalog(snapshot)
+        elif time.time() - _catalog.refreshed >= interval:
+            if _snapshots:
+                _catalog = remap_snapshot(_catalog)
+            else:
+                _catalog = load_catalog(_catalog)
+        return _catalog
+    finally:
+        _catalog_lock.release()
+
+
+def refresh_catalog():
+    global _catalog
+    with _catalog_lock:
+        _catalog = load_catalog(_catalog)
+        return _catalog
@@ -1,11 +1,190 @@
-# TODO: implement collaborative filtering
+import threading
+import numpy as np
+from scipy import sparse
+from app.config import get_read_database
+from app.models import CampaignRecommendation, CampaignRecommendationRating
+from app.recommender.content_filtering import DEFAULT_LIMIT, top_k
 
+NEIGHBOUR_COUNT = 50
+MIN_SIMILARITY = 0.0
+SIMILARITY_BLOCK_SIZE = 1024
 
-def get_recommendations(user):
-    # TODO: implement collaborative filtering
-    return []
+_model = None
+_model_lock = threading.Lock()
 
 
-def get_campaign_recommendations(group):
-    # TODO: implement collaborative filtering
-    return []
+class NeighbourModel:
+    def __init__(self, user_ids, song_ids, ratings, neighbours, similarities):
+        # user_ids and song_ids are sorted; ratings is a CSR user x song
+        # matrix of mean-centred ratings, neighbours/similarities hold the
+        # truncated top-N similar songs for every song (-1 padded).
+        self.user_ids = user_ids
+        self.song_ids = song_ids
+        self.ratings = ratings
+        self.neighbours = neighbours
+        self.similarities = similarities
+
+    def user_index(self, user_id):
+        index = np.searchsorted(self.user_ids, user_id)
+        if index < len(self.user_ids) and self.user_ids[index] == user_id:
+            return int(index)
+        return None
+
+    def user_ratings(self, user_indices):
+        rows = self.ratings[user_indices]
+        return rows.indices, rows.data
+
+
+def load_ratings():
+    rows = np.array(
+        list(
+            CampaignRecommendationRating.select(
+                CampaignRecommendationRating.user,
+                CampaignRecommendation.song,
+                CampaignRecommendationRating.rating,
+            )
+            .join(CampaignRecommendation)
+            .bind(get_read_database())
+            .tuples()
+        ),
+        dtype=np.float64,
+    ).reshape(-1, 3)
+
+    user_ids, user_rows = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    song_ids, song_columns = np.unique(rows[:, 1].astype(np.int64), return_inverse=True)
+
+    # The same song can be recommended in several campaigns, so a user can
+    # rate it more than once; duplicates are averaged.
+    shape = (len(user_ids), len(song_ids))
+    totals = sparse.csr_matrix((rows[:, 2], (user_rows, song_columns)), shape=shape)
+    counts = sparse.csr_matrix(
+        (np.ones(len(rows)), (user_rows, song_columns)), shape=shape
+    )
+    totals.data /= counts.data
+
+    return user_ids, song_ids, totals
+
+
+def center_ratings(ratings):
+    ratings = ratings.astype(np.float32)
+    counts = np.diff(ratings.indptr)
+    means = np.zeros(ratings.shape[0], dtype=np.float32)
+    np.divide(
+        np.asarray(ratings.sum(axis=1)).ravel(), counts, out=means, where=counts > 0
+    )
+    ratings.data -= np.repeat(means, counts)
+    return ratings
+
+
+def build_neighbours(ratings, neighbour_count=NEIGHBOUR_COUNT):
+    song_count = ratings.shape[1]
+    neighbours = np.full((song_count, neighbour_count), -1, dtype=np.int32)
+    similarities = np.zeros((song_count, neighbour_count), dtype=np.float32)
+
+    # Cosine similarity between song columns of the centred matrix,
+    # computed one block of songs at a time so only a sparse
+    # block x catalog slice is ever materialized.
+    items = ratings.T.tocsr()
+    norms = np.sqrt(np.asarray(items.multiply(items).sum(axis=1)).ravel())
+    inverse_norms = np.divide(
+        1.0, norms, out=np.zeros_like(norms), where=norms > 0
+    ).astype(np.float32)
+    items = sparse.diags(inverse_norms) @ items
+    items_t = items.T.tocsc()
+
+    for start in range(0, song_count, SIMILARITY_BLOCK_SIZE):
+        stop = min(start + SIMILARITY_BLOCK_SIZE, song_count)
+        block = (items[start:stop] @ items_t).tocsr()
+
+        for offset in range(stop - start):
+            begin, end = block.indptr[offset], block.indptr[offset + 1]
+            scores = block.data[begin:end]
+            columns = block.indices[begin:end]
+            keep = (scores > MIN_SIMILARITY) & (columns != start + offset)
+            scores, columns = scores[keep], columns[keep]
+
+            top = top_k(scores, neighbour_count)
+            neighbours[start + offset, : len(top)] = columns[top]
+            similarities[start + offset, : len(top)] = scores[top]
+
+    return neighbours, similarities
+
+
+def build_model():
+    user_ids, song_ids, ratings = load_ratings()
+    ratings = center_ratings(ratings)
+    neighbours, similarities = build_neighbours(ratings)
+    return NeighbourModel(user_ids, song_ids, ratings, neighbours, similarities)
+
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = build_model()
+    return _model
+
+
+def refresh_model():
+    global _model
+    model = build_model()
+    with _model_lock:
+        _model = model
+    return model
+
+
+def score(model, rated, deviations, limit):
+    if len(rated) == 0:
+        return []
+
+    # Only the neighbour lists of the rated songs are touched.
+    candidates = model.neighbours[rated].ravel()
+    weights = model.similarities[rated].ravel()
+    contributions = (model.similarities[rated] * deviations[:, None]).ravel()
+
+    valid = (candidates >= 0) & ~np.isin(candidates, rated)
+    candidates, inverse = np.unique(candidates[valid], return_inverse=True)
+    if len(candidates) == 0:
+        return []
+
+    numerator = np.bincount(inverse, weights=contributions[valid])
+    denominator = np.bincount(inverse, weights=np.abs(weights[valid]))
+    scores = numerator / np.maximum(denominator, 1e-9)
+
+    top = top_k(scores, limit)
+    top = top[scores[top] > 0]
+    return [
+        (int(song_id), float(value))
+        for song_id, value in zip(model.song_ids[candidates[top]], scores[top])
+    ]
+
+
+def get_recommendations(user, limit=DEFAULT_LIMIT):
+    model = get_model()
+    index = model.user_index(user.id)
+    if index is None:
+        return []
+
+    rated, deviations = model.user_ratings([index])
+    return score(model, rated, deviations, limit)
+
+
+def get_campaign_recommendations(members, limit=DEFAULT_LIMIT, strategy=None):
+    # Item-item scores are computed from the pooled ratings of the group,
+    # so the member aggregation strategy does not apply here.
+    model = get_model()
+    indices = [
+        index
+        for index in (model.user_index(user_id) for user_id in members.user_ids)
+        if index is not None
+    ]
+    if not indices:
+        return []
+
+    # Pool the members' ratings: a song rated by several members counts
+    # with their average deviation.
+    rated, deviations = model.user_ratings(indices)
+    rated, inverse = np.unique(rated, return_inverse=True)
+    deviations = np.bincount(inverse, weights=deviations) / np.bincount(inverse)
+    return score(model, rated, deviations, limit)
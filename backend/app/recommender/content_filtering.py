@@ -1,11 +1,218 @@
-# TODO: implement content filtering
+import logging
+import threading
+import time
+import numpy as np
+from app.config import get_read_database
+from app.models import (
+    UserGenre,
+    genre_choices,
+    instrument_choices,
+    instrument_proficiency_levels,
+)
+from app.recommender.aggregation import aggregate, coverage, validate_strategy
+from app.recommender.catalog import (
+    REFRESH_INTERVAL,
+    get_catalog,
+    load_catalog,
+    refresh_catalog,
+    save_snapshot,
+    snapshot_mode,
+    snapshot_stale,
+)
 
+DEFAULT_LIMIT = 20
 
-def get_recommendations(user):
-    # TODO: implement content filtering
-    return []
+GENRE_COUNT = len(genre_choices())
+INSTRUMENT_COUNT = len(instrument_choices())
+PROFICIENCY_COUNT = len(instrument_proficiency_levels())
 
+# Song feature layout: one-hot genre followed by one slot per
+# (instrument, proficiency) requirement pair.
+REQUIREMENT_OFFSET = GENRE_COUNT
+FEATURE_SIZE = GENRE_COUNT + INSTRUMENT_COUNT * PROFICIENCY_COUNT
 
-def get_campaign_recommendations(group):
-    # TODO: implement content filtering
-    return []
+GENRE_WEIGHT = 1.0
+MATCHING_LEVEL_WEIGHT = 1.0
+EASIER_LEVEL_WEIGHT = 0.5
+HARDER_LEVEL_PENALTY = -1.0
+
+_features = None
+_features_lock = threading.Lock()
+_publisher = None
+_publisher_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+class SongFeatures:
+    def __init__(self, song_ids, matrix, version):
+        # song_ids is sorted so lookups can use np.searchsorted; version is
+        # the catalog snapshot the matrix was built from.
+        self.song_ids = song_ids
+        self.matrix = matrix
+        self.version = version
+
+    def __len__(self):
+        return len(self.song_ids)
+
+
+def build_features(catalog):
+    matrix = np.zeros((len(catalog), FEATURE_SIZE), dtype=np.float32)
+    matrix[np.arange(len(catalog)), catalog.genres] = 1.0
+
+    bits = np.arange(INSTRUMENT_COUNT * PROFICIENCY_COUNT, dtype=np.uint16)
+    matrix[:, REQUIREMENT_OFFSET:] = (catalog.requirements[:, None] >> bits) & 1
+
+    return SongFeatures(catalog.song_ids, matrix, catalog.version)
+
+
+def get_features():
+    global _features
+    catalog = get_catalog()
+    if _features is None or _features.version != catalog.version:
+        with _features_lock:
+            if _features is None or _features.version != catalog.version:
+                matrix = catalog.extras.get("features")
+                if matrix is not None:
+                    # Mapped from the shared snapshot.
+                    _features = SongFeatures(catalog.song_ids, matrix, catalog.version)
+                else:
+                    _features = build_features(catalog)
+    return _features
+
+
+def refresh_features():
+    global _features
+    features = build_features(refresh_catalog())
+    with _features_lock:
+        _features = features
+    return features
+
+
+def publish_snapshot(directory=None):
+    # Full catalog plus its feature matrix, for worker processes to map.
+    # Read from scratch, so edits to existing songs are included too.
+    catalog = load_catalog()
+    return save_snapshot(
+        catalog, directory, extras={"features": build_features(catalog).matrix}
+    )
+
+
+class SnapshotPublisher:
+    # Runs in one worker process: republishes the shared snapshot once
+    # songs or requirements have been added, and every worker, this one
+    # included, maps the new files (see catalog.get_catalog()).
+    def __init__(self, interval=REFRESH_INTERVAL):
+        self.interval = interval
+        self.thread = threading.Thread(
+            target=self.run, name="catalog-publisher", daemon=True
+        )
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if snapshot_stale():
+                    publish_snapshot()
+            except Exception:
+                logger.exception("Catalog snapshot publish failed")
+
+
+def start_snapshot_publisher():
+    global _publisher
+    if snapshot_mode() != "publish":
+        return None
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = SnapshotPublisher()
+            _publisher.thread.start()
+    return _publisher
+
+
+def profile_matrix(instruments, proficiencies, genres):
+    # One profile row per member; genres is a (members x genres) boolean
+    # matrix of liked genres.
+    instruments = np.asarray(instruments)
+    proficiencies = np.asarray(proficiencies)
+    matrix = np.zeros((len(instruments), FEATURE_SIZE), dtype=np.float32)
+    matrix[:, :GENRE_COUNT] = np.where(genres, GENRE_WEIGHT, 0.0)
+
+    levels = np.arange(PROFICIENCY_COUNT)[None, :]
+    columns = REQUIREMENT_OFFSET + instruments[:, None] * PROFICIENCY_COUNT + levels
+    matrix[np.arange(len(instruments))[:, None], columns] = np.select(
+        [levels == proficiencies[:, None], levels < proficiencies[:, None]],
+        [MATCHING_LEVEL_WEIGHT, EASIER_LEVEL_WEIGHT],
+        HARDER_LEVEL_PENALTY,
+    )
+    return matrix
+
+
+def profile_vector(instrument, proficiency, genres):
+    liked = np.zeros((1, GENRE_COUNT), dtype=bool)
+    liked[0, list(genres)] = True
+    return profile_matrix([instrument], [proficiency], liked)[0]
+
+
+def required_levels(features, rows=None):
+    # Hardest proficiency each song asks of every instrument, -1 if the
+    # song has no part for it.
+    requirements = features.matrix[:, REQUIREMENT_OFFSET:]
+    if rows is not None:
+        requirements = requirements[rows]
+    requirements = requirements.reshape(-1, INSTRUMENT_COUNT, PROFICIENCY_COUNT) > 0
+    levels = np.arange(1, PROFICIENCY_COUNT + 1)
+    return (requirements * levels).max(axis=2) - 1
+
+
+def user_vector(user):
+    genres = [
+        genre
+        for (genre,) in UserGenre.select(UserGenre.genre)
+        .where(UserGenre.user == user)
+        .bind(get_read_database())
+        .tuples()
+    ]
+    return profile_vector(user.instrument, user.proficiency, genres)
+
+
+def top_k(scores, limit):
+    limit = min(limit, len(scores))
+    if limit <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    top = np.argpartition(-scores, limit - 1)[:limit]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def rank(features, vector, limit):
+    return ranked_songs(features.song_ids, features.matrix @ vector, limit)
+
+
+def ranked_songs(song_ids, scores, limit):
+    top = top_k(scores, limit)
+    top = top[scores[top] > 0]
+    return [
+        (int(song_id), float(score))
+        for song_id, score in zip(song_ids[top], scores[top])
+    ]
+
+
+def get_recommendations(user, limit=DEFAULT_LIMIT):
+    return rank(get_features(), user_vector(user), limit)
+
+
+def get_campaign_recommendations(members, limit=DEFAULT_LIMIT, strategy=None):
+    strategy = validate_strategy(strategy)
+    if len(members) == 0:
+        return []
+
+    features = get_features()
+    weights = None
+    if strategy == "instrument_coverage":
+        weights = coverage(required_levels(features), members, INSTRUMENT_COUNT)
+
+    member_vectors = profile_matrix(
+        members.instruments, members.proficiencies, members.genres
+    )
+    scores = aggregate(features.matrix, member_vectors, strategy, weights)
+    return ranked_songs(features.song_ids, scores, limit)
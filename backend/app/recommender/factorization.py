@@ -0,0 +1,278 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+from app.recommender import registry
+from app.recommender.aggregation import aggregate, coverage, validate_strategy
+from app.recommender.ann import load_index
+from app.recommender.artifacts import load_arrays, load_json, save_array, save_json
+from app.recommender.content_filtering import (
+    DEFAULT_LIMIT,
+    INSTRUMENT_COUNT,
+    get_features,
+    ranked_songs,
+    required_levels,
+    top_k,
+)
+
+MANIFEST_FILE = registry.MANIFEST_FILE
+MODEL_CHECK_INTERVAL = 5
+# The index is searched for this many times the requested songs, which
+# are then re-scored with the factors currently served.
+RESCORE_MULTIPLIER = 4
+
+logger = logging.getLogger(__name__)
+
+_model = None
+_checked = 0
+_model_lock = threading.Lock()
+_overlay = None
+_overlay_lock = threading.Lock()
+
+
+class FactorModel:
+    def __init__(
+        self, manifest, user_ids, song_ids, user_factors, song_factors, index=None
+    ):
+        self.manifest = manifest
+        self.user_ids = user_ids
+        self.song_ids = song_ids
+        self.user_factors = user_factors
+        self.song_factors = song_factors
+        self.index = index
+        # Bundle the files were mapped from, and the manifest's mtime there.
+        self.directory = None
+        self.modified = None
+
+    @property
+    def version(self):
+        return self.manifest["version"]
+
+    def user_indices(self, user_ids):
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        indices = np.searchsorted(self.user_ids, user_ids)
+        indices = np.minimum(indices, len(self.user_ids) - 1)
+        return indices[self.user_ids[indices] == user_ids]
+
+
+class FactorOverlay:
+    # Factors refreshed from ratings that arrived after `version` was
+    # trained (see recommender/online.py). Entries are replaced, never
+    # modified in place, so readers need no lock.
+    def __init__(self, version, last_rating_seq=None):
+        self.version = version
+        # Ratings up to this updated_seq are already reflected.
+        self.last_rating_seq = last_rating_seq
+        self.users = {}
+        self.songs = {}
+        self.updates = 0
+
+
+def get_overlay(model):
+    # Starts empty whenever a different model version is being served.
+    global _overlay
+    if _overlay is None or _overlay.version != model.version:
+        with _overlay_lock:
+            if _overlay is None or _overlay.version != model.version:
+                _overlay = FactorOverlay(
+                    model.version,
+                    # Recorded as a row id before ratings had a sequence;
+                    # the migration numbered existing rows by id.
+                    model.manifest.get(
+                        "last_rating_seq", model.manifest.get("last_rating_id")
+                    ),
+                )
+    return _overlay
+
+
+def user_vectors(model, user_ids):
+    overlay = get_overlay(model)
+    vectors = []
+    for user_id in user_ids:
+        vector = overlay.users.get(user_id)
+        if vector is None:
+            indices = model.user_indices([user_id])
+            if len(indices) == 0:
+                continue
+            vector = model.user_factors[indices[0]]
+        vectors.append(vector)
+    return np.array(vectors, dtype=np.float32).reshape(-1, model.user_factors.shape[1])
+
+
+def write_artifacts(model_dir, arrays, manifest):
+    os.makedirs(model_dir, exist_ok=True)
+
+    files = {}
+    for name, array in arrays.items():
+        files[name] = f"{name}.npy"
+        save_array(model_dir, files[name], array)
+
+    # The manifest is written last so readers never see a manifest that
+    # points at files which are still being written.
+    manifest = dict(manifest, files=files)
+    save_json(model_dir, MANIFEST_FILE, manifest)
+    return manifest
+
+
+def load_model(model_dir):
+    manifest = load_json(model_dir, MANIFEST_FILE)
+    arrays = load_arrays(model_dir, manifest["files"])
+    index = None
+    if manifest.get("index"):
+        index = load_index(os.path.join(model_dir, manifest["index"]))
+
+    return FactorModel(
+        manifest,
+        arrays["user_ids"],
+        arrays["song_ids"],
+        arrays["user_factors"],
+        arrays["song_factors"],
+        index,
+    )
+
+
+def get_model():
+    # Re-checks the registry's current bundle every MODEL_CHECK_INTERVAL
+    # seconds, so a retrain, a rollback or a compaction in another worker
+    # process is picked up without a restart. The new model replaces the
+    # old one in a single assignment: requests already holding the old
+    # one finish with it, and its files stay mapped until they do.
+    global _model, _checked
+    model = _model
+    if model is not None and time.monotonic() - _checked < MODEL_CHECK_INTERVAL:
+        return model
+
+    # While one thread loads a new bundle, others keep serving the current
+    # model instead of waiting.
+    if model is not None and not _model_lock.acquire(blocking=False):
+        return model
+    if model is None:
+        _model_lock.acquire()
+
+    try:
+        if _model is None or time.monotonic() - _checked >= MODEL_CHECK_INTERVAL:
+            _checked = time.monotonic()
+            directory = registry.active_dir()
+            if directory is None:
+                return _model
+            try:
+                modified = os.stat(os.path.join(directory, MANIFEST_FILE)).st_mtime_ns
+            except FileNotFoundError:
+                return _model
+            if (
+                _model is None
+                or _model.directory != directory
+                or _model.modified != modified
+            ):
+                try:
+                    model = load_model(directory)
+                except Exception:
+                    # A bundle that cannot be loaded never replaces a
+                    # working model; the check repeats next interval.
+                    logger.exception("Could not load model from %s", directory)
+                    return _model
+                model.directory = directory
+                model.modified = modified
+                _model = model
+        return _model
+    finally:
+        _model_lock.release()
+
+
+def reload_model():
+    # Checks for a new current bundle now rather than at the next interval;
+    # the served model stays in place until its replacement has loaded.
+    global _checked
+    with _model_lock:
+        _checked = 0
+    return get_model()
+
+
+def model_version():
+    model = get_model()
+    return model.version if model is not None else "untrained"
+
+
+def score(model, vector, limit):
+    # Songs whose factors changed online are always scored with their new
+    # factors. A copy, as the updater thread may add songs meanwhile.
+    updated = get_overlay(model).songs.copy()
+    updated_ids = np.fromiter(updated, dtype=np.int64, count=len(updated))
+    updated_vectors = np.array(list(updated.values()), dtype=np.float32).reshape(
+        -1, model.song_factors.shape[1]
+    )
+
+    if model.index is not None:
+        # The index holds the song vectors it was built with: candidates
+        # are re-scored with the served factors, and updated songs are
+        # candidates whether or not the index found them.
+        song_ids, _ = model.index.search(vector, limit * RESCORE_MULTIPLIER)
+        song_ids = np.union1d(song_ids, updated_ids)
+        vectors = np.array(
+            model.song_factors[np.searchsorted(model.song_ids, song_ids)],
+            dtype=np.float32,
+        )
+        vectors[np.searchsorted(song_ids, updated_ids)] = updated_vectors
+        scores = vectors @ vector
+    else:
+        song_ids = model.song_ids
+        scores = model.song_factors @ vector
+        scores[np.searchsorted(song_ids, updated_ids)] = updated_vectors @ vector
+
+    top = top_k(scores, limit)
+    song_ids, scores = song_ids[top], scores[top]
+
+    return [
+        (int(song_id), float(value))
+        for song_id, value in zip(song_ids, scores)
+        if value > 0
+    ]
+
+
+def get_recommendations(user, limit=DEFAULT_LIMIT):
+    model = get_model()
+    if model is None:
+        return []
+
+    vectors = user_vectors(model, [user.id])
+    if len(vectors) == 0:
+        return []
+
+    return score(model, vectors[0], limit)
+
+
+def song_required_levels(model):
+    # Requirements come from the content features, aligned to the factor
+    # model's song order; songs unknown to the catalog have no parts.
+    features = get_features()
+    rows = np.searchsorted(features.song_ids, model.song_ids)
+    rows = np.minimum(rows, len(features.song_ids) - 1)
+    known = features.song_ids[rows] == model.song_ids
+
+    levels = np.full((len(model.song_ids), INSTRUMENT_COUNT), -1)
+    levels[known] = required_levels(features, rows[known])
+    return levels
+
+
+def get_campaign_recommendations(members, limit=DEFAULT_LIMIT, strategy=None):
+    strategy = validate_strategy(strategy)
+    model = get_model()
+    if model is None:
+        return []
+
+    member_vectors = user_vectors(model, members.user_ids)
+    if len(member_vectors) == 0:
+        return []
+
+    if strategy == "average" and model.index is not None:
+        # The mean of dot products is the dot product with the mean
+        # vector, so averaging can use the index.
+        return score(model, member_vectors.mean(axis=0), limit)
+
+    weights = None
+    if strategy == "instrument_coverage":
+        weights = coverage(song_required_levels(model), members, INSTRUMENT_COUNT)
+
+    scores = aggregate(model.song_factors, member_vectors, strategy, weights)
+    return ranked_songs(model.song_ids, scores, limit)
@@ -1,38 +1,198 @@
-from app.recommender.content_filtering import get_recommendations as content_filtering
-from app.recommender.collaborative_filtering import get_recommendations as collaborative_filtering
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from app.config import get_recommender_config
+from app.models import (
+    genre_choices,
+    instrument_choices,
+    instrument_proficiency_levels,
+)
+from app.recommender.aggregation import group_members, validate_strategy
+from app.recommender.catalog import get_catalog
+from app.recommender.content_filtering import (
+    DEFAULT_LIMIT,
+    get_recommendations as content_filtering,
+    get_campaign_recommendations as content_campaign_filtering,
+)
+from app.recommender.collaborative_filtering import (
+    get_recommendations as collaborative_filtering,
+    get_campaign_recommendations as collaborative_campaign_filtering,
+)
+from app.recommender.factorization import (
+    get_recommendations as factorization,
+    get_campaign_recommendations as factorization_campaign,
+)
 
+# Each engine returns this many times the requested number of songs so
+# that fusion has overlapping candidates to rerank.
+CANDIDATE_MULTIPLIER = 3
 
-def hybrid_recommendations(user):
-    content_based = content_filtering(user)
-    collaborative = collaborative_filtering(user)
-    combined_recommendations = list(set(content_based + collaborative))
+logger = logging.getLogger(__name__)
 
-    # TODO: return combined recommendations
-    return [
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_recommender_config()["workers"],
+                    thread_name_prefix="recommender",
+                )
+    return _executor
+
+
+def normalize(scores, method):
+    if len(scores) == 0 or method == "none":
+        return scores
+
+    if method == "zscore":
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+
+    if method == "rank":
+        # Reciprocal rank: engines only need to agree on ordering.
+        return 1.0 / (1.0 + np.argsort(np.argsort(-scores)))
+
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def fuse(results, weights, normalization):
+    song_ids = []
+    scores = []
+    for name, result in results.items():
+        if not result or not weights.get(name):
+            continue
+
+        ids, values = zip(*result)
+        song_ids.append(np.array(ids, dtype=np.int64))
+        scores.append(weights[name] * normalize(np.array(values), normalization))
+
+    if not song_ids:
+        return []
+
+    song_ids, inverse = np.unique(np.concatenate(song_ids), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate(scores))
+    order = np.argsort(-totals, kind="stable")
+    return [(int(song_ids[i]), float(totals[i])) for i in order]
+
+
+def run_engines(engines, *args):
+    deadline = get_recommender_config()["deadline_ms"] / 1000
+    executor = get_executor()
+    futures = {executor.submit(engine, *args): name for name, engine in engines.items()}
+
+    # Returns as soon as every engine is done, and at the deadline with
+    # whichever engines made it; the deadline bounds the whole call.
+    done, pending = wait(futures, timeout=deadline)
+
+    results = {}
+    for future in done:
+        name = futures[future]
+        try:
+            results[name] = future.result()
+        except Exception:
+            logger.exception("Recommender engine %s failed", name)
+
+    for future in pending:
+        # Already-running engines cannot be interrupted; they finish in the
+        # background and their result is dropped.
+        future.cancel()
+        logger.warning(
+            "Recommender engine %s missed the %dms deadline",
+            futures[future],
+            deadline * 1000,
+        )
+
+    return results
+
+
+def rank(engines, limit, *args):
+    config = get_recommender_config()
+    results = run_engines(engines, *args)
+    return fuse(results, config["weights"], config["normalization"])[:limit]
+
+
+def serialize_songs(ranked, instrument=None):
+    catalog = get_catalog()
+    song_ids = np.array([song_id for song_id, _ in ranked], dtype=np.int64)
+    rows, found = catalog.rows(song_ids)
+
+    genres = dict(genre_choices())
+    instruments = dict(instrument_choices())
+    proficiencies = dict(instrument_proficiency_levels())
+    strings = catalog.strings
+
+    result = []
+    for (song_id, score), row, exists in zip(ranked, rows, found):
+        if not exists:
+            continue
+
+        # Show the part for the requested instrument when the song has one.
+        parts = catalog.requirement_pairs(row)
+        song_instrument, proficiency = next(
+            (part for part in parts if part[0] == instrument),
+            parts[0] if parts else (None, None),
+        )
+        result.append(
+            {
+                "id": song_id,
+                "name": strings[catalog.song_names[row]],
+                "artist": strings[catalog.artist_names[row]],
+                "album": strings[catalog.album_names[row]],
+                "genre": genres.get(int(catalog.genres[row])),
+                "instrument": instruments.get(song_instrument),
+                "proficiency": proficiencies.get(proficiency),
+                "score": score,
+            }
+        )
+    return result
+
+
+def rank_user(user, limit=DEFAULT_LIMIT):
+    candidates = limit * CANDIDATE_MULTIPLIER
+    return rank(
         {
-            "id": 1,
-            "name": "Song 1",
-            "artist": "Artist 1",
-            "album": "Album 1",
-            "genre": "Genre 1",
-            "instrument": "Guitar",
-            "proficiency": "Beginner",
+            "content": content_filtering,
+            "collaborative": collaborative_filtering,
+            "factorization": factorization,
         },
+        limit,
+        user,
+        candidates,
+    )
+
+
+def rank_group(group, limit=DEFAULT_LIMIT, strategy=None):
+    strategy = validate_strategy(strategy or get_recommender_config()["group_strategy"])
+    members = group_members(group)
+    if len(members) == 0:
+        return []
+
+    candidates = limit * CANDIDATE_MULTIPLIER
+    return rank(
         {
-            "id": 2,
-            "name": "Song 2",
-            "artist": "Artist 2",
-            "album": "Album 2",
-            "genre": "Genre 2",
-            "instrument": "Guitar",
-            "proficiency": "Intermediate",
+            "content": content_campaign_filtering,
+            "collaborative": collaborative_campaign_filtering,
+            "factorization": factorization_campaign,
         },
-    ]
+        limit,
+        members,
+        candidates,
+        strategy,
+    )
+
 
+def hybrid_recommendations(user, limit=DEFAULT_LIMIT):
+    return serialize_songs(rank_user(user, limit), instrument=user.instrument)
 
-def hybrid_campaign_recommendations(group):
-    content_based = content_filtering(group)
-    collaborative = collaborative_filtering(group)
-    combined_recommendations = list(set(content_based + collaborative))
 
-    return combined_recommendations
+def hybrid_campaign_recommendations(group, limit=DEFAULT_LIMIT, strategy=None):
+    return [song_id for song_id, _ in rank_group(group, limit, strategy)]
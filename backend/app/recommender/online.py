@@ -0,0 +1,338 @@
+import datetime
+import logging
+import os
+import threading
+import time
+import numpy as np
+from peewee import fn
+from app.cache import invalidate_user
+from app.config import get_database, get_model_dir, get_read_database
+from app.metrics import histogram, register_gauges
+from app.models import CampaignRecommendation, CampaignRecommendationRating
+from app.ratings import subscribe
+from app.recommender import registry
+from app.recommender.ann import IVFIndex, save_index
+from app.recommender.factorization import (
+    get_model,
+    get_overlay,
+    reload_model,
+    write_artifacts,
+)
+
+# Step size and number of SGD steps applied to a song's factors per new
+# rating; user factors are re-solved exactly instead.
+DEFAULT_LEARNING_RATE = 0.05
+SGD_STEPS = 3
+# Refreshed factors are folded into a new model artifact this often.
+DEFAULT_COMPACT_INTERVAL = 15 * 60
+# Seconds between polls of the rating table, and ratings read per poll.
+POLL_INTERVAL = 5
+POLL_BATCH = 5000
+
+logger = logging.getLogger(__name__)
+
+update_duration = histogram(
+    "online_update_duration_seconds",
+    "Time to apply one flushed batch of ratings to the factor model",
+)
+
+
+class OnlineUpdater:
+    # Runs on its own thread and follows the rating table by updated_seq,
+    # so every worker process applies every new rating and re-rate,
+    # whichever process accepted it.
+    # Local rating flushes only wake it up early.
+    def __init__(self):
+        self.learning_rate = DEFAULT_LEARNING_RATE
+        self.compact_interval = DEFAULT_COMPACT_INTERVAL
+        self.compaction = True
+        self.wake = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {
+            "batches": 0,
+            "ratings": 0,
+            "skipped": 0,
+            "compactions": 0,
+            "failures": 0,
+        }
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="online-updates", daemon=True
+                )
+                self.thread.start()
+
+    def notify(self, batch):
+        self.wake.set()
+
+    def count(self, name, delta=1):
+        with self.lock:
+            self.counters[name] += delta
+
+    def run(self):
+        compact_after = time.monotonic() + self.compact_interval
+        while True:
+            timeout = POLL_INTERVAL
+            if self.compaction:
+                timeout = min(timeout, max(0, compact_after - time.monotonic()))
+            self.wake.wait(timeout)
+            self.wake.clear()
+            try:
+                with get_database().connection_context():
+                    while self.poll():
+                        pass
+                    if self.compaction and time.monotonic() >= compact_after:
+                        compact_after = time.monotonic() + self.compact_interval
+                        self.compact()
+            except Exception:
+                self.count("failures")
+                logger.exception("Online model update failed")
+
+    def poll(self):
+        # Applies the next batch of ratings after the overlay's watermark;
+        # returns True while more are waiting.
+        model = get_model()
+        if model is None:
+            return False
+
+        overlay = get_overlay(model)
+        if overlay.last_rating_seq is None:
+            # Models trained before the watermark was recorded start from
+            # the ratings that arrive from now on.
+            overlay.last_rating_seq = (
+                CampaignRecommendationRating.select(
+                    fn.MAX(CampaignRecommendationRating.updated_seq)
+                )
+                .bind(get_read_database())
+                .scalar()
+                or 0
+            )
+
+        rows = list(
+            CampaignRecommendationRating.select(
+                CampaignRecommendationRating.updated_seq,
+                CampaignRecommendationRating.user,
+                CampaignRecommendation.song,
+                CampaignRecommendationRating.rating,
+            )
+            .join(CampaignRecommendation)
+            .where(CampaignRecommendationRating.updated_seq > overlay.last_rating_seq)
+            .order_by(CampaignRecommendationRating.updated_seq)
+            .limit(POLL_BATCH)
+            .bind(get_read_database())
+            .tuples()
+        )
+        if not rows:
+            return False
+
+        self.apply(model, overlay, rows)
+        overlay.last_rating_seq = rows[-1][0]
+        return len(rows) == POLL_BATCH
+
+    def apply(self, model, overlay, rows):
+        started = time.perf_counter()
+        global_mean = model.manifest.get("global_mean", 0.0)
+        regularization = model.manifest["regularization"]
+
+        by_user = {}
+        for _, user_id, song_id, rating in rows:
+            by_user.setdefault(user_id, []).append((song_id, rating))
+
+        applied = 0
+        for user_id, ratings in by_user.items():
+            vector = self.fold_in(model, overlay, user_id, regularization, global_mean)
+            if vector is None:
+                continue
+            overlay.users[user_id] = vector
+
+            # With the user's factors settled, nudge each newly rated
+            # song's factors towards explaining the rating.
+            for song_id, rating in ratings:
+                song_vector = self.song_vector(model, overlay, song_id)
+                if song_vector is None:
+                    continue
+                overlay.songs[song_id] = self.sgd(
+                    song_vector, vector, rating - global_mean, regularization
+                )
+                applied += 1
+
+        overlay.updates += applied
+        self.count("batches")
+        self.count("ratings", applied)
+        self.count("skipped", len(rows) - applied)
+        update_duration.observe(time.perf_counter() - started)
+
+        # Cached recommendations in this process were built from the old
+        # factors. Every process applies these ratings and invalidates for
+        # itself.
+        for user_id in by_user:
+            invalidate_user(user_id, publish=False)
+
+    def song_vector(self, model, overlay, song_id):
+        vector = overlay.songs.get(song_id)
+        if vector is not None:
+            return vector
+        index = np.searchsorted(model.song_ids, song_id)
+        if index < len(model.song_ids) and model.song_ids[index] == song_id:
+            return np.array(model.song_factors[index])
+        # Songs the model has never seen need a full retrain.
+        return None
+
+    def fold_in(self, model, overlay, user_id, regularization, global_mean):
+        # Same regularized least squares as one ALS step in train_model.py,
+        # over all of this user's ratings against the current song factors.
+        song_vectors = []
+        values = []
+        for song_id, rating in (
+            CampaignRecommendationRating.select(
+                CampaignRecommendation.song, fn.AVG(CampaignRecommendationRating.rating)
+            )
+            .join(CampaignRecommendation)
+            .where(CampaignRecommendationRating.user == user_id)
+            .group_by(CampaignRecommendation.song)
+            .bind(get_read_database())
+            .tuples()
+        ):
+            vector = self.song_vector(model, overlay, song_id)
+            if vector is not None:
+                song_vectors.append(vector)
+                values.append(rating - global_mean)
+        if not song_vectors:
+            return None
+
+        song_vectors = np.array(song_vectors, dtype=np.float32)
+        gram = song_vectors.T @ song_vectors + regularization * len(values) * np.eye(
+            song_vectors.shape[1], dtype=np.float32
+        )
+        rhs = song_vectors.T @ np.array(values, dtype=np.float32)
+        return np.linalg.solve(gram, rhs).astype(np.float32)
+
+    def sgd(self, song_vector, user_vector, value, regularization):
+        for _ in range(SGD_STEPS):
+            error = value - float(song_vector @ user_vector)
+            song_vector = song_vector + self.learning_rate * (
+                error * user_vector - regularization * song_vector
+            )
+        return song_vector.astype(np.float32)
+
+    def compact(self):
+        model = get_model()
+        if model is None:
+            return None
+        overlay = get_overlay(model)
+        if not overlay.users and not overlay.songs:
+            return None
+
+        # Users first seen since training are merged into the sorted ids.
+        new_users = np.array(
+            sorted(set(overlay.users) - set(model.user_ids.tolist())), dtype=np.int64
+        )
+        user_ids = np.union1d(model.user_ids, new_users)
+        user_factors = np.zeros(
+            (len(user_ids), model.user_factors.shape[1]), dtype=np.float32
+        )
+        user_factors[np.searchsorted(user_ids, model.user_ids)] = model.user_factors
+        for user_id, vector in overlay.users.items():
+            user_factors[np.searchsorted(user_ids, user_id)] = vector
+
+        song_factors = np.array(model.song_factors, dtype=np.float32)
+        for song_id, vector in overlay.songs.items():
+            song_factors[np.searchsorted(model.song_ids, song_id)] = vector
+
+        # The catalog snapshot is shared with the base bundle. The index
+        # keeps its lists, rebuilt only by the next full retrain, but gets
+        # the updated song vectors.
+        version = registry.new_version()
+        manifest = {
+            key: value for key, value in model.manifest.items() if key != "files"
+        }
+        bundle = registry.start_bundle()
+        try:
+            if manifest.get("index") and model.index is not None:
+                index = model.index
+                rows = np.searchsorted(model.song_ids, index.ids)
+                save_index(
+                    IVFIndex(
+                        index.centroids,
+                        index.offsets,
+                        index.ids,
+                        song_factors[rows],
+                        index.nprobe,
+                    ),
+                    os.path.join(bundle, manifest["index"]),
+                )
+            else:
+                manifest["index"] = None
+            catalog = manifest.get("catalog")
+            if catalog and not registry.link_files(model.directory, bundle, catalog):
+                manifest["catalog"] = None
+            manifest = write_artifacts(
+                bundle,
+                {
+                    "user_ids": user_ids,
+                    "song_ids": model.song_ids,
+                    "user_factors": user_factors,
+                    "song_factors": song_factors,
+                },
+                dict(
+                    manifest,
+                    version=version,
+                    created=datetime.datetime.now().isoformat(),
+                    base_version=model.manifest.get("base_version", model.version),
+                    last_rating_seq=overlay.last_rating_seq,
+                    online_updates=model.manifest.get("online_updates", 0)
+                    + overlay.updates,
+                    users=len(user_ids),
+                ),
+            )
+            # Activated only if nobody published or rolled back meanwhile.
+            registry.publish(
+                bundle,
+                version,
+                expected=model.version if model.directory != get_model_dir() else None,
+            )
+        except BaseException:
+            registry.discard_bundle(bundle)
+            raise
+        reload_model()
+        self.count("compactions")
+        logger.info(
+            "Compacted %d online updates into model %s",
+            overlay.updates,
+            manifest["version"],
+        )
+        return manifest
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        model = get_model()
+        if model is not None:
+            overlay = get_overlay(model)
+            stats.update(
+                overlay_users=len(overlay.users),
+                overlay_songs=len(overlay.songs),
+                last_rating_seq=overlay.last_rating_seq or 0,
+            )
+        return stats
+
+
+_updater = OnlineUpdater()
+
+
+def initialize_online(learning_rate=None, compact_interval=None, compaction=True):
+    _updater.learning_rate = learning_rate or DEFAULT_LEARNING_RATE
+    _updater.compact_interval = compact_interval or DEFAULT_COMPACT_INTERVAL
+    # With several worker processes only one of them writes artifacts.
+    _updater.compaction = compaction
+
+
+def start_online_updates():
+    _updater.start()
+
+
+subscribe(_updater.notify)
+register_gauges("online_updates", "Incremental factor model updates", _updater.stats)
@@ -0,0 +1,189 @@
+import datetime
+import os
+import shutil
+import uuid
+from app.config import get_model_dir
+from app.recommender.artifacts import load_json
+
+# MODEL_DIR/versions/<version>/ holds one immutable bundle: manifest.json,
+# the factor arrays, the song index and a catalog snapshot.
+# MODEL_DIR/CURRENT names the bundle being served; replacing that file is
+# the only step of a publish or rollback that running processes see.
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+CATALOG_DIR = "catalog"
+# Training runs whose bundles are kept on disk for rollback. Online
+# compaction derives further bundles from a run (see recommender/online.py);
+# of those only the newest is kept.
+DEFAULT_KEEP = 5
+
+MISSING = object()
+
+
+class RegistryError(Exception):
+    pass
+
+
+def versions_dir(model_dir=None):
+    return os.path.join(model_dir or get_model_dir(), VERSIONS_DIR)
+
+
+def bundle_dir(version, model_dir=None):
+    return os.path.join(versions_dir(model_dir), version)
+
+
+def list_versions(model_dir=None):
+    # Oldest first; version names sort by creation time.
+    directory = versions_dir(model_dir)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if not name.startswith(".")
+        and os.path.exists(os.path.join(directory, name, MANIFEST_FILE))
+    )
+
+
+def base_version(version, model_dir=None):
+    # The trained bundle a compacted one derives from; its own version for
+    # a trained bundle.
+    manifest = load_json(bundle_dir(version, model_dir), MANIFEST_FILE)
+    return manifest.get("base_version", version)
+
+
+def current_version(model_dir=None):
+    try:
+        with open(os.path.join(model_dir or get_model_dir(), CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def active_dir(model_dir=None):
+    # Directory of the bundle to serve, or None before the first publish.
+    # A model written by an older train_model.py straight into MODEL_DIR is
+    # still served until a versioned bundle replaces it.
+    model_dir = model_dir or get_model_dir()
+    version = current_version(model_dir)
+    if version is not None:
+        return bundle_dir(version, model_dir)
+    if os.path.exists(os.path.join(model_dir, MANIFEST_FILE)):
+        return model_dir
+    return None
+
+
+def new_version(model_dir=None):
+    version = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    existing = set(list_versions(model_dir))
+    candidate, suffix = version, 1
+    while candidate in existing:
+        candidate = f"{version}-{suffix}"
+        suffix += 1
+    return candidate
+
+
+def start_bundle(model_dir=None):
+    # Bundles are assembled in a hidden directory and renamed into place,
+    # so a half-written bundle is never listed or activated.
+    path = os.path.join(versions_dir(model_dir), f".tmp-{uuid.uuid4().hex}")
+    os.makedirs(path)
+    return path
+
+
+def discard_bundle(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def link_files(source, destination, name):
+    # Shares an unchanged part (index, catalog) of an older bundle with a
+    # new one: hard links where possible, otherwise a copy.
+    source = os.path.join(source, name)
+    if not os.path.exists(source):
+        return False
+    shutil.copytree(
+        source,
+        os.path.join(destination, name),
+        copy_function=link_or_copy,
+    )
+    return True
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def publish(
+    path, version, model_dir=None, activate=True, expected=MISSING, keep=DEFAULT_KEEP
+):
+    # With `expected`, the bundle only becomes current if that version still
+    # is, so a derived bundle never replaces one activated in the meantime.
+    final = bundle_dir(version, model_dir)
+    if os.path.exists(final):
+        raise RegistryError(f"Model version {version} already exists")
+    os.rename(path, final)
+    if activate and (expected is MISSING or current_version(model_dir) == expected):
+        set_current(version, model_dir)
+    prune(keep, model_dir)
+    return final
+
+
+def set_current(version, model_dir=None):
+    model_dir = model_dir or get_model_dir()
+    if not os.path.exists(os.path.join(bundle_dir(version, model_dir), MANIFEST_FILE)):
+        raise RegistryError(f"Unknown model version {version}")
+
+    path = os.path.join(model_dir, CURRENT_FILE)
+    with open(path + ".tmp", "w") as f:
+        f.write(version + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def rollback(version=None, model_dir=None):
+    # Without a version, goes back to the newest bundle of an earlier
+    # training run: compactions of the current run carry its problems.
+    if version is None:
+        current = current_version(model_dir)
+        if current is None:
+            raise RegistryError("No model version is active")
+        base = base_version(current, model_dir)
+        older = [
+            name
+            for name in list_versions(model_dir)
+            if name < current and base_version(name, model_dir) != base
+        ]
+        if not older:
+            raise RegistryError("No earlier training run to roll back to")
+        version = older[-1]
+    set_current(version, model_dir)
+    return version
+
+
+def prune(keep=DEFAULT_KEEP, model_dir=None):
+    # Keeps, for the newest `keep` training runs and the current one, the
+    # trained bundle and the newest compaction; older compactions of a run
+    # are superseded by its newest. Removing a bundle is safe while
+    # processes still map its files: the open inodes live on until they
+    # are unmapped.
+    current = current_version(model_dir)
+    bases = {name: base_version(name, model_dir) for name in list_versions(model_dir)}
+    runs = sorted(set(bases.values()))
+    kept_runs = set(runs[max(0, len(runs) - keep) :])
+    if current in bases:
+        kept_runs.add(bases[current])
+
+    newest = {}
+    for name in sorted(bases):
+        newest[bases[name]] = name
+    kept = {current}
+    for base in kept_runs:
+        kept.update((base, newest[base]))
+
+    removed = [name for name in sorted(bases) if name not in kept]
+    for name in removed:
+        shutil.rmtree(bundle_dir(name, model_dir), ignore_errors=True)
+    return removed
@@ -3,20 +3,54 @@ from ..models import (
     Campaign,
     CampaignRecommendation,
     CampaignRecommendationRating,
-    User,
 )
 import datetime
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, g, request, url_for
+from ..config import get_database, get_read_database
+from ..jobs import get_job, submit, to_dict
+from ..ratings import add_rating
 from ..utils import generate_campaign_recommendations, api_response, api_error
+from ..admission import admit_group, coalesce
+from ..conditional import conditional
 from ..middleware import auth_required
+from ..recommender.aggregation import STRATEGIES
+from ..pagination import list_response
+from ..serializers import (
+    campaign_ratings,
+    campaign_recommendations,
+    find_campaign,
+    serialize_campaign,
+    serialize_ratings,
+    serialize_recommendation_page,
+)
 
 bp = Blueprint("campaign", __name__, url_prefix="/api/campaign")
 
 
+def generate_campaign(group_id, name, due_date, strategy, admission):
+    with admission:
+        group = Group.get(Group.id == group_id)
+        song_ids = generate_campaign_recommendations(group, strategy)
+
+    with get_database().atomic():
+        campaign = Campaign.create(
+            name=name,
+            created_date=datetime.datetime.now(),
+            due_date=due_date,
+            group=group,
+        )
+        if song_ids:
+            CampaignRecommendation.insert_many(
+                [{"campaign": campaign.id, "song": song_id} for song_id in song_ids]
+            ).execute()
+
+    return {"campaign_id": campaign.id, "recommendations": len(song_ids)}
+
+
 @bp.route("/<int:group_id>", methods=["POST"])
 @auth_required
 def create_campaign(group_id):
-    group = Group.get(Group.id == group_id)
+    group = Group.get_or_none(Group.id == group_id)
     if not group:
         return api_error("Group not found", status_code=404)
 
@@ -33,42 +67,86 @@ def create_campaign(group_id):
     except ValueError:
         return api_error("Invalid due date", status_code=400)
 
-    campaign = Campaign.create(
-        name=name,
-        created_date=datetime.datetime.now(),
-        due_date=due_date,
-        group=group,
-    )
+    strategy = request.json.get("strategy")
+    if strategy is not None and strategy not in STRATEGIES:
+        return api_error("Invalid strategy", status_code=400)
 
-    campaign_recommendations = generate_campaign_recommendations(group)
-    for recommendation in campaign_recommendations:
-        CampaignRecommendation.create(
-            campaign=campaign,
-            song=recommendation,
+    # Admitted here rather than in the job, so an overloaded server answers
+    # 503 instead of queueing jobs; the job releases the slots when done.
+    admission = admit_group()
+    try:
+        job = submit(
+            "campaign", generate_campaign, group.id, name, due_date, strategy, admission
         )
+    except BaseException:
+        admission.release()
+        raise
+    status_url = url_for("campaign.get_campaign_job", job_id=job.id)
+
+    response, status_code = api_response(
+        data={"job_id": job.id, "status_url": status_url},
+        message="Campaign generation started",
+        status_code=202,
+    )
+    response.headers["Location"] = status_url
+    return response, status_code
 
-    return api_response(message="Campaign created", status_code=201)
+
+@bp.route("/jobs/<string:job_id>", methods=["GET"])
+@auth_required
+def get_campaign_job(job_id):
+    job = get_job(job_id)
+    if not job:
+        return api_error("Job not found", status_code=404)
+
+    return api_response(data=to_dict(job), message="Job retrieved", status_code=200)
 
 
 @bp.route("/<int:group_id>/<int:campaign_id>", methods=["GET"])
 @auth_required
+@conditional
 def get_campaign(group_id, campaign_id):
-    group = Group.get(Group.id == group_id)
-    if not group:
-        return api_error("Group not found", status_code=404)
+    user = getattr(g, "user", None)
+    user_id = user.id if user else None
+    result = coalesce(
+        ("campaign", group_id, campaign_id, user_id),
+        lambda: serialize_campaign(campaign_id, group_id=group_id, user_id=user_id),
+    )
+    if result is None:
+        return api_error("Campaign not found", status_code=404)
 
-    campaign = Campaign.get(Campaign.id == campaign_id)
-    if not campaign:
+    return api_response(data=result, message="Campaign retrieved", status_code=200)
+
+
+@bp.route("/<int:group_id>/<int:campaign_id>/recommendations", methods=["GET"])
+@auth_required
+@conditional
+def get_campaign_recommendations(group_id, campaign_id):
+    if find_campaign(campaign_id, group_id) is None:
         return api_error("Campaign not found", status_code=404)
 
-    result = jsonify(campaign)
-    result.update(
-        {
-            "recommendations": jsonify(campaign.recommendations),
-        }
+    user = getattr(g, "user", None)
+    return list_response(
+        campaign_recommendations(campaign_id, user.id if user else None),
+        CampaignRecommendation.id,
+        serialize_recommendation_page,
+        message="Recommendations retrieved",
     )
 
-    return api_response(data=result, message="Campaign retrieved", status_code=200)
+
+@bp.route("/<int:group_id>/<int:campaign_id>/ratings", methods=["GET"])
+@auth_required
+@conditional
+def get_campaign_ratings(group_id, campaign_id):
+    if find_campaign(campaign_id, group_id) is None:
+        return api_error("Campaign not found", status_code=404)
+
+    return list_response(
+        campaign_ratings(campaign_id),
+        CampaignRecommendationRating.id,
+        serialize_ratings,
+        message="Ratings retrieved",
+    )
 
 
 @bp.route("/<int:group_id>/<int:campaign_id>", methods=["DELETE"])
@@ -88,30 +166,31 @@ def delete_campaign(group_id, campaign_id):
 
 @bp.route("/ratings/<int:user_id>/<int:campaign_recommendation_id>", methods=["POST"])
 @auth_required
-def add_campaign_recommendation_rating(user_id, campaign_recommendation_id, rating):
-    campaign_recommendation = CampaignRecommendation.get(
-        CampaignRecommendation.id == campaign_recommendation_id
-    )
-    if not campaign_recommendation:
-        return api_error("Campaign recommendation not found", status_code=404)
-
-    user = User.get(User.id == user_id)
-    if not user:
-        return api_error("User not found", status_code=404)
+def add_campaign_recommendation_rating(user_id, campaign_recommendation_id):
+    # The authenticated user is already loaded; ratings are only accepted
+    # for that user.
+    if user_id != g.user.id:
+        return api_error("Cannot rate for another user", status_code=403)
 
     rating = request.json.get("rating")
-    if not rating:
+    if rating is None:
         return api_error("Rating is required", status_code=400)
 
     try:
         rating = int(rating)
-    except ValueError:
+    except (TypeError, ValueError):
         return api_error("Invalid rating", status_code=400)
 
-    CampaignRecommendationRating.create(
-        campaign_recommendation=campaign_recommendation,
-        user=user,
-        rating=rating,
-    )
+    if (
+        not CampaignRecommendation.select()
+        .where(CampaignRecommendation.id == campaign_recommendation_id)
+        .bind(get_read_database())
+        .exists()
+    ):
+        return api_error("Campaign recommendation not found", status_code=404)
 
-    return api_response(message="Campaign recommendation rating added", status_code=201)
+    add_rating(campaign_recommendation_id, user_id, rating)
+
+    return api_response(
+        message="Campaign recommendation rating accepted", status_code=202
+    )
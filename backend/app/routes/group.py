@@ -1,9 +1,17 @@
-from flask import Blueprint, request, jsonify
-from ..models import Group, User, Campaign
+from flask import Blueprint, request
+from ..models import Campaign, Group, User
 import datetime
 import uuid
+from ..admission import coalesce
+from ..conditional import conditional
 from ..middleware import auth_required
 from ..utils import api_response, api_error
+from ..pagination import list_response
+from ..serializers import (
+    group_campaigns,
+    serialize_campaign_summaries,
+    serialize_group,
+)
 
 bp = Blueprint("group", __name__, url_prefix="/api/group")
 
@@ -36,20 +44,13 @@ def create_group(user_id):
 
 @bp.route("/<int:id>", methods=["GET"])
 @auth_required
+@conditional
 def get_group(id):
-    group = Group.get(Group.id == id)
-    if not group:
+    # Members opening the group page together share one load.
+    result = coalesce(("group", id), lambda: serialize_group(id))
+    if result is None:
         return api_error("Group not found", status_code=404)
 
-    campaigns = Campaign.select().where(Campaign.group == group)
-
-    result = jsonify(group)
-    result.update(
-        {
-            "campaigns": jsonify(campaigns),
-        }
-    )
-
     return api_response(
         data=result,
         message="Group retrieved",
@@ -57,6 +58,21 @@ def get_group(id):
     )
 
 
+@bp.route("/<int:id>/campaigns", methods=["GET"])
+@auth_required
+@conditional
+def get_group_campaigns(id):
+    if not Group.select().where(Group.id == id).exists():
+        return api_error("Group not found", status_code=404)
+
+    return list_response(
+        group_campaigns(id),
+        Campaign.id,
+        serialize_campaign_summaries,
+        message="Campaigns retrieved",
+    )
+
+
 @bp.route("/<int:id>", methods=["DELETE"])
 @auth_required
 def delete_group(id):
@@ -1,16 +1,24 @@
 import datetime
-from flask import Blueprint, jsonify, request
-from ..models import User, Group, instrument_choices, instrument_proficiency_levels
+from flask import Blueprint, g, request
+from ..models import (
+    User,
+    Group,
+    GroupUser,
+    instrument_choices,
+    instrument_proficiency_levels,
+)
 from ..utils import (
+    StaleRecommendations,
     generate_recommendations,
     hash_password,
     check_password,
+    verify_password,
     is_valid_password,
-    generate_jwt_token,
-    validate_jwt_token,
     api_response,
     api_error,
 )
+from ..auth import issue_token, revoke_token
+from ..conditional import conditional
 from ..middleware import auth_required
 
 bp = Blueprint("user", __name__, url_prefix="/api/user")
@@ -27,18 +35,23 @@ def login():
     if not is_valid_password(password):
         return api_error("Invalid password", status_code=400)
 
-    user = User.get(User.email == email)
+    user = User.get_or_none(User.email == email)
     if not user:
         return api_error("User not found", status_code=404)
 
-    if not check_password(password, user.password):
+    matches, new_hash = verify_password(password, user.password)
+    if not matches:
         return api_error("Invalid password", status_code=401)
 
-    # token = generate_jwt_token(user.id)
-    # TODO: set token in cookie
+    if new_hash:
+        # Stored with older hash parameters: upgrade while we have the
+        # plaintext.
+        User.update(password=new_hash).where(User.id == user.id).execute()
+
     user_data = {
         "id": user.id,
         "email": user.email,
+        "token": issue_token(user.id),
     }
     return api_response(
         data=user_data, message="Logged in successfully", status_code=200
@@ -46,8 +59,9 @@ def login():
 
 
 @bp.route("/<int:id>/logout", methods=["POST"])
+@auth_required
 def logout(id):
-    # TODO: invalidate token
+    revoke_token(g.token)
     return api_response(message="Logged out successfully", status_code=200)
 
 
@@ -111,6 +125,7 @@ def create_user():
 
 @bp.route("/<int:id>", methods=["GET"])
 @auth_required
+@conditional
 def get_user(id):
     print("Getting user")
     user = User.get(User.id == id)
@@ -144,17 +159,27 @@ def delete_user(id):
 
 @bp.route("/<int:id>/recommendations", methods=["GET"])
 @auth_required
+@conditional
 def get_recommendations(id):
     user = User.get(User.id == id)
     if not user:
         return api_error("User not found", status_code=404)
 
     recommendations = generate_recommendations(user)
-    return api_response(
+    response, status_code = api_response(
         data=recommendations,
         message="Recommendations retrieved",
         status_code=200,
     )
+    if isinstance(recommendations, StaleRecommendations):
+        response.headers["Warning"] = '110 - "Response is Stale"'
+        response.headers["X-Recommendations-Generated"] = (
+            recommendations.generated.isoformat()
+        )
+        response.headers["X-Recommendations-Model-Version"] = (
+            recommendations.model_version
+        )
+    return response, status_code
 
 
 @bp.route("/<int:id>/groups/<string:invite_code>", methods=["POST"])
@@ -168,10 +193,13 @@ def add_user_to_group(id, invite_code):
     if not group:
         return api_error("Group not found", status_code=404)
 
-    if user in group.users:
+    if (
+        GroupUser.select()
+        .where((GroupUser.group == group) & (GroupUser.user == user))
+        .exists()
+    ):
         return api_error("User already in group", status_code=400)
 
-    group.users.add(user)
-    group.save()
+    GroupUser.create(group=group, user=user, joined=datetime.datetime.now())
 
     return api_response(message="User added to group", status_code=200)
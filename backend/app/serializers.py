@@ -0,0 +1,286 @@
+from peewee import JOIN, Case, fn
+from .models import (
+    Album,
+    Artist,
+    Campaign,
+    CampaignRecommendation,
+    CampaignRecommendationRating,
+    Group,
+    GroupUser,
+    Song,
+    SongInstrumentProficiency,
+    User,
+)
+from .pagination import DEFAULT_PAGE_SIZE, keyset_page
+from .recommender.catalog import get_catalog
+
+# Every serializer runs a fixed number of queries, however many members,
+# campaigns or recommendations the response contains. Campaigns and
+# recommendations are embedded one page at a time, with the cursor for
+# the rest of the list on its paginated endpoint.
+
+
+def format_date(value):
+    return value.strftime("%Y-%m-%d") if value else None
+
+
+def serialize_member(user, joined=None):
+    return {
+        "id": user.id,
+        "email": user.email,
+        "instrument": user.instrument,
+        "proficiency": user.proficiency,
+        "joined": format_date(joined),
+    }
+
+
+def group_campaigns(group_id):
+    return (
+        Campaign.select(
+            Campaign.id,
+            Campaign.name,
+            Campaign.created_date,
+            Campaign.due_date,
+            fn.COUNT(CampaignRecommendation.id).alias("recommendation_count"),
+        )
+        .join(CampaignRecommendation, JOIN.LEFT_OUTER)
+        .where(Campaign.group == group_id)
+        .group_by(Campaign.id)
+    )
+
+
+def serialize_campaign_summaries(campaigns):
+    return [
+        {
+            "id": campaign.id,
+            "name": campaign.name,
+            "createdDate": format_date(campaign.created_date),
+            "dueDate": format_date(campaign.due_date),
+            "recommendationCount": campaign.recommendation_count,
+        }
+        for campaign in campaigns
+    ]
+
+
+def serialize_group(group_id):
+    # 3 queries: group with its admin, members, the first page of campaigns
+    # with counts (more from GET /group/<id>/campaigns?after=<cursor>).
+    group = (
+        Group.select(Group, User)
+        .join(User, on=(Group.admin_user == User.id))
+        .where(Group.id == group_id)
+        .get_or_none()
+    )
+    if group is None:
+        return None
+
+    members = (
+        GroupUser.select(GroupUser.joined, User)
+        .join(User)
+        .where(GroupUser.group == group_id)
+        .order_by(GroupUser.joined, User.id)
+    )
+    campaigns, cursor = keyset_page(
+        group_campaigns(group_id), Campaign.id, 0, DEFAULT_PAGE_SIZE
+    )
+
+    return {
+        "id": group.id,
+        "name": group.name,
+        "description": group.description,
+        "created": format_date(group.created),
+        "inviteCode": group.invite_code,
+        "admin": serialize_member(group.admin_user),
+        "members": [serialize_member(member.user, member.joined) for member in members],
+        "campaigns": serialize_campaign_summaries(campaigns),
+        "campaignsNextCursor": cursor,
+    }
+
+
+def serialize_song(
+    song_id, name, album_id, album_name, artist_id, artist_name, genre, requirements
+):
+    return {
+        "id": song_id,
+        "name": name,
+        "album": {
+            "id": album_id,
+            "name": album_name,
+            "artist": {"id": artist_id, "name": artist_name, "genre": genre},
+        },
+        "requirements": [
+            {"instrument": instrument, "proficiency": proficiency}
+            for instrument, proficiency in requirements
+        ],
+    }
+
+
+def catalog_songs(song_ids):
+    # Read from the catalog snapshot the recommenders already hold, so a
+    # page of recommendations needs no Song/Album/Artist join.
+    catalog = get_catalog()
+    strings = catalog.strings
+    rows, found = catalog.rows(song_ids)
+    return {
+        song_id: serialize_song(
+            song_id,
+            strings[catalog.song_names[row]],
+            int(catalog.album_ids[row]),
+            strings[catalog.album_names[row]],
+            int(catalog.artist_ids[row]),
+            strings[catalog.artist_names[row]],
+            int(catalog.genres[row]),
+            catalog.requirement_pairs(row),
+        )
+        for song_id, row, exists in zip(song_ids, rows, found)
+        if exists
+    }
+
+
+def database_songs(song_ids):
+    # Songs added since the catalog was last refreshed.
+    requirements = {}
+    for song_id, instrument, proficiency in (
+        SongInstrumentProficiency.select(
+            SongInstrumentProficiency.song,
+            SongInstrumentProficiency.instrument,
+            SongInstrumentProficiency.proficiency,
+        )
+        .where(SongInstrumentProficiency.song.in_(song_ids))
+        .tuples()
+    ):
+        requirements.setdefault(song_id, []).append((instrument, proficiency))
+
+    songs = (
+        Song.select(
+            Song.id,
+            Song.name,
+            Album.id,
+            Album.name,
+            Artist.id,
+            Artist.name,
+            Artist.genre,
+        )
+        .join(Album)
+        .join(Artist)
+        .where(Song.id.in_(song_ids))
+        .tuples()
+    )
+    return {
+        song[0]: serialize_song(*song, requirements.get(song[0], [])) for song in songs
+    }
+
+
+def campaign_recommendations(campaign_id, user_id=None):
+    # userRating is the requesting user's own rating, if any.
+    user_rating = fn.MAX(
+        Case(
+            None,
+            [
+                (
+                    CampaignRecommendationRating.user == user_id,
+                    CampaignRecommendationRating.rating,
+                )
+            ],
+        )
+    )
+    return (
+        CampaignRecommendation.select(
+            CampaignRecommendation.id,
+            CampaignRecommendation.song,
+            fn.AVG(CampaignRecommendationRating.rating).alias("average_rating"),
+            fn.COUNT(CampaignRecommendationRating.id).alias("rating_count"),
+            user_rating.alias("user_rating"),
+        )
+        .join(CampaignRecommendationRating, JOIN.LEFT_OUTER)
+        .where(CampaignRecommendation.campaign == campaign_id)
+        .group_by(CampaignRecommendation.id)
+    )
+
+
+def serialize_recommendation_page(rows):
+    # Pages are capped well below SQLite's bound-parameter limit, so the
+    # fallback query for songs missing from the catalog fits one IN list.
+    song_ids = [row.song_id for row in rows]
+    songs = catalog_songs(song_ids)
+    missing = [song_id for song_id in song_ids if song_id not in songs]
+    if missing:
+        songs.update(database_songs(missing))
+
+    return [
+        {
+            "id": row.id,
+            "song": songs[row.song_id],
+            "averageRating": row.average_rating,
+            "ratingCount": row.rating_count,
+            "userRating": row.user_rating,
+        }
+        for row in rows
+        if row.song_id in songs
+    ]
+
+
+def campaign_ratings(campaign_id):
+    return (
+        CampaignRecommendationRating.select(
+            CampaignRecommendationRating.id,
+            CampaignRecommendationRating.user,
+            CampaignRecommendationRating.rating,
+            CampaignRecommendation.id,
+            CampaignRecommendation.song,
+        )
+        .join(CampaignRecommendation)
+        .where(CampaignRecommendation.campaign == campaign_id)
+    )
+
+
+def serialize_ratings(rows):
+    return [
+        {
+            "id": row.id,
+            "recommendationId": row.campaign_recommendation.id,
+            "songId": row.campaign_recommendation.song_id,
+            "userId": row.user_id,
+            "rating": row.rating,
+        }
+        for row in rows
+    ]
+
+
+def find_campaign(campaign_id, group_id=None):
+    query = (
+        Campaign.select(Campaign, Group.id, Group.name)
+        .join(Group)
+        .where(Campaign.id == campaign_id)
+    )
+    if group_id is not None:
+        query = query.where(Campaign.group == group_id)
+    return query.get_or_none()
+
+
+def serialize_campaign(campaign_id, group_id=None, user_id=None):
+    # 2 queries: campaign with its group, and the first page of
+    # recommendations with rating aggregates; their songs come from the
+    # catalog. Later pages come from
+    # GET /campaign/<group>/<campaign>/recommendations?after=<cursor>.
+    campaign = find_campaign(campaign_id, group_id)
+    if campaign is None:
+        return None
+
+    rows, cursor = keyset_page(
+        campaign_recommendations(campaign_id, user_id),
+        CampaignRecommendation.id,
+        0,
+        DEFAULT_PAGE_SIZE,
+    )
+
+    return {
+        "id": campaign.id,
+        "name": campaign.name,
+        "groupId": campaign.group.id,
+        "groupName": campaign.group.name,
+        "createdDate": format_date(campaign.created_date),
+        "dueDate": format_date(campaign.due_date),
+        "recommendations": serialize_recommendation_page(rows),
+        "recommendationsNextCursor": cursor,
+    }
@@ -1,26 +1,62 @@
 import os
-from peewee import SqliteDatabase
-from app.recommender.hybrid import hybrid_recommendations
-from werkzeug.security import generate_password_hash, check_password_hash
-import jwt
-from datetime import datetime, timedelta
-from flask import current_app, jsonify
+from app.recommender.hybrid import (
+    hybrid_recommendations,
+    hybrid_campaign_recommendations,
+    serialize_songs,
+)
+from app.admission import Overloaded, admit
+from app.batch import load_user, load_group
+from app.cache import get_recommendation_cache, user_key, group_key
+from app.passwords import hash_password, verify_password
+from flask import jsonify
+
+
+class StaleRecommendations(list):
+    # Precomputed rows whose inputs changed since they were generated,
+    # served because there was no capacity to compute fresh ones. Never
+    # cached, so the next request tries again.
+    def __init__(self, items, precomputed):
+        super().__init__(items)
+        self.model_version = precomputed.model_version
+        self.generated = precomputed.generated
 
 
 def generate_recommendations(user):
-    return hybrid_recommendations(user)
+    def compute():
+        precomputed = load_user(user.id)
+        if precomputed is not None and not precomputed.stale:
+            return serialize_songs(precomputed.ranked, instrument=user.instrument)
+        with admit():
+            return hybrid_recommendations(user)
 
+    try:
+        return get_recommendation_cache().get_or_compute(user_key(user.id), compute)
+    except Overloaded:
+        precomputed = load_user(user.id)
+        if precomputed is None:
+            raise
+        return StaleRecommendations(
+            serialize_songs(precomputed.ranked, instrument=user.instrument),
+            precomputed,
+        )
 
-def generate_campaign_recommendations(group):
-    return hybrid_recommendations(group)
 
+def generate_campaign_recommendations(group, strategy=None):
+    def compute():
+        # Batch rows are generated with the default strategy only.
+        precomputed = load_group(group.id) if strategy is None else None
+        if precomputed is not None and not precomputed.stale:
+            return [song_id for song_id, _ in precomputed.ranked]
+        return hybrid_campaign_recommendations(group, strategy=strategy)
 
-def hash_password(raw_password):
-    return generate_password_hash(raw_password)
+    return get_recommendation_cache().get_or_compute(
+        group_key(group.id, strategy), compute
+    )
 
 
 def check_password(raw_password, hashed_password):
-    return check_password_hash(pwhash=hashed_password, password=raw_password)
+    matches, _ = verify_password(raw_password, hashed_password)
+    return matches
 
 
 def is_valid_password(raw_password):
@@ -30,40 +66,6 @@ def is_valid_password(raw_password):
     return True
 
 
-def initialize_database(db_path):
-    return SqliteDatabase(
-        db_path,
-        pragmas={
-            "journal_mode": "wal",
-            "cache_size": -1 * 64000,
-            "foreign_keys": 1,
-            "ignore_check_constraints": 0,
-            "synchronous": 0,
-        },
-    )
-
-
-def generate_jwt_token(user_id):
-    payload = {
-        "exp": datetime.now() + timedelta(days=7),
-        "iat": datetime.now(),
-        "sub": user_id,
-    }
-    return jwt.encode(payload, current_app.config.get("SECRET_KEY"), algorithm="HS256")
-
-
-def validate_jwt_token(token):
-    try:
-        payload = jwt.decode(
-            token, current_app.config.get("SECRET_KEY"), algorithms=["HS256"]
-        )
-        return payload["sub"]
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
-        return None
-
-
 def api_response(data=None, message=None, status_code=200):
     response = {
         "status": "success" if status_code < 400 else "error",
@@ -0,0 +1,83 @@
+import argparse
+import time
+import numpy as np
+from app.recommender.ann import build_index
+from app.recommender.content_filtering import top_k
+
+
+def clustered_vectors(rng, count, dim, clusters):
+    centres = rng.normal(0, 1, (clusters, dim))
+    labels = rng.integers(0, clusters, count)
+    return (centres[labels] + rng.normal(0, 0.5, (count, dim))).astype(np.float32)
+
+
+def exact_search(vectors, query, limit):
+    return set(top_k(vectors @ query, limit).tolist())
+
+
+def run(songs, dim, queries, limit, lists, nprobes, seed):
+    rng = np.random.default_rng(seed)
+    vectors = clustered_vectors(rng, songs, dim, max(1, songs // 1000))
+    ids = np.arange(songs)
+    query_vectors = clustered_vectors(rng, queries, dim, max(1, songs // 1000))
+
+    started = time.perf_counter()
+    index = build_index(vectors, ids, lists=lists, seed=seed)
+    print(
+        f"Built {len(index.centroids)} lists over {songs} x {dim} vectors "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+
+    truth = [exact_search(vectors, query, limit) for query in query_vectors]
+
+    timings = []
+    for query in query_vectors:
+        started = time.perf_counter()
+        top_k(vectors @ query, limit)
+        timings.append(time.perf_counter() - started)
+    report("exact", 1.0, timings)
+
+    for nprobe in nprobes:
+        recalls = []
+        timings = []
+        for query, expected in zip(query_vectors, truth):
+            started = time.perf_counter()
+            found, _ = index.search(query, limit, nprobe=nprobe)
+            timings.append(time.perf_counter() - started)
+            recalls.append(len(expected.intersection(found.tolist())) / limit)
+        report(f"nprobe={nprobe}", float(np.mean(recalls)), timings)
+
+
+def report(label, recall, timings):
+    timings = np.array(timings) * 1000
+    print(
+        f"{label:>12}  recall@k={recall:.3f}  "
+        f"p50={np.percentile(timings, 50):.3f}ms  "
+        f"p99={np.percentile(timings, 99):.3f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recall and latency of the IVF song index against exact search"
+    )
+    parser.add_argument("--songs", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--lists", type=int, default=None)
+    parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run(
+        args.songs,
+        args.dim,
+        args.queries,
+        args.limit,
+        args.lists,
+        args.nprobe,
+        args.seed,
+    )
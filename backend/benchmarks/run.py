@@ -0,0 +1,239 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from app.cache import get_recommendation_cache, group_key
+from app.config import get_database, initialize_config, initialize_recommender_config
+from app.models import Group, User
+from app.recommender import (
+    collaborative_filtering,
+    content_filtering,
+    factorization,
+    registry,
+)
+from app.recommender.aggregation import STRATEGIES
+from app.recommender.hybrid import rank_group, rank_user
+from app.routes.campaign import generate_campaign
+from benchmarks.synthetic import SCALES, generate
+from train_model import train_model
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, "data")
+RESULTS_DIR = os.path.join(HERE, "results")
+
+# Engines run to completion: the benchmark measures their cost, not how
+# often the online deadline would cut them off.
+BENCHMARK_DEADLINE_MS = 10 * 60 * 1000
+
+# A change is reported as a regression when it is this much slower (or
+# uses this much more memory) than the baseline.
+REGRESSION_THRESHOLD = 1.2
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=HERE, capture_output=True, text=True
+        ).stdout.strip()
+
+    return git("rev-parse", "HEAD") or "unknown", bool(git("status", "--porcelain"))
+
+
+def prepare(db_path, model_dir, users, songs, seed):
+    initialize_config(None, None, db_path, model_dir)
+    initialize_recommender_config(deadline_ms=BENCHMARK_DEADLINE_MS)
+
+    if not os.path.exists(db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        print(f"Generating {users} users and {songs} songs into {db_path}")
+        with get_database().connection_context():
+            generate(users, songs, seed=seed)
+
+    if registry.active_dir(model_dir) is None:
+        with get_database().connection_context():
+            train_model(model_dir, 32, 0.1, 10, os.cpu_count(), seed)
+
+
+def sample(model, count, rng):
+    ids = [row_id for (row_id,) in model.select(model.id).tuples()]
+    ids = rng.choice(ids, min(count, len(ids)), replace=False).tolist()
+    return list(model.select().where(model.id.in_(ids)))
+
+
+def measure(fn, inputs):
+    # First call pays for building or loading models; it is reported
+    # separately from the steady-state latencies.
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn(inputs[0])
+    cold = time.perf_counter() - started
+    _, cold_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = []
+    for item in inputs[1:]:
+        started = time.perf_counter()
+        fn(item)
+        timings.append(time.perf_counter() - started)
+
+    # Memory is traced in a separate pass so tracing does not skew timings.
+    tracemalloc.start()
+    for item in inputs[1:]:
+        fn(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings = np.array(timings) * 1000
+    return {
+        "cold_ms": cold * 1000,
+        "cold_peak_bytes": cold_peak,
+        "samples": len(timings),
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95)),
+        "p99_ms": float(np.percentile(timings, 99)),
+        "throughput_per_s": float(len(timings) / (timings.sum() / 1000)),
+        "peak_bytes": peak,
+    }
+
+
+def generate_and_discard(group):
+    # The campaign write is part of the measured path, but rolled back (and
+    # the cached recommendations dropped) so every call does the full work
+    # and repeated runs see the same database.
+    due_date = datetime.datetime.now() + datetime.timedelta(days=7)
+    with get_database().atomic() as transaction:
+        generate_campaign(group.id, "Benchmark", due_date, None)
+        transaction.rollback()
+    get_recommendation_cache().delete(group_key(group.id))
+
+
+def benchmarks(limit):
+    suite = {
+        "content": (
+            "user",
+            lambda user: content_filtering.get_recommendations(user, limit),
+        ),
+        "collaborative": (
+            "user",
+            lambda user: collaborative_filtering.get_recommendations(user, limit),
+        ),
+        "factorization": (
+            "user",
+            lambda user: factorization.get_recommendations(user, limit),
+        ),
+        "hybrid": ("user", lambda user: rank_user(user, limit)),
+    }
+    for strategy in STRATEGIES:
+        suite[f"campaign_{strategy}"] = (
+            "group",
+            lambda group, strategy=strategy: rank_group(group, limit, strategy),
+        )
+    suite["campaign_generation"] = ("group", generate_and_discard)
+    return suite
+
+
+def run(scale, samples, limit, seed, selected):
+    rng = np.random.default_rng(seed)
+    with get_database().connection_context():
+        inputs = {
+            "user": sample(User, samples + 1, rng),
+            "group": sample(Group, samples + 1, rng),
+        }
+
+        results = {}
+        for name, (kind, fn) in benchmarks(limit).items():
+            if selected and name not in selected:
+                continue
+            results[name] = measure(fn, inputs[kind])
+            print(
+                "{:>28}  cold={cold_ms:9.1f}ms  p50={p50_ms:8.2f}ms  "
+                "p99={p99_ms:8.2f}ms  {throughput_per_s:8.1f}/s  "
+                "peak={peak_mb:7.1f}MB".format(
+                    name, peak_mb=results[name]["peak_bytes"] / 2**20, **results[name]
+                )
+            )
+
+    commit, dirty = git_commit()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.datetime.now().isoformat(),
+        "scale": scale,
+        "samples": samples,
+        "limit": limit,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "benchmarks": results,
+    }
+
+
+def compare(baseline, current):
+    regressions = []
+    for name, result in current["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p99_ms", "peak_bytes"):
+            ratio = result[metric] / max(before[metric], 1e-9)
+            print(f"{name:>28}  {metric:>10}  {ratio:6.2f}x")
+            if ratio > REGRESSION_THRESHOLD:
+                regressions.append(f"{name} {metric}")
+    return regressions
+
+
+def write_results(results, name):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{results['commit'][:12]}-{name}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Latency, throughput and peak memory of the recommender "
+        "entry points on a synthetic database"
+    )
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--songs", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=content_filtering.DEFAULT_LIMIT)
+    parser.add_argument(
+        "--db-path", help="defaults to a generated database under benchmarks/data"
+    )
+    parser.add_argument("--only", nargs="+", help="benchmark names to run")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    scale = dict(SCALES[args.scale])
+    scale["users"] = args.users or scale["users"]
+    scale["songs"] = args.songs or scale["songs"]
+    name = f"{scale['users']}u-{scale['songs']}s-seed{args.seed}"
+
+    db_path = args.db_path or os.path.join(DATA_DIR, f"{name}.db")
+    prepare(db_path, f"{db_path}.models", scale["users"], scale["songs"], args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = run(scale, args.samples, args.limit, args.seed, args.only)
+    print(f"Results written to {write_results(results, name)}")
+
+    if baseline is not None:
+        regressions = compare(baseline, results)
+        if regressions:
+            raise SystemExit("Regressions: " + ", ".join(regressions))
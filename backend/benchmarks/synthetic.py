@@ -0,0 +1,309 @@
+import argparse
+import datetime
+import os
+import numpy as np
+from peewee import chunked
+from app.config import get_database, initialize_config
+from app.migrations import apply_migrations
+from app.models import (
+    Album,
+    Artist,
+    Campaign,
+    CampaignRecommendation,
+    CampaignRecommendationRating,
+    Group,
+    GroupUser,
+    Song,
+    SongInstrumentProficiency,
+    User,
+    UserGenre,
+    genre_choices,
+    instrument_choices,
+    instrument_proficiency_levels,
+)
+
+SCALES = {
+    "10k": {"users": 10000, "songs": 10000},
+    "100k": {"users": 100000, "songs": 100000},
+    "1m": {"users": 1000000, "songs": 1000000},
+}
+
+SQLITE_MAX_VARIABLES = 999
+ROWS_PER_TRANSACTION = 200000
+
+GENRES = len(genre_choices())
+INSTRUMENTS = len(instrument_choices())
+PROFICIENCIES = len(instrument_proficiency_levels())
+
+
+def insert(model, fields, columns):
+    # columns is a list of equally long arrays, one per field.
+    rows = zip(*[column.tolist() for column in columns])
+    batch_size = SQLITE_MAX_VARIABLES // len(fields)
+    db = get_database()
+    for transaction in chunked(rows, ROWS_PER_TRANSACTION):
+        with db.atomic():
+            for batch in chunked(transaction, batch_size):
+                model.insert_many(batch, fields=fields).execute()
+    return len(columns[0])
+
+
+def sizes(rng, count, low, high, mean):
+    # Long-tailed sizes (geometric around `mean`) clipped to [low, high].
+    return np.clip(rng.geometric(1.0 / mean, count), low, high)
+
+
+def zipf_choice(rng, population, count, exponent=1.1):
+    # Popularity-skewed sampling: a few songs get most of the exposure,
+    # like a real catalog.
+    weights = 1.0 / np.arange(1, population + 1) ** exponent
+    weights /= weights.sum()
+    return rng.permutation(population)[rng.choice(population, count, p=weights)]
+
+
+def generate(
+    users,
+    songs,
+    seed=0,
+    group_size=8,
+    campaigns_per_group=3,
+    campaign_size=20,
+    rating_probability=0.5,
+    factors=8,
+):
+    rng = np.random.default_rng(seed)
+    now = datetime.datetime(2024, 1, 1)
+    counts = {}
+    apply_migrations()
+
+    user_ids = np.arange(1, users + 1)
+    counts["users"] = insert(
+        User,
+        [
+            User.id,
+            User.email,
+            User.password,
+            User.created,
+            User.instrument,
+            User.proficiency,
+        ],
+        [
+            user_ids,
+            np.array([f"user{i}@example.com" for i in user_ids]),
+            np.full(users, "x"),
+            np.full(users, now),
+            rng.integers(0, INSTRUMENTS, users),
+            rng.integers(0, PROFICIENCIES, users),
+        ],
+    )
+
+    liked = rng.random((users, GENRES)) < 0.35
+    liked[np.arange(users), rng.integers(0, GENRES, users)] = True
+    genre_users, genres = np.nonzero(liked)
+    counts["user_genres"] = insert(
+        UserGenre, [UserGenre.user, UserGenre.genre], [genre_users + 1, genres]
+    )
+
+    artists = max(10, songs // 20)
+    albums = max(10, songs // 10)
+    counts["artists"] = insert(
+        Artist,
+        [Artist.id, Artist.name, Artist.genre],
+        [
+            np.arange(1, artists + 1),
+            np.array([f"Artist {i}" for i in range(artists)]),
+            rng.integers(0, GENRES, artists),
+        ],
+    )
+    counts["albums"] = insert(
+        Album,
+        [Album.id, Album.name, Album.artist],
+        [
+            np.arange(1, albums + 1),
+            np.array([f"Album {i}" for i in range(albums)]),
+            rng.integers(1, artists + 1, albums),
+        ],
+    )
+    counts["songs"] = insert(
+        Song,
+        [Song.id, Song.name, Song.album],
+        [
+            np.arange(1, songs + 1),
+            np.array([f"Song {i}" for i in range(songs)]),
+            rng.integers(1, albums + 1, songs),
+        ],
+    )
+
+    parts = rng.random((songs, INSTRUMENTS)) < 0.4
+    parts[np.arange(songs), rng.integers(0, INSTRUMENTS, songs)] = True
+    part_songs, part_instruments = np.nonzero(parts)
+    counts["requirements"] = insert(
+        SongInstrumentProficiency,
+        [
+            SongInstrumentProficiency.song,
+            SongInstrumentProficiency.instrument,
+            SongInstrumentProficiency.proficiency,
+        ],
+        [
+            part_songs + 1,
+            part_instruments,
+            rng.integers(0, PROFICIENCIES, len(part_songs)),
+        ],
+    )
+
+    # Bands: every user joins one group; sizes are long-tailed up to 50.
+    group_sizes = []
+    remaining = users
+    while remaining > 0:
+        size = int(min(remaining, sizes(rng, 1, 1, 50, group_size)[0]))
+        group_sizes.append(size)
+        remaining -= size
+    group_count = len(group_sizes)
+    member_groups = np.repeat(np.arange(1, group_count + 1), group_sizes)
+    members = rng.permutation(user_ids)
+    admins = members[np.concatenate(([0], np.cumsum(group_sizes)[:-1]))]
+
+    counts["groups"] = insert(
+        Group,
+        [
+            Group.id,
+            Group.name,
+            Group.created,
+            Group.admin_user,
+            Group.description,
+            Group.invite_code,
+        ],
+        [
+            np.arange(1, group_count + 1),
+            np.array([f"Band {i}" for i in range(group_count)]),
+            np.full(group_count, now),
+            admins,
+            np.full(group_count, ""),
+            np.array([f"INVITE{i}" for i in range(group_count)]),
+        ],
+    )
+    counts["group_users"] = insert(
+        GroupUser,
+        [GroupUser.group, GroupUser.user, GroupUser.joined],
+        [member_groups, members, np.full(users, now)],
+    )
+
+    campaign_count = group_count * campaigns_per_group
+    campaign_groups = np.repeat(np.arange(1, group_count + 1), campaigns_per_group)
+    counts["campaigns"] = insert(
+        Campaign,
+        [
+            Campaign.id,
+            Campaign.name,
+            Campaign.created_date,
+            Campaign.due_date,
+            Campaign.group,
+        ],
+        [
+            np.arange(1, campaign_count + 1),
+            np.array([f"Campaign {i}" for i in range(campaign_count)]),
+            np.full(campaign_count, now),
+            np.full(campaign_count, now + datetime.timedelta(days=7)),
+            campaign_groups,
+        ],
+    )
+
+    size = min(campaign_size, songs)
+    recommended = zipf_choice(rng, songs, campaign_count * size).reshape(-1, size) + 1
+    # (campaign, song) is unique: drop repeats inside a campaign.
+    recommended.sort(axis=1)
+    keep = np.ones_like(recommended, dtype=bool)
+    keep[:, 1:] = recommended[:, 1:] != recommended[:, :-1]
+    recommendation_campaigns = np.repeat(np.arange(1, campaign_count + 1), size)[
+        keep.ravel()
+    ]
+    recommendation_songs = recommended[keep]
+    counts["recommendations"] = insert(
+        CampaignRecommendation,
+        [
+            CampaignRecommendation.id,
+            CampaignRecommendation.campaign,
+            CampaignRecommendation.song,
+        ],
+        [
+            np.arange(1, len(recommendation_songs) + 1),
+            recommendation_campaigns,
+            recommendation_songs,
+        ],
+    )
+
+    # Members rate a random subset of their campaigns' songs; ratings come
+    # from hidden user/song factors so the data has learnable structure.
+    user_factors = rng.normal(0, 1, (users + 1, factors)) / np.sqrt(factors)
+    song_factors = rng.normal(0, 1, (songs + 1, factors))
+    groups_members = np.split(members, np.cumsum(group_sizes)[:-1])
+    recommendation_ids = np.arange(1, len(recommendation_songs) + 1)
+    first_campaign_recommendation = np.searchsorted(
+        recommendation_campaigns, np.arange(1, campaign_count + 1)
+    )
+
+    rating_rows = []
+    for group in range(group_count):
+        group_members = groups_members[group]
+        first = first_campaign_recommendation[group * campaigns_per_group]
+        last = (
+            first_campaign_recommendation[(group + 1) * campaigns_per_group]
+            if group + 1 < group_count
+            else len(recommendation_songs)
+        )
+        rated = rng.random((len(group_members), last - first)) < rating_probability
+        raters, offsets = np.nonzero(rated)
+        rating_rows.append(
+            (
+                recommendation_ids[first + offsets],
+                group_members[raters],
+                first + offsets,
+            )
+        )
+
+    rating_recommendations, rating_users, positions = (
+        np.concatenate(column) for column in zip(*rating_rows)
+    )
+    affinity = np.einsum(
+        "ij,ij->i",
+        user_factors[rating_users],
+        song_factors[recommendation_songs[positions]],
+    )
+    ratings = np.clip(
+        np.rint(3 + 1.5 * affinity + rng.normal(0, 0.5, len(affinity))), 1, 5
+    )
+    counts["ratings"] = insert(
+        CampaignRecommendationRating,
+        [
+            CampaignRecommendationRating.campaign_recommendation,
+            CampaignRecommendationRating.user,
+            CampaignRecommendationRating.rating,
+        ],
+        [rating_recommendations, rating_users, ratings.astype(np.int64)],
+    )
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fill a fresh database with seeded synthetic data"
+    )
+    parser.add_argument("db_path")
+    parser.add_argument("--scale", choices=SCALES, default="10k")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--songs", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.exists(args.db_path):
+        parser.error(f"{args.db_path} already exists")
+
+    scale = dict(SCALES[args.scale])
+    scale["users"] = args.users or scale["users"]
+    scale["songs"] = args.songs or scale["songs"]
+
+    initialize_config(None, None, args.db_path)
+    counts = generate(scale["users"], scale["songs"], seed=args.seed)
+    for table, count in counts.items():
+        print(f"{table}: {count}")
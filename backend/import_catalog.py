@@ -0,0 +1,249 @@
+import argparse
+import csv
+import gzip
+import json
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from peewee import chunked
+from app import create_app
+from app.config import get_database
+from app.models import (
+    Album,
+    Artist,
+    Song,
+    SongInstrumentProficiency,
+    genre_choices,
+    instrument_choices,
+    instrument_proficiency_levels,
+)
+
+# Stay under SQLite's default host-parameter limit for a single INSERT.
+SQLITE_MAX_VARIABLES = 999
+# Number of insert batches committed per transaction.
+BATCHES_PER_TRANSACTION = 50
+
+IMPORT_PRAGMAS = {
+    "foreign_keys": 0,
+    "cache_size": -1 * 256000,
+    "temp_store": "memory",
+}
+
+
+def open_dump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+    return open(path, newline="")
+
+
+def read_records(path):
+    # Streams one dict per row from a .csv or .jsonl/.ndjson file
+    # (optionally gzipped) without loading the file into memory.
+    name = path[:-3] if path.endswith(".gz") else path
+    with open_dump(path) as f:
+        if name.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def choice_parser(choices):
+    by_name = {label.lower(): value for value, label in choices}
+    values = {value for value, _ in choices}
+
+    def parse(raw):
+        if isinstance(raw, str) and not raw.strip().isdigit():
+            return by_name[raw.strip().lower()]
+        value = int(raw)
+        if value not in values:
+            raise ValueError(raw)
+        return value
+
+    return parse
+
+
+parse_genre = choice_parser(genre_choices())
+parse_instrument = choice_parser(instrument_choices())
+parse_proficiency = choice_parser(instrument_proficiency_levels())
+
+
+@contextmanager
+def import_pragmas(db):
+    # Foreign keys are resolved from the in-memory maps, so SQLite does
+    # not need to re-check them per row while importing.
+    previous = {name: db.pragma(name) for name in IMPORT_PRAGMAS}
+    for name, value in IMPORT_PRAGMAS.items():
+        db.pragma(name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            db.pragma(name, value)
+
+
+def insert_rows(model, rows, keys, ids):
+    # Rows of one batch become a single multi-row INSERT. Inside the
+    # write transaction SQLite hands out consecutive rowids, so the new
+    # ids are recovered from the last inserted rowid.
+    last_id = model.insert_many(rows).execute()
+    for offset, key in enumerate(keys):
+        ids[key] = last_id - len(keys) + 1 + offset
+
+
+def write(db, model, pending, ids, columns):
+    batch_size = max(1, SQLITE_MAX_VARIABLES // columns)
+    batches = chunked(pending, batch_size)
+    written = 0
+    for transaction in chunked(batches, BATCHES_PER_TRANSACTION):
+        with db.atomic():
+            for batch in transaction:
+                keys, rows = zip(*batch)
+                insert_rows(model, list(rows), keys, ids)
+                written += len(rows)
+    return written
+
+
+def unseen(records, ids, stats):
+    # Drops rows already present in the database or earlier in the dump.
+    seen = set()
+    for key, row in records:
+        if key is None:
+            stats["skipped"] += 1
+        elif key not in ids and key not in seen:
+            seen.add(key)
+            yield key, row
+
+
+def import_artists(db, records, stats):
+    ids = dict(Artist.select(Artist.name, Artist.id).tuples())
+
+    def rows():
+        for record in records:
+            name = record["name"].strip()
+            yield name, {"name": name, "genre": parse_genre(record["genre"])}
+
+    stats["artists"] = write(db, Artist, unseen(rows(), ids, stats), ids, 2)
+    return ids
+
+
+def import_albums(db, records, artist_ids, stats):
+    ids = {
+        (artist_id, name): album_id
+        for album_id, artist_id, name in Album.select(
+            Album.id, Album.artist, Album.name
+        ).tuples()
+    }
+
+    def rows():
+        for record in records:
+            artist_id = artist_ids.get(record["artist"].strip())
+            name = record["name"].strip()
+            if artist_id is None:
+                yield None, None
+                continue
+            yield (artist_id, name), {"name": name, "artist": artist_id}
+
+    stats["albums"] = write(db, Album, unseen(rows(), ids, stats), ids, 2)
+    return ids
+
+
+def resolve_album(record, artist_ids, album_ids):
+    artist_id = artist_ids.get(record["artist"].strip())
+    return album_ids.get((artist_id, record["album"].strip()))
+
+
+def import_songs(db, records, artist_ids, album_ids, stats):
+    ids = {
+        (album_id, name): song_id
+        for song_id, album_id, name in Song.select(
+            Song.id, Song.album, Song.name
+        ).tuples()
+    }
+
+    def rows():
+        for record in records:
+            album_id = resolve_album(record, artist_ids, album_ids)
+            name = record["name"].strip()
+            if album_id is None:
+                yield None, None
+                continue
+            yield (album_id, name), {"name": name, "album": album_id}
+
+    stats["songs"] = write(db, Song, unseen(rows(), ids, stats), ids, 2)
+    return ids
+
+
+def import_requirements(db, records, artist_ids, album_ids, song_ids, stats):
+    ids = {
+        (song_id, instrument, proficiency): requirement_id
+        for requirement_id, song_id, instrument, proficiency in (
+            SongInstrumentProficiency.select(
+                SongInstrumentProficiency.id,
+                SongInstrumentProficiency.song,
+                SongInstrumentProficiency.instrument,
+                SongInstrumentProficiency.proficiency,
+            ).tuples()
+        )
+    }
+
+    def rows():
+        for record in records:
+            album_id = resolve_album(record, artist_ids, album_ids)
+            song_id = song_ids.get((album_id, record["song"].strip()))
+            if song_id is None:
+                yield None, None
+                continue
+
+            instrument = parse_instrument(record["instrument"])
+            proficiency = parse_proficiency(record["proficiency"])
+            yield (song_id, instrument, proficiency), {
+                "song": song_id,
+                "instrument": instrument,
+                "proficiency": proficiency,
+            }
+
+    stats["requirements"] = write(
+        db, SongInstrumentProficiency, unseen(rows(), ids, stats), ids, 3
+    )
+
+
+def import_catalog(artists=(), albums=(), songs=(), requirements=()):
+    # Each argument is an iterable of dicts; they are consumed in
+    # dependency order so every foreign key resolves from the maps built
+    # by the previous stage.
+    db = get_database()
+    stats = {"skipped": 0}
+    with import_pragmas(db):
+        artist_ids = import_artists(db, artists, stats)
+        album_ids = import_albums(db, albums, artist_ids, stats)
+        song_ids = import_songs(db, songs, artist_ids, album_ids, stats)
+        import_requirements(db, requirements, artist_ids, album_ids, song_ids, stats)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stream CSV/JSONL catalog dumps into the database"
+    )
+    parser.add_argument("--artists", help="name, genre")
+    parser.add_argument("--albums", help="name, artist")
+    parser.add_argument("--songs", help="name, album, artist")
+    parser.add_argument(
+        "--requirements", help="song, album, artist, instrument, proficiency"
+    )
+    args = parser.parse_args()
+
+    load_dotenv("settings.env")
+    app = create_app()
+    with app.app_context():
+        stats = import_catalog(
+            read_records(args.artists) if args.artists else (),
+            read_records(args.albums) if args.albums else (),
+            read_records(args.songs) if args.songs else (),
+            read_records(args.requirements) if args.requirements else (),
+        )
+        print(
+            "Imported {artists} artists, {albums} albums, {songs} songs and "
+            "{requirements} requirements ({skipped} rows skipped)".format(**stats)
+        )
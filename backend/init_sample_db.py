@@ -2,20 +2,10 @@ import os
 import datetime
 from dotenv import load_dotenv
 from app import create_app
-from app.models import (
-    User,
-    UserGenre,
-    Group,
-    GroupUser,
-    Artist,
-    Album,
-    Song,
-    SongInstrumentProficiency,
-    Campaign,
-    CampaignRecommendation,
-    CampaignRecommendationRating,
-)
+from app.models import User, UserGenre, Group, GroupUser
+from app.migrations import apply_migrations
 from app.utils import hash_password
+from import_catalog import import_catalog
 
 
 def init_db():
@@ -23,24 +13,7 @@ def init_db():
     if not os.path.exists(db_dir):
         os.makedirs(db_dir)
 
-    tables = [
-        User,
-        UserGenre,
-        Group,
-        GroupUser,
-        Artist,
-        Album,
-        Song,
-        SongInstrumentProficiency,
-        Campaign,
-        CampaignRecommendation,
-        CampaignRecommendationRating,
-    ]
-
-    for table in tables:
-        if not table.table_exists():
-            print(f"Creating table: {table.__name__}")
-            table.create_table()
+    apply_migrations()
 
     if User.select().count() == 0:
         print("Adding sample data...")
@@ -68,14 +41,25 @@ def init_db():
             group=demo_group, user=admin_user, joined=datetime.datetime.now()
         )
 
-        led_zeppelin = Artist.create(name="Led Zeppelin", genre=0)  # Rock
-        album_iv = Album.create(name="Led Zeppelin IV", artist=led_zeppelin)
-        stairway = Song.create(name="Stairway to Heaven", album=album_iv)
-
-        SongInstrumentProficiency.create(
-            song=stairway,
-            instrument=0,  # Guitar
-            proficiency=2,  # Advanced
+        import_catalog(
+            artists=[{"name": "Led Zeppelin", "genre": "Rock"}],
+            albums=[{"name": "Led Zeppelin IV", "artist": "Led Zeppelin"}],
+            songs=[
+                {
+                    "name": "Stairway to Heaven",
+                    "album": "Led Zeppelin IV",
+                    "artist": "Led Zeppelin",
+                }
+            ],
+            requirements=[
+                {
+                    "song": "Stairway to Heaven",
+                    "album": "Led Zeppelin IV",
+                    "artist": "Led Zeppelin",
+                    "instrument": "Guitar",
+                    "proficiency": "Advanced",
+                }
+            ],
         )
 
         print("Sample data added successfully.")
@@ -0,0 +1,42 @@
+import argparse
+from dotenv import load_dotenv
+from app import initialize_settings
+from app.config import get_database
+from app.migrations import (
+    MIGRATIONS,
+    QueryPlanError,
+    applied_versions,
+    apply_migrations,
+    check_query_plans,
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply versioned schema migrations")
+    parser.add_argument("--to", type=int, help="stop after this version")
+    parser.add_argument(
+        "--status", action="store_true", help="list migrations and exit"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only run the query-plan checks of every migration",
+    )
+    args = parser.parse_args()
+
+    load_dotenv("settings.env")
+    initialize_settings()
+    with get_database().connection_context():
+        if args.status:
+            applied = applied_versions(get_database())
+            for migration in MIGRATIONS:
+                state = "applied" if migration.version in applied else "pending"
+                print(f"{migration.version:>4}  {state:<8} {migration.name}")
+        elif args.check:
+            try:
+                check_query_plans(get_database())
+            except QueryPlanError as e:
+                raise SystemExit(str(e))
+            print("All hot queries use an index")
+        else:
+            for migration in apply_migrations(args.to):
+                print(f"Applied {migration.version}: {migration.name}")
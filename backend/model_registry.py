@@ -0,0 +1,58 @@
+import argparse
+from dotenv import load_dotenv
+from app import initialize_settings
+from app.recommender import registry
+from app.recommender.artifacts import load_json
+from app.recommender.factorization import MODEL_CHECK_INTERVAL
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="List, activate and roll back published model versions"
+    )
+    parser.add_argument("--activate", metavar="VERSION", help="serve this version")
+    parser.add_argument(
+        "--rollback",
+        nargs="?",
+        const="",
+        metavar="VERSION",
+        help="serve the previous version, or the given one",
+    )
+    parser.add_argument(
+        "--prune",
+        type=int,
+        metavar="KEEP",
+        help="keep the newest KEEP training runs and remove older versions",
+    )
+    args = parser.parse_args()
+
+    load_dotenv("settings.env")
+    initialize_settings()
+    try:
+        if args.activate:
+            registry.set_current(args.activate)
+            print(f"Activated {args.activate}")
+        elif args.rollback is not None:
+            version = registry.rollback(args.rollback or None)
+            print(f"Rolled back to {version}")
+        elif args.prune is not None:
+            for version in registry.prune(args.prune):
+                print(f"Removed {version}")
+        else:
+            current = registry.current_version()
+            for version in registry.list_versions():
+                manifest = load_json(
+                    registry.bundle_dir(version), registry.MANIFEST_FILE
+                )
+                marker = "*" if version == current else " "
+                base = manifest.get("base_version")
+                print(
+                    f"{marker} {version}  {manifest['created']}  "
+                    f"users={manifest['users']} songs={manifest['songs']} "
+                    f"rmse={manifest['rmse']:.4f}"
+                    + (f"  compacted from {base}" if base else "")
+                )
+    except registry.RegistryError as e:
+        raise SystemExit(str(e))
+
+    if args.activate or args.rollback is not None:
+        print(f"Running servers switch within {MODEL_CHECK_INTERVAL} seconds")
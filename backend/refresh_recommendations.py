@@ -0,0 +1,30 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from app import create_app
+from app.batch import run_batch
+from app.recommender.content_filtering import DEFAULT_LIMIT
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precompute top-N recommendations for every user and group"
+    )
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the most recent unfinished run from its checkpoint",
+    )
+    parser.add_argument(
+        "--stale",
+        action="store_true",
+        help="only rebuild users and groups whose rows were marked stale",
+    )
+    args = parser.parse_args()
+
+    load_dotenv("settings.env")
+    app = create_app()
+    with app.app_context():
+        run = run_batch(args.limit, args.workers, args.resume, args.stale)
+        print(f"Batch run {run.id} ({run.model_version}) complete")
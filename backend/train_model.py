@@ -0,0 +1,243 @@
+import argparse
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+from peewee import fn
+from app import create_app
+from app.config import get_model_dir, get_read_database
+from app.models import CampaignRecommendationRating
+from app.recommender import registry
+from app.recommender.ann import DEFAULT_NPROBE, build_index, save_index
+from app.recommender.collaborative_filtering import load_ratings
+from app.recommender.content_filtering import publish_snapshot
+from app.recommender.factorization import write_artifacts
+
+# Upper bound on ratings handled per solve task; each task materializes
+# a (ratings x factors x factors) float32 block.
+CHUNK_RATINGS = 8192
+
+INDEX_DIR = "song_index"
+
+
+def row_chunks(indptr, chunk_ratings=CHUNK_RATINGS):
+    bounds = np.searchsorted(
+        indptr, np.arange(0, indptr[-1], chunk_ratings), side="right"
+    )
+    bounds = np.unique(np.concatenate(([0], bounds - 1, [len(indptr) - 1])))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def solve_rows(matrix, fixed, regularization, start, stop, out):
+    indptr = matrix.indptr[start : stop + 1]
+    counts = np.diff(indptr)
+    nonempty = counts > 0
+    if not nonempty.any():
+        return
+
+    begin, end = indptr[0], indptr[-1]
+    if end - begin > CHUNK_RATINGS:
+        # Only a single row with more ratings than a chunk gets here; its
+        # Gram matrix is summed by a matrix product instead of through a
+        # (ratings x factors x factors) block.
+        solve_large_rows(matrix, fixed, regularization, start, stop, out)
+        return
+
+    vectors = fixed[matrix.indices[begin:end]]
+    values = matrix.data[begin:end]
+    offsets = (indptr[:-1] - begin)[nonempty]
+
+    # Normal equations (V_u^T V_u + lambda * n_u * I) x_u = V_u^T r_u for
+    # every row in the chunk, summed with reduceat and solved as a batch.
+    gram = np.add.reduceat(vectors[:, :, None] * vectors[:, None, :], offsets, axis=0)
+    rhs = np.add.reduceat(vectors * values[:, None], offsets, axis=0)
+    gram += (
+        regularization
+        * counts[nonempty][:, None, None]
+        * np.eye(fixed.shape[1], dtype=fixed.dtype)
+    )
+    out[start:stop][nonempty] = np.linalg.solve(gram, rhs[:, :, None])[:, :, 0]
+
+
+def solve_large_rows(matrix, fixed, regularization, start, stop, out):
+    identity = np.eye(fixed.shape[1], dtype=fixed.dtype)
+    for row in range(start, stop):
+        begin, end = matrix.indptr[row], matrix.indptr[row + 1]
+        if begin == end:
+            continue
+        vectors = fixed[matrix.indices[begin:end]]
+        gram = vectors.T @ vectors + regularization * (end - begin) * identity
+        out[row] = np.linalg.solve(gram, vectors.T @ matrix.data[begin:end])
+
+
+def solve_side(executor, matrix, fixed, regularization):
+    out = np.zeros((matrix.shape[0], fixed.shape[1]), dtype=np.float32)
+    futures = [
+        executor.submit(solve_rows, matrix, fixed, regularization, start, stop, out)
+        for start, stop in row_chunks(matrix.indptr)
+    ]
+    for future in futures:
+        future.result()
+    return out
+
+
+def rmse(ratings, user_factors, song_factors):
+    rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))
+    predictions = np.einsum(
+        "ij,ij->i", user_factors[rows], song_factors[ratings.indices]
+    )
+    return float(np.sqrt(np.mean((ratings.data - predictions) ** 2)))
+
+
+def train(ratings, factors, regularization, iterations, workers, seed):
+    rng = np.random.default_rng(seed)
+    by_user = ratings.tocsr().astype(np.float32)
+    by_song = by_user.T.tocsr()
+
+    user_factors = np.zeros((by_user.shape[0], factors), dtype=np.float32)
+    song_factors = rng.normal(0, 0.1, (by_user.shape[1], factors)).astype(np.float32)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for iteration in range(iterations):
+            user_factors = solve_side(executor, by_user, song_factors, regularization)
+            song_factors = solve_side(executor, by_song, user_factors, regularization)
+            print(
+                f"Iteration {iteration + 1}/{iterations}: "
+                f"rmse={rmse(by_user, user_factors, song_factors):.4f}"
+            )
+
+    return user_factors, song_factors
+
+
+def train_model(
+    model_dir,
+    factors,
+    regularization,
+    iterations,
+    workers,
+    seed,
+    index_lists=None,
+    index_nprobe=DEFAULT_NPROBE,
+    with_index=True,
+    activate=True,
+):
+    # Read first: ratings written while training have higher sequence
+    # numbers and are picked up by the online updates
+    # (app/recommender/online.py).
+    last_rating_seq = (
+        CampaignRecommendationRating.select(
+            fn.MAX(CampaignRecommendationRating.updated_seq)
+        )
+        .bind(get_read_database())
+        .scalar()
+        or 0
+    )
+    user_ids, song_ids, ratings = load_ratings()
+    if ratings.nnz == 0:
+        print("No ratings to train on")
+        return None
+
+    global_mean = float(ratings.data.mean())
+    ratings.data -= global_mean
+    print(
+        f"Training on {ratings.nnz} ratings "
+        f"({len(user_ids)} users, {len(song_ids)} songs)"
+    )
+
+    user_factors, song_factors = train(
+        ratings, factors, regularization, iterations, workers, seed
+    )
+
+    # Everything is written into a hidden bundle directory that becomes
+    # visible, and then current, only once complete.
+    version = registry.new_version(model_dir)
+    bundle = registry.start_bundle(model_dir)
+    try:
+        index = None
+        if with_index:
+            song_index = build_index(
+                song_factors,
+                song_ids,
+                lists=index_lists,
+                nprobe=index_nprobe,
+                seed=seed,
+            )
+            save_index(song_index, os.path.join(bundle, INDEX_DIR))
+            index = INDEX_DIR
+            print(f"Built song index with {len(song_index.centroids)} lists")
+
+        # The catalog the model was trained against; workers start from it
+        # when no newer shared snapshot exists.
+        publish_snapshot(os.path.join(bundle, registry.CATALOG_DIR))
+
+        manifest = write_artifacts(
+            bundle,
+            {
+                "user_ids": user_ids,
+                "song_ids": song_ids,
+                "user_factors": user_factors,
+                "song_factors": song_factors,
+            },
+            {
+                "version": version,
+                "created": datetime.datetime.now().isoformat(),
+                "factors": factors,
+                "regularization": regularization,
+                "iterations": iterations,
+                "global_mean": global_mean,
+                "last_rating_seq": last_rating_seq,
+                "rmse": rmse(ratings.tocsr(), user_factors, song_factors),
+                "users": len(user_ids),
+                "songs": len(song_ids),
+                "index": index,
+                "catalog": registry.CATALOG_DIR,
+            },
+        )
+        registry.publish(bundle, version, model_dir, activate=activate)
+    except BaseException:
+        registry.discard_bundle(bundle)
+        raise
+
+    state = "active" if activate else "published, not active"
+    print(
+        f"Model {version} written to {registry.bundle_dir(version, model_dir)} ({state})"
+    )
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Train song/user latent factors with ALS"
+    )
+    parser.add_argument("--model-dir", default=None)
+    parser.add_argument("--factors", type=int, default=32)
+    parser.add_argument("--regularization", type=float, default=0.1)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--index-lists", type=int, default=None)
+    parser.add_argument("--index-nprobe", type=int, default=DEFAULT_NPROBE)
+    parser.add_argument("--no-index", action="store_true")
+    parser.add_argument(
+        "--no-activate",
+        action="store_true",
+        help="publish the version without serving it (see model_registry.py)",
+    )
+    args = parser.parse_args()
+
+    load_dotenv("settings.env")
+    app = create_app()
+    with app.app_context():
+        train_model(
+            args.model_dir or get_model_dir(),
+            args.factors,
+            args.regularization,
+            args.iterations,
+            args.workers,
+            args.seed,
+            args.index_lists,
+            args.index_nprobe,
+            not args.no_index,
+            not args.no_activate,
+        )
@@ -1,19 +1,61 @@
-from app import create_app
+from app import create_app, initialize, initialize_settings
+from app.config import close_connections, get_database, get_threads
+from app.prefork import serve_prefork
+from app.recommender.content_filtering import (
+    publish_snapshot,
+    start_snapshot_publisher,
+)
+from app.recommender.online import start_online_updates
 from dotenv import load_dotenv
 import os
+import signal
+import sys
 from waitress import serve
 
+
+def create_worker_app():
+    app = create_app()
+    start_online_updates()
+    start_snapshot_publisher()
+    return app
+
+
+def prepare_workers():
+    # Runs in the pre-fork master before workers are (re)started: writes
+    # the current catalog snapshot they all map, then drops every
+    # connection so none is inherited across fork(). Model versions need
+    # no restart; workers swap to a newly activated one on their own.
+    initialize()
+    with get_database().connection_context():
+        publish_snapshot()
+    close_connections()
+
+
 if __name__ == "__main__":
     load_dotenv("settings.env")
-    app = create_app()
 
     mode = os.getenv("MODE", "LOCAL")
     host = os.getenv("HOST", "127.0.0.1")
     port = os.getenv("PORT", 5000)
+    workers = int(os.getenv("WEB_WORKERS", 1))
 
     print(f"Running in {mode} mode on {host}:{port}")
+    if mode == "PRODUCTION" and workers > 1:
+        initialize_settings()
+        # SIGHUP: republish the catalog and replace workers one at a time.
+        serve_prefork(
+            host, port, workers, get_threads(), create_worker_app, prepare_workers
+        )
+        sys.exit(0)
+
+    app = create_worker_app()
+
+    # Exit through SystemExit on SIGTERM so atexit hooks (e.g. the rating
+    # buffer flush) run, as they do on Ctrl-C.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     if mode == "PRODUCTION":
-        serve(app, host=host, port=port)
+        serve(app, host=host, port=port, threads=get_threads())
     else:
         app.run(
             host=host,
@@ -1,6 +1,9 @@
 import React, { useState, useEffect } from "react";
 import { useParams, useNavigate, Link } from "react-router-dom";
-import { useCreateCampaignMutation } from "../api";
+import {
+  useCreateCampaignMutation,
+  useLazyGetCampaignJobQuery,
+} from "../api";
 import {
   Box,
   Typography,
@@ -30,6 +33,13 @@ import MusicNoteIcon from "@mui/icons-material/MusicNote";
 import ArrowBackIcon from "@mui/icons-material/ArrowBack";
 import AddIcon from "@mui/icons-material/Add";
 
+// Campaigns are generated by a background job; its status is polled
+// this often, for at most this many times.
+const JOB_POLL_INTERVAL_MS = 1000;
+const JOB_POLL_ATTEMPTS = 120;
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
 const Campaigns = () => {
   const { groupId } = useParams();
   const navigate = useNavigate();
@@ -69,7 +79,10 @@ const Campaigns = () => {
     },
   ]);
 
-  const [createCampaign, { isLoading }] = useCreateCampaignMutation();
+  const [createCampaign] = useCreateCampaignMutation();
+  const [getCampaignJob] = useLazyGetCampaignJobQuery();
+  const [isCreating, setIsCreating] = useState(false);
+  const [createError, setCreateError] = useState(null);
 
   const handleOpenDialog = () => {
     setOpenDialog(true);
@@ -77,6 +90,7 @@ const Campaigns = () => {
 
   const handleCloseDialog = () => {
     setOpenDialog(false);
+    setCreateError(null);
     setNewCampaign({
       name: "",
       dueDate: dayjs(),
@@ -97,31 +111,54 @@ const Campaigns = () => {
     });
   };
 
+  const waitForJob = async (jobId) => {
+    for (let attempt = 0; attempt < JOB_POLL_ATTEMPTS; attempt++) {
+      const { data: job } = await getCampaignJob(jobId).unwrap();
+      if (job.status === "succeeded") {
+        return job.result;
+      }
+      if (job.status === "failed") {
+        throw new Error(job.error || "Campaign generation failed");
+      }
+      await sleep(JOB_POLL_INTERVAL_MS);
+    }
+    throw new Error("Campaign generation is taking too long");
+  };
+
   const handleCreateCampaign = async () => {
+    const dueDate = newCampaign.dueDate.format("YYYY-MM-DD");
+    setIsCreating(true);
+    setCreateError(null);
     try {
-      const result = await createCampaign({
+      // The server answers 202 with the job generating the campaign.
+      const { data: accepted } = await createCampaign({
         groupId,
         campaignData: {
-          ...newCampaign,
-          dueDate: newCampaign.dueDate.format("YYYY-MM-DD"),
+          name: newCampaign.name,
+          due_date: dueDate,
         },
       }).unwrap();
+      const result = await waitForJob(accepted.job_id);
 
       // Add new campaign to the list
-      setCampaigns([
-        ...campaigns,
+      setCampaigns((current) => [
+        ...current,
         {
-          id: result.id,
+          id: result.campaign_id,
           name: newCampaign.name,
-          dueDate: newCampaign.dueDate.format("YYYY-MM-DD"),
-          recommendationCount: 0,
+          dueDate,
+          recommendationCount: result.recommendations,
         },
       ]);
 
       handleCloseDialog();
     } catch (err) {
-      // Handle error (ideally show in UI)
       console.error("Failed to create campaign:", err);
+      setCreateError(
+        err?.data?.message || err?.message || "Failed to create campaign"
+      );
+    } finally {
+      setIsCreating(false);
     }
   };
 
@@ -226,15 +263,20 @@ const Campaigns = () => {
                 minDate={dayjs()}
               />
             </LocalizationProvider>
+            {createError && (
+              <Alert severity="error" sx={{ mt: 2 }}>
+                {createError}
+              </Alert>
+            )}
           </DialogContent>
           <DialogActions>
             <Button onClick={handleCloseDialog}>Cancel</Button>
             <Button
               onClick={handleCreateCampaign}
               variant="contained"
-              disabled={isLoading || !newCampaign.name}
+              disabled={isCreating || !newCampaign.name}
             >
-              {isLoading ? "Creating..." : "Create"}
+              {isCreating ? "Creating..." : "Create"}
             </Button>
           </DialogActions>
         </Dialog>
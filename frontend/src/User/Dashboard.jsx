@@ -1,6 +1,10 @@
 import React, { useEffect, useState } from "react";
 import { useNavigate, Link } from "react-router-dom";
-import { useGetUserQuery, useGetUserRecommendationsQuery } from "../api";
+import {
+  useGetUserQuery,
+  useGetUserRecommendationsQuery,
+  useLogoutUserMutation,
+} from "../api";
 import {
   Box,
   Typography,
@@ -63,8 +67,15 @@ const Dashboard = () => {
     2: "Advanced",
   };
 
+  const [logoutUser] = useLogoutUserMutation();
+
   // Handle logout
-  const handleLogout = () => {
+  const handleLogout = async () => {
+    try {
+      await logoutUser(userId).unwrap();
+    } catch (err) {
+      console.error("Logout failed:", err);
+    }
     localStorage.removeItem("token");
     localStorage.removeItem("userId");
     navigate("/login");
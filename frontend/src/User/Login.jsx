@@ -47,8 +47,7 @@ const Login = () => {
     try {
       const result = await loginUser(credentials).unwrap();
       console.log(result);
-      // TODO: set token in cookie
-      localStorage.setItem("token", "123");
+      localStorage.setItem("token", result.data.token);
       localStorage.setItem("userId", result.data.id);
       navigate("/dashboard");
     } catch (err) {
@@ -2,7 +2,16 @@ import { createApi, fetchBaseQuery } from "@reduxjs/toolkit/query/react";
 
 export const musicRecommenderApi = createApi({
   reducerPath: "musicRecommenderApi",
-  baseQuery: fetchBaseQuery({ baseUrl: "http://localhost:8000/api" }),
+  baseQuery: fetchBaseQuery({
+    baseUrl: "http://localhost:8000/api",
+    prepareHeaders: (headers) => {
+      const token = localStorage.getItem("token");
+      if (token) {
+        headers.set("Authorization", `Bearer ${token}`);
+      }
+      return headers;
+    },
+  }),
   tagTypes: ["Users", "Groups", "Campaigns", "Recommendations"],
   endpoints: (builder) => ({
     // User endpoints
@@ -13,6 +22,12 @@ export const musicRecommenderApi = createApi({
         body: credentials,
       }),
     }),
+    logoutUser: builder.mutation({
+      query: (userId) => ({
+        url: `/user/${userId}/logout`,
+        method: "POST",
+      }),
+    }),
     createUser: builder.mutation({
       query: (userData) => ({
         url: "/user/register",
@@ -64,6 +79,11 @@ export const musicRecommenderApi = createApi({
       query: (groupId) => `/group/${groupId}`,
       providesTags: ["Groups"],
     }),
+    getGroupCampaigns: builder.query({
+      query: ({ groupId, after = 0, limit = 50 }) =>
+        `/group/${groupId}/campaigns?after=${after}&limit=${limit}`,
+      providesTags: ["Campaigns"],
+    }),
     deleteGroup: builder.mutation({
       query: (groupId) => ({
         url: `/group/${groupId}`,
@@ -81,10 +101,23 @@ export const musicRecommenderApi = createApi({
       }),
       invalidatesTags: ["Campaigns"],
     }),
+    getCampaignJob: builder.query({
+      query: (jobId) => `/campaign/jobs/${jobId}`,
+    }),
     getCampaign: builder.query({
       query: ({ groupId, campaignId }) => `/campaign/${groupId}/${campaignId}`,
       providesTags: ["Campaigns"],
     }),
+    getCampaignRecommendations: builder.query({
+      query: ({ groupId, campaignId, after = 0, limit = 50 }) =>
+        `/campaign/${groupId}/${campaignId}/recommendations?after=${after}&limit=${limit}`,
+      providesTags: ["Campaigns", "Recommendations"],
+    }),
+    getCampaignRatings: builder.query({
+      query: ({ groupId, campaignId, after = 0, limit = 50 }) =>
+        `/campaign/${groupId}/${campaignId}/ratings?after=${after}&limit=${limit}`,
+      providesTags: ["Recommendations"],
+    }),
     deleteCampaign: builder.mutation({
       query: ({ groupId, campaignId }) => ({
         url: `/campaign/${groupId}/${campaignId}`,
@@ -105,6 +138,7 @@ export const musicRecommenderApi = createApi({
 
 export const {
   useLoginUserMutation,
+  useLogoutUserMutation,
   useCreateUserMutation,
   useGetUserQuery,
   useDeleteUserMutation,
@@ -113,9 +147,14 @@ export const {
   useJoinGroupMutation,
   useCreateGroupMutation,
   useGetGroupQuery,
+  useGetGroupCampaignsQuery,
   useDeleteGroupMutation,
   useCreateCampaignMutation,
+  useGetCampaignJobQuery,
+  useLazyGetCampaignJobQuery,
   useGetCampaignQuery,
+  useGetCampaignRecommendationsQuery,
+  useGetCampaignRatingsQuery,
   useDeleteCampaignMutation,
   useRateCampaignRecommendationMutation,
 } = musicRecommenderApi;